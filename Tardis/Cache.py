@@ -31,67 +31,142 @@
 import collections
 import time
 import logging
+import threading
+import sys
+
+def sizeOf(value):
+    """ Rough size of a value in memory, counting the contents of containers, but not anything they contain """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sys.getsizeof(v) for v in value.itervalues())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(sys.getsizeof(v) for v in value)
+    return size
 
 class Cache(object):
-    def __init__(self, size, timeout, name='Cache'):
+    """
+    A least recently used cache, with optional timeouts on entries.
+    size is the maximum number of entries, maxBytes the maximum total size of the values, as measured by sizeOf.
+    Either can be 0 for no limit.  timeout is the number of seconds an entry stays valid, or 0 for no timeout.
+    """
+    def __init__(self, size, timeout, name='Cache', maxBytes=0, sizeOf=sizeOf):
         self.size = size
         self.timeout = timeout
+        self.maxBytes = maxBytes
+        self.sizeOf = sizeOf
+        self.name = name
+        # Entries are (value, timeout, bytes), kept in order of use, least recently used first.
         self.cache = collections.OrderedDict()
+        self.bytes = 0
+        self.nextFlush = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
         self.logger = logging.getLogger(name)
+        # Reentrant, as insert and retrieve flush with the lock held.
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.cache)
 
     def insert(self, key, value, now=None, timeout=None):
+        with self.lock:
+            self._insert(key, value, now, timeout)
+
+    def _insert(self, key, value, now, timeout):
+        if now is None:
+            now = time.time()
+
         # Use the regular timeout if it's specified
         if timeout is None:
             timeout = self.timeout
 
         # If there is a timeout, set the timeout time
         if timeout:
-            if now is None:
-                now = time.time()
             timeout += now
 
-        self.cache[key] = (value, timeout)
-        self.logger.debug("Inserting key %s", key)
-        if self.size != 0 and len(self.cache) > self.size:
-            self.flush()
-            if len(self.cache) > self.size:
-                self.cache.popitem(False)
+        nbytes = self.sizeOf(value) if self.maxBytes else 0
+        if key in self.cache:
+            self._remove(key)
+        self.cache[key] = (value, timeout, nbytes)
+        self.bytes += nbytes
+
+        self._maybeFlush(now)
+        while self.cache and ((self.size and len(self.cache) > self.size) or (self.maxBytes and self.bytes > self.maxBytes)):
+            self._remove(next(iter(self.cache)))
+            self.evictions += 1
 
     def retrieve(self, key):
-        if not key in self.cache:
-            self.logger.debug("Retrieving key %s failed", key)
+        with self.lock:
+            return self._retrieve(key)
+
+    def _retrieve(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is None:
+            self.misses += 1
             return None
-        (value, timeout) = self.cache[key]
-        if timeout and timeout < time.time():
-            self.logger.debug("Removing timedout key %s", key)
-            del self.cache[key]
-            self.flush()
+        (value, timeout, _) = entry
+        now = time.time()
+        if timeout and timeout < now:
+            self.bytes -= entry[2]
+            self.expirations += 1
+            self.misses += 1
+            self._maybeFlush(now)
             return None
-        self.logger.debug("Retrieving key %s", key)
+        # Move it to the most recently used end.
+        self.cache[key] = entry
+        self.hits += 1
         return value
 
     def delete(self, key):
-        if key in self.cache:
-            del self.cache[key]
+        with self.lock:
+            if key in self.cache:
+                self._remove(key)
+
+    def _remove(self, key):
+        (_, _, nbytes) = self.cache.pop(key)
+        self.bytes -= nbytes
+
+    def _maybeFlush(self, now):
+        # Expired entries are dropped when they're found, but ones which are never looked at again would hang around
+        # until they're pushed out, so sweep them up every so often.  The sweep looks at every entry, so it's only done
+        # once per timeout period.
+        if self.timeout and now >= self.nextFlush:
+            self._flush(now)
+            self.nextFlush = now + self.timeout
 
     def flush(self):
-        now = time.time()
-        i = self.cache.iteritems()
-        z = i.next()
-        try:
-            while z:
-                (_, item) = z
-                (_, timeout) = item
-                if timeout > now:
-                    return
-                self.cache.popitem(False)
-                z = i.next()
-        except:
-            # If something goes wrong, just punt.
-            pass
+        """ Remove all expired entries """
+        with self.lock:
+            self._flush(time.time())
+
+    def _flush(self, now):
+        expired = [k for (k, (_, timeout, _)) in self.cache.iteritems() if timeout and timeout < now]
+        for k in expired:
+            self._remove(k)
+        self.expirations += len(expired)
 
     def purge(self):
-        self.cache = collections.OrderedDict()
+        with self.lock:
+            self.cache = collections.OrderedDict()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries':      len(self.cache),
+                'bytes':        self.bytes,
+                'hits':         self.hits,
+                'misses':       self.misses,
+                'evictions':    self.evictions,
+                'expirations':  self.expirations
+            }
+
+    def logStats(self):
+        s = self.stats()
+        self.logger.debug("%s: %d entries (%d bytes).  %d hits, %d misses, %d evictions, %d expirations",
+                          self.name, s['entries'], s['bytes'], s['hits'], s['misses'], s['evictions'], s['expirations'])
 
 if __name__ == "__main__":
     c = Cache(5, 2)
@@ -100,10 +175,12 @@ if __name__ == "__main__":
     for i in range(0, 10):
         print i, " :: ", c.retrieve(i)
     print "----"
-    for i in range(5, 10):
+    c.retrieve(0)
+    for i in range(5, 9):
         c.insert(i, i * 100)
     for i in range(0, 10):
         print i, " :: ", c.retrieve(i)
     time.sleep(2)
     for i in range(0, 10):
         print i, " :: ", c.retrieve(i)
+    print c.stats()
@@ -34,6 +34,7 @@ import socket
 import logging
 import shutil
 import ConfigParser
+import cStringIO
 
 import Defaults
 
@@ -48,7 +49,10 @@ class CacheDir(object):
         self.user  = user if user else -1
         self.group = group if group else -1
         self.chown = user or group
-
+        self.index = None
+        self.packThreshold = 0
+        self.packSize = 0
+        self.superseded = []
 
         if not os.path.isdir(self.root):
             if create:
@@ -87,6 +91,83 @@ class CacheDir(object):
             except Exception as e:
                 logger.warning("Could not write cnofigpration file: %s", configFile)
 
+    def usePacks(self, index, threshold=0, packSize=64 * 1024 * 1024):
+        """
+        Keep small files in append only pack files, rather than each in a file of its own.  The index, normally the
+        client's TardisDB, records where in which pack each packed file is.  Packed files are read transparently, and
+        take precedence over an unpacked file of the same name.  Files no larger than threshold are packed when they're
+        inserted or stored.  If threshold is 0, existing packs are read, but nothing new is packed.
+        """
+        self.index = index
+        self.packThreshold = threshold
+        self.packSize = packSize
+
+    def packPath(self, packid):
+        return os.path.join(self.root, "packs", "pack-%08d" % packid)
+
+    def _member(self, name):
+        if self.index:
+            return self.index.getPackMember(name)
+        return None
+
+    def _readMember(self, member):
+        (packid, offset, size) = member
+        with open(self.packPath(packid), "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def _pack(self, name, data):
+        """ Append data to the current pack, starting a new one when it's full, and record where it went """
+        packid = self.index.getCurrentPack()
+        if packid is None or (os.path.exists(self.packPath(packid)) and os.path.getsize(self.packPath(packid)) >= self.packSize):
+            packid = self.index.newPack()
+        path = self.packPath(packid)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            if self.chown:
+                os.chown(directory, self.user, self.group)
+        with open(path, "ab") as f:
+            if self.chown:
+                os.fchown(f.fileno(), self.user, self.group)
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+        self.index.insertPackMember(name, packid, offset, len(data))
+        # Any older unpacked copy is hidden by this one, but is still needed if the index is rolled back.
+        if os.path.lexists(self.path(name)):
+            self.superseded.append(name)
+
+    def removeSuperseded(self):
+        """ Remove unpacked copies of files which have since been packed.  Call after the index has been committed """
+        for name in self.superseded:
+            if self._member(name) is not None and os.path.lexists(self.path(name)):
+                os.remove(self.path(name))
+        self.superseded = []
+
+    def repack(self, ratio=0.5):
+        """
+        Compact the pack files which are mostly dead space, by copying their live members into the current pack, and
+        deleting them.  Commits the index before the old packs are removed.  Returns the number of packs removed.
+        """
+        if not self.index:
+            return 0
+        sparse = self.index.listSparsePacks(ratio, exclude=self.index.getCurrentPack())
+        if not sparse:
+            return 0
+        for packid in sparse:
+            logger.debug("Repacking pack %d", packid)
+            with open(self.packPath(packid), "rb") as f:
+                for (name, offset, size) in self.index.listPackMembers(packid):
+                    f.seek(offset)
+                    self._pack(name, f.read(size))
+            self.index.deletePack(packid)
+        self.index.commit()
+        self.removeSuperseded()
+        for packid in sparse:
+            os.remove(self.packPath(packid))
+        return len(sparse)
+
     def comps(self, name):
         return [name[(i * self.partsize):((i + 1) * self.partsize)] for i in range(0, self.parts)]
 
@@ -97,9 +178,12 @@ class CacheDir(object):
         return os.path.join(self.dirPath(name), name)
 
     def exists(self, name):
-        return os.path.lexists(self.path(name))
+        return os.path.lexists(self.path(name)) or self._member(name) is not None
 
     def size(self, name):
+        member = self._member(name)
+        if member:
+            return member[2]
         try:
             s = os.stat(self.path(name))
             return s.st_size
@@ -121,17 +205,40 @@ class CacheDir(object):
         if iswrite:
             self.mkdir(name)
         path = self.path(name)
+        if not iswrite:
+            member = self._member(name)
+            if member:
+                return cStringIO.StringIO(self._readMember(member))
         f = open(path, mode)
-        if iswrite and self.chown:
-            os.fchown(f.fileno(), self.user, self.group)
+        if iswrite:
+            if self.chown:
+                os.fchown(f.fileno(), self.user, self.group)
+            # Otherwise the packed copy would hide the one being written
+            if self.index:
+                self.index.deletePackMember(name)
         return f
 
     def insert(self, name, source):
+        if self.packThreshold and os.path.getsize(source) <= self.packThreshold:
+            with open(source, "rb") as f:
+                self._pack(name, f.read())
+            os.remove(source)
+            return
         self.mkdir(name)
         path = self.path(name)
         shutil.move(source, path)
         if self.chown:
             os.chown(path, self.user, self.group)
+        if self.index:
+            self.index.deletePackMember(name)
+
+    def store(self, name, data):
+        """ Store a string as name """
+        if self.packThreshold and len(data) <= self.packThreshold:
+            self._pack(name, data)
+        else:
+            with self.open(name, "wb") as f:
+                f.write(data)
 
     def link(self, source, dest, soft=True):
         self.mkdir(dest)
@@ -145,11 +252,15 @@ class CacheDir(object):
         return True
 
     def remove(self, name):
+        removed = False
         try:
             os.remove(self.path(name))
-            return True
+            removed = True
         except OSError:
-            return False
+            pass
+        if self.index and self.index.deletePackMember(name):
+            removed = True
+        return removed
 
     def removeSuffixes(self, name, suffixes):
         deleted = 0
@@ -160,6 +271,12 @@ class CacheDir(object):
         return deleted
 
     def move(self, oldname, newname):
+        member = self._member(oldname)
+        if member:
+            # Packed.  Copy it into the current pack under the new name.
+            self._pack(newname, self._readMember(member))
+            self.index.deletePackMember(oldname)
+            return True
         try:
             self.mkdir(newname)
             os.rename(self.path(oldname), self.path(newname))
@@ -0,0 +1,102 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2016, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Content defined chunking.
+Splits a stream into variable sized chunks, with the boundaries chosen by a rolling (gear) hash of the content, so
+that data inserted or removed in one part of a file only changes the chunks around it.  Identical runs of data in
+different files (or different versions of the same file) produce identical chunks, which can then be stored once.
+Boundaries are chosen as in FastCDC:  no cut is made in the first minSize bytes, a harder to match mask is used up to
+avgSize, and an easier one after, which keeps most chunks close to the average.  A chunk is never longer than maxSize.
+"""
+
+import hashlib
+import struct
+
+# 256 random-ish 32 bit values.  These must never change, or the chunk boundaries (and hence the dedup) will change.
+_gear = [struct.unpack('<I', hashlib.md5(chr(i)).digest()[:4])[0] for i in range(256)]
+
+def _mask(bits):
+    # Use the high bits, as they're influenced by the most bytes.
+    return ((1 << bits) - 1) << (32 - bits)
+
+def _cut(data, start, end, minSize, avgSize, maxSize, maskS, maskL):
+    """ Find the end of the chunk which starts at start in data, looking no further than end """
+    if end - start <= minSize:
+        return end
+    end = min(end, start + maxSize)
+    normal = min(end, start + avgSize)
+    gear = _gear
+    h = 0
+    i = start + minSize
+    while i < normal:
+        h = ((h << 1) + gear[data[i]]) & 0xffffffff
+        i += 1
+        if not h & maskS:
+            return i
+    while i < end:
+        h = ((h << 1) + gear[data[i]]) & 0xffffffff
+        i += 1
+        if not h & maskL:
+            return i
+    return end
+
+def chunks(stream, minSize=256 * 1024, avgSize=1024 * 1024, maxSize=4 * 1024 * 1024):
+    """ Generator.  Read stream to the end, and yield it as a series of content defined chunks """
+    bits = avgSize.bit_length() - 1
+    maskS = _mask(bits + 2)
+    maskL = _mask(bits - 2)
+
+    buf = bytearray()
+    pos = 0
+    eof = False
+    while True:
+        # Keep at least a maximum sized chunk in the buffer, so a chunk is only cut short at the end of the stream
+        if not eof and len(buf) - pos < maxSize:
+            del buf[:pos]
+            pos = 0
+            while not eof and len(buf) < maxSize:
+                data = stream.read(maxSize)
+                if data:
+                    buf.extend(data)
+                else:
+                    eof = True
+        if pos == len(buf):
+            return
+        end = _cut(buf, pos, len(buf), minSize, avgSize, maxSize, maskS, maskL)
+        yield str(buf[pos:end])
+        pos = end
+
+if __name__ == "__main__":
+    import sys
+    for f in sys.argv[1:]:
+        with open(f, 'rb') as stream:
+            for chunk in chunks(stream):
+                print len(chunk), hashlib.md5(chunk).hexdigest()
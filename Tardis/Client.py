@@ -50,6 +50,10 @@ import cStringIO
 import shlex
 import urlparse
 import functools
+import collections
+import threading
+import Queue
+import multiprocessing.pool
 import stat
 import uuid
 import errno
@@ -67,10 +71,14 @@ import Tardis
 import Tardis.TardisCrypto as TardisCrypto
 import Tardis.CompressedBuffer as CompressedBuffer
 import Tardis.Connection as Connection
+import Tardis.Messages as Messages
 import Tardis.Util as Util
 import Tardis.Defaults as Defaults
 import Tardis.librsync as librsync
 import Tardis.MultiFormatter as MultiFormatter
+import Tardis.FileState as FileState
+import Tardis.Compressibility as Compressibility
+import Tardis.Chunker as Chunker
 
 features = Tardis.check_features()
 support_xattr = 'xattr' in features
@@ -102,12 +110,18 @@ configDefaults = {
     'SendClientConfig':     Defaults.getDefault('TARDIS_SEND_CONFIG'),
     'CompressData':         'none',
     'CompressMin':          str(4096),
+    'ZstdLevel':            None,
+    'ZstdThreads':          str(0),
+    'CompressStats':        None,
     'NoCompressFile':       Defaults.getDefault('TARDIS_NOCOMPRESS'),
     'NoCompress':           None,
     'Local':                str(False),
     'LocalServerCmd':       'tardisd --config ' + local_config,
     'CompressMsgs':         'none',
     'ChecksumContent':      str(0),
+    'ChunkFiles':           str(0),
+    'StateDB':              None,
+    'Window':               str(0),
     'Purge':                str(False),
     'IgnoreCVS':            str(False),
     'SkipCaches':           str(False),
@@ -122,6 +136,9 @@ configDefaults = {
     'ExcludeNoAccess':      str(True),
     'LogFiles':             None,
     'Verbosity':            str(0),
+    'ScanThreads':          str(4),
+    'DeltaThreads':         str(2),
+    'Streams':              str(0),
     'Stats':                str(False),
     'Report':               str(False),
     'Directories':          '.',
@@ -156,6 +173,23 @@ metaCache           = Util.bidict()                 # A cache of metadata.  Sinc
                                                     # that we haven't sent it yet.
 newmeta             = []                            # When we encounter new metadata, keep it here until we flush it to the server.
 
+fileState           = None                          # Local record of file checksums and signatures from previous runs
+deltaBases          = {}                            # Checksums the server will use as the basis for requested deltas
+compressibility     = None                          # How well each type of file has compressed, in previous runs and this one
+
+scanPool            = None                          # Thread pool for reading directories ahead of the main traversal
+pendingScans        = {}                            # Directory scans submitted to the pool, but not yet consumed.  Path -> AsyncResult
+scanLock            = threading.Lock()              # Protects the metadata cache and the stats, which are updated by the scanners
+
+deltaPool           = None                          # Thread pool for generating deltas, checksums, and signatures ahead of sending them
+
+dataToken           = None                          # Token from the server allowing data streams to join this session
+streamQueue         = None                          # Transfers waiting to be sent on a data stream
+streamDone          = Queue.Queue()                 # Transfers which have been sent on a data stream, waiting to be finished in the main thread
+streamFailed        = Queue.Queue()                 # Transfers which failed on a data stream, waiting to be resent on the main connection
+streamThreads       = []                            # Threads sending on the data streams
+streamsStopping     = False
+
 noCompTypes         = []
 
 crypt               = None
@@ -273,24 +307,29 @@ def processChecksums(inodes):
     files = []
     for inode in inodes:
         try:
-            (_, pathname) = inodeDB[inode]
+            (fileInfo, pathname) = inodeDB[inode]
 
             printProgress("File [C]:", pathname)
 
-            m = Util.getHash(crypt, args.crypt)
-            s = os.lstat(pathname)
-            mode = s.st_mode
-            if stat.S_ISLNK(mode):
-                m.update(os.readlink(pathname))
-            else:
-                try:
-                    with open(pathname, "rb") as file:
-                        for chunk in iter(functools.partial(file.read, args.chunksize), ''):
-                            m.update(chunk)
-                except IOError as e:
-                    logger.error("Unable to generate checksum for %s: %s", pathname, str(e))
-                    exceptionLogger.log(e)
-            checksum = m.hexdigest()
+            # If the file hasn't changed since we last checksummed it, don't bother reading it.
+            checksum = fileState.getChecksum(fileInfo) if fileState else None
+            if checksum is None:
+                m = Util.getHash(crypt, args.crypt)
+                s = os.lstat(pathname)
+                mode = s.st_mode
+                if stat.S_ISLNK(mode):
+                    m.update(os.readlink(pathname))
+                else:
+                    try:
+                        with open(pathname, "rb") as file:
+                            for chunk in iter(functools.partial(file.read, args.chunksize), ''):
+                                m.update(chunk)
+                    except IOError as e:
+                        logger.error("Unable to generate checksum for %s: %s", pathname, str(e))
+                        exceptionLogger.log(e)
+                checksum = m.hexdigest()
+                if fileState:
+                    fileState.setState(fileInfo, checksum)
             files.append({ "inode": inode, "checksum": checksum })
         except KeyError as e:
             logger.error("Unable to process checksum for %s, not found in inodeDB", str(inode))
@@ -341,6 +380,16 @@ def handleAckSum(response):
         sendContent(i, 'Full')
         delInode(i)
 
+    # Chunked files are always sent as content, as in handleAckDir.
+    if args.chunkfiles:
+        chunked = set(tuple(x) for x in delta if chunkable(tuple(x)))
+        delta = [x for x in delta if tuple(x) not in chunked]
+        for i in chunked:
+            if logfiles:
+                logFileInfo(i, 'n')
+            sendContent(i, 'Full')
+            delInode(i)
+
     signatures = None
     if not args.full and len(delta) != 0:
         signatures = prefetchSigFiles(delta)
@@ -365,6 +414,19 @@ def makeEncryptor():
         hmac = None
     return (func, pad, iv, hmac)
 
+def localSigFiles(inodes):
+    """ Find the signatures for any of the delta requests which we have recorded locally, matching the server's basis """
+    signatures = {}
+    for i in [tuple(x) for x in inodes]:
+        basis = deltaBases.pop(i, None)
+        if fileState and basis and i in inodeDB:
+            (fileInfo, _) = inodeDB[i]
+            sigfile = fileState.getSignature(fileInfo, basis)
+            if sigfile:
+                logger.debug("Using local signature for %s: Chksum: %s", str(i), basis)
+                signatures[i] = (sigfile, basis)
+    return signatures
+
 def prefetchSigFiles(inodes):
     logger.debug("Requesting signature files: %s", str(inodes))
     signatures = {}
@@ -425,47 +487,161 @@ def fetchSignature(inode):
     return (sigfile, None)
 
 
-def processDelta(inode, signatures):
-    """ Generate a delta and send it """
+def streamWorker(stream):
+    """ Send transfers on a data stream, until the streams are shut down, or this one fails """
+    while True:
+        try:
+            (send, finish, pathname) = streamQueue.get(timeout=1)
+        except Queue.Empty:
+            if streamsStopping:
+                break
+            continue
+        sendStats = { 'dataSent': 0 }
+        try:
+            result = send(stream, sendStats, None)
+        except Exception as e:
+            # The stream is in an unknown state, so stop using it, and have the main thread send this file instead.
+            logger.error("Data stream failed sending %s: %s", pathname, e)
+            streamFailed.put((send, finish, pathname))
+            stream.sock.close()
+            return
+        streamDone.put((finish, result, sendStats))
+    stream.close()
+
+def openStreams(server, port):
+    """ Open the data streams, and start sending on them """
+    global streamQueue
+    streamQueue = Queue.Queue(args.streams * 2)
+    for i in range(args.streams):
+        try:
+            stream = getConnection(server, port)
+            stream.send({ "message": "DATA", "sessionid": str(sessionid), "token": dataToken })
+            resp = stream.receive()
+            if resp['status'] != 'OK':
+                raise Exception(resp.get('error', 'Data stream refused'))
+        except Exception as e:
+            logger.warning("Unable to open data stream: %s", str(e))
+            exceptionLogger.log(e)
+            break
+        thread = threading.Thread(target=streamWorker, args=(stream,), name="DataStream-{}".format(i))
+        thread.daemon = True
+        thread.start()
+        streamThreads.append(thread)
+    logger.debug("Opened %d data streams", len(streamThreads))
+
+def finishTransfers():
+    """ Finish up any transfers which have been sent on the data streams, and resend any which failed on the main connection """
+    while True:
+        try:
+            (finish, result, sendStats) = streamDone.get_nowait()
+        except Queue.Empty:
+            break
+        for (name, amount) in sendStats.items():
+            Util.accumulateStat(stats, name, amount)
+        finish(*result)
+    while True:
+        try:
+            (send, finish, pathname) = streamFailed.get_nowait()
+        except Queue.Empty:
+            return
+        logger.warning("Resending %s on the main connection", pathname)
+        finish(*send(conn, stats, None))
+
+def stopStreams():
+    """ Wait for the data streams to send everything queued for them, and shut them down """
+    global streamsStopping
+    streamsStopping = True
+    for thread in streamThreads:
+        thread.join()
+    # If any streams failed, there may be transfers left over.  Send them on the main connection
+    while True:
+        try:
+            (send, finish, pathname) = streamQueue.get_nowait()
+        except Queue.Empty:
+            break
+        finish(*send(conn, stats, None))
+    finishTransfers()
+    del streamThreads[:]
+
+def transfer(send, finish, pathname):
+    """ Send the data for a file, and finish it up.  If there are data streams, the send is queued to run on one of them, and
+        the file is finished in the main thread after it's been sent.  Otherwise it's all done now, on the main connection. """
+    while any(thread.is_alive() for thread in streamThreads):
+        try:
+            streamQueue.put((send, finish, pathname), timeout=1)
+            finishTransfers()
+            return
+        except Queue.Full:
+            finishTransfers()
+    progress = printProgress if args.progress else None
+    finish(*send(conn, stats, progress))
+
+def makeDelta(pathname, sigfile):
+    """ Generate a delta for a file against a signature.  Can be run in a delta worker thread.
+        Returns the delta file, its size, and the checksum, size, and (if needed) new signature of the file """
+    # If we're encrypted, we need to generate a new signature, and send it along
+    # Likewise if we're saving state, so the next delta can be generated locally
+    makeSig = (args.crypt and crypt) or args.signature or (fileState is not None)
+
+    logger.debug("Generating delta for %s", pathname)
+
+    # Create a buffered reader object, which can generate the checksum and an actual filesize while
+    # reading the file.  And, if we need it, the signature
+    reader = CompressedBuffer.BufferedReader(open(pathname, "rb"), hasher=Util.getHash(crypt, args.crypt), signature=makeSig)
+    # HACK: Monkeypatch the reader object to have a seek function to keep librsync happy.  Never gets called
+    reader.seek = lambda x, y: 0
+
+    # Generate the delta file
+    delta = librsync.delta(reader, sigfile)
+    sigfile.close()
+
+    # get the auxiliary info
+    checksum = reader.checksum()
+    filesize = reader.size()
+    newsig = reader.signatureFile()
+
+    # Figure out the size of the delta file.  Seek to the end, do a tell, and go back to the start
+    # Ugly.
+    delta.seek(0, 2)
+    deltasize = delta.tell()
+    delta.seek(0)
+
+    return (delta, deltasize, checksum, filesize, newsig)
+
+def findSignature(inode, signatures):
+    if signatures and inode in signatures:
+        return signatures[inode]
+    else:
+        return fetchSignature(inode)
+
+def startDelta(inode, signatures):
+    """ Start generating a delta in the delta pool.  Returns the basis checksum, and a function to wait for the results
+        (or None if there's no signature to generate against), to be passed to processDelta """
+    if inode not in inodeDB:
+        return None
+    (_, pathname) = inodeDB[inode]
+    (sigfile, oldchksum) = findSignature(inode, signatures)
+    if sigfile is None:
+        return (oldchksum, None)
+    return (oldchksum, deltaPool.apply_async(makeDelta, (pathname, sigfile)).get)
+
+def processDelta(inode, signatures, pending=None):
+    """ Generate a delta and send it.  If pending is set, the delta is already being generated, by startDelta """
 
     try:
-        (_, pathname) = inodeDB[inode]
+        (fileInfo, pathname) = inodeDB[inode]
         printProgress("File [D]:", pathname)
         logger.debug("Processing delta: %s :: %s", str(inode), pathname)
 
-        if signatures and inode in signatures:
-            (sigfile, oldchksum) = signatures[inode]
+        if pending:
+            (oldchksum, generate) = pending
         else:
-            (sigfile, oldchksum) = fetchSignature(inode)
+            (sigfile, oldchksum) = findSignature(inode, signatures)
+            generate = functools.partial(makeDelta, pathname, sigfile) if sigfile is not None else None
 
-        if sigfile is not None:
+        if generate is not None:
             try:
-                newsig = None
-                # If we're encrypted, we need to generate a new signature, and send it along
-                makeSig = (args.crypt and crypt) or args.signature
-
-                logger.debug("Generating delta for %s", pathname)
-
-                # Create a buffered reader object, which can generate the checksum and an actual filesize while
-                # reading the file.  And, if we need it, the signature
-                reader = CompressedBuffer.BufferedReader(open(pathname, "rb"), hasher=Util.getHash(crypt, args.crypt), signature=makeSig)
-                # HACK: Monkeypatch the reader object to have a seek function to keep librsync happy.  Never gets called
-                reader.seek = lambda x, y: 0
-
-                # Generate the delta file
-                delta = librsync.delta(reader, sigfile)
-                sigfile.close()
-
-                # get the auxiliary info
-                checksum = reader.checksum()
-                filesize = reader.size()
-                newsig = reader.signatureFile()
-
-                # Figure out the size of the delta file.  Seek to the end, do a tell, and go back to the start
-                # Ugly.
-                delta.seek(0, 2)
-                deltasize = delta.tell()
-                delta.seek(0)
+                (delta, deltasize, checksum, filesize, newsig) = generate()
             except Exception as e:
                 logger.warning("Unable to process signature.  Sending full file: %s: %s", pathname, str(e))
                 exceptionLogger.log(e)
@@ -485,32 +661,43 @@ def processDelta(inode, signatures):
                     "encrypted": (iv is not None)
                 }
 
-                sendMessage(message)
-                #batchMessage(message, flush=True, batch=False, response=False)
                 compress = args.compress if (args.compress and (filesize > args.mincompsize)) else None
-                progress = printProgress if args.progress else None
-                (sent, _, _) = Util.sendData(conn.sender, delta, encrypt, pad, chunksize=args.chunksize, compress=compress, stats=stats, hmac=hmac, iv=iv, progress=progress)
-                delta.close()
-
-                # If we have a signature, send it.
-                sigsize = 0
-                if newsig:
-                    message = {
-                        "message" : "SIG",
-                        "checksum": checksum
-                    }
-                    sendMessage(message)
-                    #batchMessage(message, flush=True, batch=False, response=False)
-                    # Send the signature, generated above
-                    (sigsize, _, _) = Util.sendData(conn.sender, newsig, chunksize=args.chunksize, compress=False, stats=stats, progress=progress)            # Don't bother to encrypt the signature
-                    newsig.close()
 
-                if args.report:
-                    x = { 'type': 'Delta', 'size': sent, 'sigsize': sigsize }
-                    # Convert to Unicode, and normalize any characters, so lengths become reasonable
-                    name = unicodedata.normalize('NFD', unicode(pathname.decode('utf-8')))
-                    report[os.path.split(pathname)] = x
-                logger.debug("Completed %s -- Checksum %s -- %s bytes, %s signature bytes", Util.shortPath(pathname), checksum, sent, sigsize)
+                # Start from the beginning each time, as a send which fails on a data stream is retried on the main connection
+                def send(stream, sendStats, progress):
+                    stream.send(message)
+                    delta.seek(0)
+                    (sent, _, _) = Util.sendData(stream.sender, delta, encrypt, pad, chunksize=args.chunksize, compress=compress, stats=sendStats, hmac=hmac, iv=iv, progress=progress)
+
+                    # If we have a signature, send it.
+                    sigsize = 0
+                    if newsig:
+                        sigmessage = {
+                            "message" : "SIG",
+                            "checksum": checksum
+                        }
+                        stream.send(sigmessage)
+                        # Send the signature, generated above
+                        newsig.seek(0)
+                        (sigsize, _, _) = Util.sendData(stream.sender, newsig, chunksize=args.chunksize, compress=False, stats=sendStats, progress=progress)            # Don't bother to encrypt the signature
+                    return (sent, sigsize)
+
+                def finish(sent, sigsize):
+                    delta.close()
+                    if newsig:
+                        if fileState:
+                            newsig.seek(0)
+                            fileState.setState(fileInfo, checksum, newsig.read())
+                        newsig.close()
+                    elif fileState:
+                        fileState.setState(fileInfo, checksum)
+
+                    if args.report:
+                        x = { 'type': 'Delta', 'size': sent, 'sigsize': sigsize }
+                        report[os.path.split(pathname)] = x
+                    logger.debug("Completed %s -- Checksum %s -- %s bytes, %s signature bytes", Util.shortPath(pathname), checksum, sent, sigsize)
+
+                transfer(send, finish, pathname)
             else:
                 if logger.isEnabledFor(logging.DEBUG):
                     logger.debug("Delta size for %s is too large.  Sending full content: Delta: %d File: %d", Util.shortPath(pathname, 40), deltasize, filesize)
@@ -567,58 +754,162 @@ def sendContent(inode, reportType):
                 return
 
             # Attempt to send the data.
-            sig = None
-            sigsize = 0
-            try:
-                compress = args.compress if (args.compress and (filesize > args.mincompsize)) else None
-                progress = printProgress if args.progress else None
-                # Check if it's a file type we don't want to compress
-                if compress and noCompTypes:
-                    mimeType = magic.from_buffer(data.read(128), mime=True)
+            compress = args.compress if (args.compress and (filesize > args.mincompsize)) else None
+            # Check if it's a file type we don't want to compress.  Check the types we've learned don't compress first,
+            # as that doesn't require reading the file
+            if compress and not compressibility.shouldCompress(pathname):
+                logger.debug("Not compressing %s.  Type doesn't compress", pathname)
+                compress = False
+            elif compress and noCompTypes:
+                mimeType = magic.from_buffer(data.read(128), mime=True)
+                data.seek(0)
+                if mimeType in noCompTypes:
+                    logger.debug("Not compressing %s.  Type %s", pathname, mimeType)
+                    compressibility.record(pathname, filesize, filesize)
+                    compress = False
+            if chunkable(inode):
+                sendChunks(inode, reportType, data, compress)
+                return
+
+            compInfo = {}
+            makeSig = (args.crypt and crypt) or args.signature or (fileState is not None)
+
+            # Start from the beginning each time, as a send which fails on a data stream is retried on the main connection
+            def send(stream, sendStats, progress):
+                try:
+                    stream.send(message)
                     data.seek(0)
-                    if mimeType in noCompTypes:
-                        logger.debug("Not compressing %s.  Type %s", pathname, mimeType)
-                        compress = False
-                makeSig = (args.crypt and crypt) or args.signature
-                sendMessage(message)
-                #batchMessage(message, batch=False, flush=True, response=False)
-                (size, checksum, sig) = Util.sendData(conn.sender, data,
-                                                      encrypt, pad, hasher=Util.getHash(crypt, args.crypt),
-                                                      chunksize=args.chunksize,
-                                                      compress=compress,
-                                                      signature=makeSig,
-                                                      hmac=hmac,
-                                                      iv=iv,
-                                                      stats=stats,
-                                                      progress=progress)
-
-                if sig:
-                    sig.seek(0)
-                    message = {
-                        "message" : "SIG",
-                        "checksum": checksum
-                    }
-                    sendMessage(message)
-                    #batchMessage(message, batch=False, flush=True, response=False)
-                    (sigsize, _, _) = Util.sendData(conn, sig, chunksize=args.chunksize, stats=stats, progress=progress)            # Don't bother to encrypt the signature
-            except Exception as e:
-                logger.error("Caught exception during sending of data in %s: %s", pathname, e)
-                exceptionLogger.log(e)
-                raise e
-            finally:
-                if data is not None:
-                    data.close()
+                    (size, checksum, sig) = Util.sendData(stream.sender, data,
+                                                          encrypt, pad, hasher=Util.getHash(crypt, args.crypt),
+                                                          chunksize=args.chunksize,
+                                                          compress=compress,
+                                                          signature=makeSig,
+                                                          hmac=hmac,
+                                                          iv=iv,
+                                                          stats=sendStats,
+                                                          progress=progress,
+                                                          info=compInfo)
+                    sigsize = 0
+                    if sig:
+                        sig.seek(0)
+                        sigmessage = {
+                            "message" : "SIG",
+                            "checksum": checksum
+                        }
+                        stream.send(sigmessage)
+                        (sigsize, _, _) = Util.sendData(stream.sender, sig, chunksize=args.chunksize, stats=sendStats, progress=progress)            # Don't bother to encrypt the signature
+                    return (size, checksum, sig, sigsize)
+                except Exception as e:
+                    logger.error("Caught exception during sending of data in %s: %s", pathname, e)
+                    exceptionLogger.log(e)
+                    raise e
+
+            def finish(size, checksum, sig, sigsize):
+                data.close()
+                if compress:
+                    compressibility.record(pathname, size, compInfo['compsize'])
+                if fileState:
+                    sigdata = None
+                    if sig:
+                        sig.seek(0)
+                        sigdata = sig.read()
+                    fileState.setState(fileInfo, checksum, sigdata)
                 if sig is not None:
                     sig.close()
 
-            Util.accumulateStat(stats, 'new')
-            if args.report:
-                repInfo = { 'type': reportType, 'size': size, 'sigsize': sigsize }
-                report[os.path.split(pathname)] = repInfo
-            logger.debug("Completed %s -- Checksum %s -- %s bytes, %s signature bytes", Util.shortPath(pathname), checksum, size, sigsize)
+                Util.accumulateStat(stats, 'new')
+                if args.report:
+                    repInfo = { 'type': reportType, 'size': size, 'sigsize': sigsize }
+                    report[os.path.split(pathname)] = repInfo
+                logger.debug("Completed %s -- Checksum %s -- %s bytes, %s signature bytes", Util.shortPath(pathname), checksum, size, sigsize)
+
+            transfer(send, finish, pathname)
     else:
         logger.debug("Unknown inode {} -- Probably linked".format(inode))
 
+def chunkable(inode):
+    """ Should this file be stored as content defined chunks """
+    if args.chunkfiles and inode in inodeDB:
+        (fileInfo, _) = inodeDB[inode]
+        return stat.S_ISREG(fileInfo['mode']) and fileInfo['size'] >= args.chunkfiles
+    return False
+
+def sendChunks(inode, reportType, data, compress):
+    """ Send a file as a list of content defined chunks.  The file is read twice, once to find and checksum the chunks,
+        and then again to send the ones the server doesn't already have. """
+    (fileInfo, pathname) = inodeDB[inode]
+    hasher = Util.getHash(crypt, args.crypt)
+    chunks = []
+    offsets = []
+    offset = 0
+    try:
+        for chunk in Chunker.chunks(data, minSize=args.chunkavg / 4, avgSize=args.chunkavg, maxSize=args.chunkavg * 4):
+            hasher.update(chunk)
+            h = Util.getHash(crypt, args.crypt)
+            h.update(chunk)
+            chunks.append(h.hexdigest())
+            offsets.append((offset, len(chunk)))
+            offset += len(chunk)
+        checksum = hasher.hexdigest()
+
+        message = {
+            "message":  "CHUNKQ",
+            "checksum": checksum,
+            "chunks":   chunks
+        }
+        setMessageID(message)
+        response = sendAndReceive(message)
+        checkMessage(response, "ACKCHUNKQ")
+        needed = response['needed']
+
+        size = 0
+        progress = printProgress if args.progress else None
+        for i in needed:
+            (encrypt, pad, iv, hmac) = makeEncryptor()
+            (start, length) = offsets[i]
+            data.seek(start)
+            sendMessage({
+                "message":   "CHUNK",
+                "encoding":  encoding,
+                "encrypted": (iv is not None)
+            })
+            (sent, cks, _) = Util.sendData(conn.sender, cStringIO.StringIO(data.read(length)),
+                                           encrypt, pad, hasher=Util.getHash(crypt, args.crypt),
+                                           chunksize=args.chunksize,
+                                           compress=compress,
+                                           hmac=hmac,
+                                           iv=iv,
+                                           stats=stats,
+                                           progress=progress)
+            size += sent
+            if cks != chunks[i]:
+                logger.warning("%s changed while being sent.  Not backed up", pathname)
+                Util.accumulateStat(stats, 'gone')
+                return
+
+        sendMessage({
+            "message":   "CHUNKS",
+            "inode":     inode,
+            "checksum":  checksum,
+            "size":      offset,
+            "chunks":    chunks,
+            "encrypted": bool(args.crypt and crypt)
+        })
+    except Exception as e:
+        logger.error("Caught exception during sending of chunks in %s: %s", pathname, e)
+        exceptionLogger.log(e)
+        raise e
+    finally:
+        data.close()
+
+    if fileState:
+        fileState.setState(fileInfo, checksum)
+    Util.accumulateStat(stats, 'new')
+    if args.report:
+        repInfo = { 'type': reportType, 'size': size, 'sigsize': 0 }
+        report[os.path.split(pathname)] = repInfo
+    logger.debug("Completed %s -- Checksum %s -- %d of %d chunks, %s bytes", Util.shortPath(pathname), checksum, len(needed), len(chunks), size)
+
 def handleAckMeta(message):
     checkMessage(message, 'ACKMETA')
     content = message.setdefault('content', {})
@@ -702,6 +993,10 @@ def handleAckDir(message):
     for i in [tuple(x) for x in done]:
         delInode(i)
 
+    # Remember the basis the server will use for each delta, so we can use a local signature if we have one.
+    for (inode, dev, basis) in message.get("basis", []):
+        deltaBases[(inode, dev)] = basis
+
     allContent += content
     allDelta   += delta
     allCkSum   += cksum
@@ -710,68 +1005,99 @@ def handleAckDir(message):
 def pushFiles():
     global allContent, allDelta, allCkSum, allRefresh
     logger.debug("Pushing files")
+    # Take the current lists, and clear them out.  Handling responses (directly, or while draining pipelined
+    # responses ahead of a synchronous request) can reenter here, and should only see new requests.
+    (content, delta, cksum, refresh) = (allContent, allDelta, allCkSum, allRefresh)
+    allContent = []
+    allDelta   = []
+    allCkSum   = []
+    allRefresh = []
+
     # If checksum content in NOT specified, send the data for each file
-    for i in [tuple(x) for x in allContent]:
+    for i in [tuple(x) for x in content]:
         if args.ckscontent and cksize(i, args.ckscontent):
-            allCkSum.append(i)
+            cksum.append(i)
         else:
             if logger.isEnabledFor(logging.FILES):
                 logFileInfo(i, 'N')
             sendContent(i, 'New')
             delInode(i)
 
-    for i in [tuple(x) for x in allRefresh]:
+    for i in [tuple(x) for x in refresh]:
         if logger.isEnabledFor(logging.FILES):
             logFileInfo(i, 'N')
         sendContent(i, 'Full')
         delInode(i)
 
+    # Chunked files are always sent as content.  Only the chunks which have changed will actually be sent.
+    if args.chunkfiles:
+        chunked = set(tuple(x) for x in delta if chunkable(tuple(x)))
+        delta = [x for x in delta if tuple(x) not in chunked]
+        for i in chunked:
+            if logger.isEnabledFor(logging.FILES):
+                logFileInfo(i, 'N')
+            sendContent(i, 'Full')
+            delInode(i)
+
     # If there are any delta files requested, ask for them
     signatures = None
-    if not args.full and len(allDelta) != 0:
-        signatures = prefetchSigFiles(allDelta)
+    if not args.full and len(delta) != 0:
+        signatures = localSigFiles(delta)
+        remaining = [i for i in delta if tuple(i) not in signatures]
+        if remaining:
+            signatures.update(prefetchSigFiles(remaining))
 
-    for i in [tuple(x) for x in allDelta]:
+    # If there's a delta pool, keep a few deltas being generated ahead of the one being sent.
+    started = collections.deque()
+    for i in [tuple(x) for x in delta]:
+        if deltaPool and not args.full:
+            started.append((i, startDelta(i, signatures)))
+            if len(started) > args.deltathreads * 2:
+                (inode, pending) = started.popleft()
+                finishDelta(inode, signatures, pending)
+            continue
         # If doing a full backup, send the full file, else just a delta.
         if args.full:
             if logger.isEnabledFor(logging.FILES):
                 logFileInfo(i, 'N')
             sendContent(i, 'Full')
+            delInode(i)
         else:
-            if logger.isEnabledFor(logging.FILES):
-                if i in inodeDB:
-                    (x, name) = inodeDB[i]
-                    logger.log(logging.FILES, "[D]: %s", Util.shortPath(name))
-            processDelta(i, signatures)
-        delInode(i)
+            finishDelta(i, signatures)
+    while started:
+        (inode, pending) = started.popleft()
+        finishDelta(inode, signatures, pending)
 
     # If checksum content is specified, concatenate the checksums and content requests, and handle checksums
     # for all of them.
-    if len(allCkSum) > 0:
-        processChecksums([tuple(x) for x in allCkSum])
-
-    # Clear out the files
-    allContent = []
-    allDelta   = []
-    allCkSum   = []
-    allRefresh = []
+    if len(cksum) > 0:
+        processChecksums([tuple(x) for x in cksum])
 
     #if message['last']:
     #    sendDirHash(message['inode'])
 
+def finishDelta(inode, signatures, pending=None):
+    if logger.isEnabledFor(logging.FILES):
+        if inode in inodeDB:
+            (x, name) = inodeDB[inode]
+            logger.log(logging.FILES, "[D]: %s", Util.shortPath(name))
+    processDelta(inode, signatures, pending)
+    delInode(inode)
+
 def addMeta(meta):
     """
     Add data to the metadata cache
     """
-    if meta in metaCache:
-        return metaCache[meta]
-    else:
-        m = Util.getHash(crypt, args.crypt)
-        m.update(meta)
-        digest = m.hexdigest()
-        metaCache[meta] = digest
-        newmeta.append(digest)
-        return digest
+    with scanLock:
+        if meta in metaCache:
+            return metaCache[meta]
+        else:
+            m = Util.getHash(crypt, args.crypt)
+            m.update(meta)
+            digest = m.hexdigest()
+            metaCache[meta] = digest
+            newmeta.append(digest)
+            return digest
 
 def mkFileInfo(dir, name):
     pathname = os.path.join(dir, name)
@@ -832,7 +1158,8 @@ def getDirContents(dir, dirstat, excludes=[]):
         of the files, a list of sub directories, and the new list of excluded patterns """
 
     #logger.debug("Processing directory : %s", dir)
-    Util.accumulateStat(stats, 'dirs')
+    # Count locally, and add into the global stats at the end.  May be running in a scanner thread.
+    counts = { 'dirs': 1, 'links': 0, 'files': 0, 'backed': 0 }
     device = dirstat.st_dev
 
     # Process an exclude file which will be passed on down to the receivers
@@ -854,10 +1181,10 @@ def getDirContents(dir, dirstat, excludes=[]):
                 if fInfo and (args.crossdev or device == fInfo['dev']):
                     mode = fInfo["mode"]
                     if stat.S_ISLNK(mode):
-                        Util.accumulateStat(stats, 'links')
+                        counts['links'] += 1
                     elif stat.S_ISREG(mode):
-                        Util.accumulateStat(stats, 'files')
-                        Util.accumulateStat(stats, 'backed', fInfo['size'])
+                        counts['files'] += 1
+                        counts['backed'] += fInfo['size']
 
                     if stat.S_ISDIR(mode):
                         sub = os.path.join(dir, f)
@@ -877,6 +1204,10 @@ def getDirContents(dir, dirstat, excludes=[]):
     except (IOError, OSError) as e:
         logger.error("Error reading directory %s: %s" ,dir, str(e))
 
+    with scanLock:
+        for (name, amount) in counts.iteritems():
+            Util.accumulateStat(stats, name, amount)
+
     return (files, subdirs, excludes)
 
 def handleAckClone(message):
@@ -942,6 +1273,22 @@ def flushClones():
 def sendBatchMsgs():
     global batchMsgs
     batchSize = len(batchMsgs)
+    if args.window:
+        # Pipelined.  Put the batch on the wire, and handle the response whenever it arrives.
+        if batchSize == 1:
+            message = batchMsgs[0]
+        else:
+            message = {
+                'message'  : 'BATCH',
+                'batchsize': batchSize,
+                'batch'    : batchMsgs
+            }
+            setMessageID(message)
+            logger.debug("BATCH %d pipelined. %s commands", message['msgid'], batchSize)
+        batchMsgs = []
+        sendPipelined(message)
+        return
+
     if batchSize == 1:
         # If there's only one, don't batch it up, just send it.
         response = sendAndReceive(batchMsgs[0])
@@ -1015,11 +1362,12 @@ def sendDirChunks(path, inode, files):
 
 def makeMetaMessage():
     global newmeta
-    message = {
-        'message': 'META',
-        'metadata': newmeta
-        }
-    newmeta = []
+    with scanLock:
+        message = {
+            'message': 'META',
+            'metadata': newmeta
+            }
+        newmeta = []
     return message
 
 _progressBarFormat = None
@@ -1069,6 +1417,52 @@ def printProgress(header=None, name=None):
 
 processedDirs = set()
 
+def scanDir(dir, excludes):
+    """ Stat a directory, determine if it should be skipped, and if not, read its contents.
+        Returns the stat and the results of getDirContents, or None for the contents if the directory
+        is skipped, or None altogether if it's not a directory.  Can be run in a scanner thread. """
+    s = os.lstat(dir)
+    if not stat.S_ISDIR(s.st_mode):
+        return None
+
+    if dir in excludeDirs:
+        logger.debug("%s excluded.  Skipping", dir)
+        return (s, None)
+
+    if os.path.lexists(os.path.join(dir, args.skipfile)):
+        logger.debug("Skip file found.  Skipping %s", dir)
+        return (s, None)
+
+    if args.skipcaches and os.path.lexists(os.path.join(dir, 'CACHEDIR.TAG')):
+        logger.debug("CACHEDIR.TAG file found.  Analyzing")
+        try:
+            with file(os.path.join(dir, 'CACHEDIR.TAG'), 'r') as f:
+                line = f.readline()
+                if line.startswith('Signature: 8a477f597d28d172789f06886806bc55'):
+                    logger.debug("Valid CACHEDIR.TAG file found.  Skipping %s", dir)
+                    return (s, None)
+        except:
+            logger.warning("Could not read %s.  Backing up directory %s", os.path.join(dir, 'CACHEDIR.TAG'), dir)
+
+    return (s, getDirContents(dir, s, excludes))
+
+def prefetchDirs(dirs, excludes):
+    """ Queue up scans of directories we're going to visit shortly.  Bounded, so memory doesn't explode on wide trees """
+    if scanPool is None:
+        return
+    for dir in dirs:
+        if len(pendingScans) >= args.scanthreads * 64:
+            break
+        if dir not in pendingScans:
+            pendingScans[dir] = scanPool.apply_async(scanDir, (dir, excludes))
+
+def getScan(dir, excludes):
+    """ Get the results of scanDir, either from a prefetched scan, or by scanning it now """
+    result = pendingScans.pop(dir, None)
+    if result is not None:
+        return result.get()
+    return scanDir(dir, excludes)
+
 def recurseTree(dir, top, depth=0, excludes=[]):
     """ Process a directory, send any contents along, and then dive down into subdirectories and repeat. """
     global dirHashes
@@ -1077,9 +1471,10 @@ def recurseTree(dir, top, depth=0, excludes=[]):
     if depth > 0:
         newdepth = depth - 1
 
-    s = os.lstat(dir)
-    if not stat.S_ISDIR(s.st_mode):
+    scan = getScan(dir, excludes)
+    if scan is None:
         return
+    (s, contents) = scan
 
     if args.progress:
         printProgress("Dir:", dir)
@@ -1087,26 +1482,10 @@ def recurseTree(dir, top, depth=0, excludes=[]):
         # Mark that we've processed it before attempting to determine if we actually should
         processedDirs.add(dir)
 
-        if dir in excludeDirs:
-            logger.debug("%s excluded.  Skipping", dir)
+        if contents is None:
             return
 
-        if os.path.lexists(os.path.join(dir, args.skipfile)):
-            logger.debug("Skip file found.  Skipping %s", dir)
-            return
-
-        if args.skipcaches and os.path.lexists(os.path.join(dir, 'CACHEDIR.TAG')):
-            logger.debug("CACHEDIR.TAG file found.  Analyzing")
-            try:
-                with file(os.path.join(dir, 'CACHEDIR.TAG'), 'r') as f:
-                    line = f.readline()
-                    if line.startswith('Signature: 8a477f597d28d172789f06886806bc55'):
-                        logger.debug("Valid CACHEDIR.TAG file found.  Skipping %s", dir)
-                        return
-            except:
-                logger.warning("Could not read %s.  Backing up directory %s", os.path.join(dir, 'CACHEDIR.TAG'), dir)
-
-        (files, subdirs, subexcludes) = getDirContents(dir, s, excludes)
+        (files, subdirs, subexcludes) = contents
 
         h = Util.hashDir(crypt, files, args.crypt)
         #logger.debug("Dir: %s (%d, %d): Hash: %s Size: %d.", Util.shortPath(dir), s.st_ino, s.st_dev, h[0], h[1])
@@ -1156,9 +1535,11 @@ def recurseTree(dir, top, depth=0, excludes=[]):
         # Make sure we're not at maximum depth
         if depth != 1:
             # Purge out the lists.  Allow garbage collection to take place.  These can get largish.
-            files = oldFiles = newFiles = None
-            # Process the sub directories
-            for subdir in sorted(subdirs):
+            files = oldFiles = newFiles = contents = None
+            # Process the sub directories.  Start reading them in the background while we work through them in order.
+            subdirs = sorted(subdirs)
+            prefetchDirs(subdirs, subexcludes)
+            for subdir in subdirs:
                 recurseTree(subdir, top, newdepth, subexcludes)
 
     except (OSError) as e:
@@ -1275,8 +1656,42 @@ def receiveMessage():
 
 waittime = 0
 
+# Message ID's which have been sent pipelined, but whose responses haven't been handled yet.
+# The server processes messages, and responds, in the order received, so this is a simple FIFO.
+inFlight = collections.deque()
+
+def sendPipelined(message):
+    """ Send a message without waiting for the response.  If the window is full, handle the oldest response first """
+    sendMessage(message)
+    inFlight.append(message['msgid'])
+    while len(inFlight) > args.window:
+        receiveResponse()
+
+def receiveResponse():
+    """ Receive and process the response to the oldest in-flight message """
+    global waittime
+    msgId = inFlight.popleft()
+    s = time.time()
+    response = receiveMessage()
+    e = time.time()
+    waittime += e - s
+    if response.get('respid') != msgId:
+        logger.critical("Out of order response.  Expected response to %s, received %s (%s)", msgId, response.get('respid'), response.get('message'))
+        raise ProtocolError("Expected response to message {}, received {}".format(msgId, response.get('respid')))
+    handleResponse(response)
+
+def receiveResponses():
+    """ Drain all outstanding pipelined responses.  Return True if any were processed """
+    if not inFlight:
+        return False
+    while inFlight:
+        receiveResponse()
+    return True
+
 def sendAndReceive(message):
     global waittime
+    # Any pipelined responses are ahead of ours in the stream.  Get them out of the way first.
+    receiveResponses()
     s = time.time()
     sendMessage(message)
     response = receiveMessage()
@@ -1354,8 +1769,11 @@ def batchMessage(message, batch=True, flush=False, response=True):
         flushBatchMsgs()
     if not batch:
         if response:
-            respmessage = sendAndReceive(message)
-            handleResponse(respmessage)
+            if args.window:
+                sendPipelined(message)
+            else:
+                respmessage = sendAndReceive(message)
+                handleResponse(respmessage)
         else:
             sendMessage(message)
 
@@ -1503,7 +1921,7 @@ def doSrpAuthentication():
     
 
 def startBackup(name, priority, client, autoname, force, full=False, create=False, password=None, version=Tardis.__versionstring__):
-    global sessionid, clientId, lastTimestamp, backupName, newBackup, filenameKey, contentKey
+    global sessionid, clientId, lastTimestamp, backupName, newBackup, filenameKey, contentKey, dataToken
 
     # Create a BACKUP message
     message = {
@@ -1542,6 +1960,7 @@ def startBackup(name, priority, client, autoname, force, full=False, create=Fals
         filenameKey = resp['filenameKey']
     if 'contentKey' in resp:
         contentKey = resp['contentKey']
+    dataToken      = resp.get('datatoken')
 
 def getConnection(server, port):
     #if args.protocol == 'json':
@@ -1629,6 +2048,12 @@ def processCommandLine():
     parser.add_argument('--compress-data',  '-Z',   dest='compress', const='zlib', default=c.get(t, 'CompressData'), nargs='?', choices=CompressedBuffer.getCompressors(),
                         help='Compress files.  Default: %(default)s')
     parser.add_argument('--compress-min',           dest='mincompsize', type=int, default=c.getint(t, 'CompressMin'),   help='Minimum size to compress.  Default: %(default)d')
+    parser.add_argument('--zstd-level',             dest='zstdlevel', type=int, default=c.get(t, 'ZstdLevel'),
+                        help='Compression level when compressing data with zstd.  Default: %(default)s')
+    parser.add_argument('--zstd-threads',           dest='zstdthreads', type=int, default=c.getint(t, 'ZstdThreads'),
+                        help='Number of threads used when compressing data with zstd.  0 to compress in the sending thread.  Default: %(default)s')
+    parser.add_argument('--compress-stats',         dest='compressstats', default=c.get(t, 'CompressStats'),
+                        help='Database recording how well each type of file compresses, kept between runs.  Types which don\'t compress are skipped.  Default: %(default)s')
     parser.add_argument('--nocompress-types',       dest='nocompressfile', default=splitList(c.get(t, 'NoCompressFile')), action='append',
                         help='File containing a list of MIME types to not compress.  Default: %(default)s')
     parser.add_argument('--nocompress', '-z',       dest='nocompress', default=splitList(c.get(t, 'NoCompress')), action='append',
@@ -1672,17 +2097,25 @@ def processCommandLine():
                         help='Ignore the global exclude file')
 
     comgrp = parser.add_argument_group('Communications options', 'Options for specifying details about the communications protocol.')
-    comgrp.add_argument('--compress-msgs', '-C',    dest='compressmsgs', nargs='?', const='zlib', choices=['none', 'zlib', 'zlib-stream', 'snappy'], default=c.get(t, 'CompressMsgs'),
+    comgrp.add_argument('--compress-msgs', '-C',    dest='compressmsgs', nargs='?', const='zlib', choices=Messages.getCompressors(), default=c.get(t, 'CompressMsgs'),
                         help='Compress messages.  Default: %(default)s')
+    comgrp.add_argument('--state-db',               dest='statedb', default=c.get(t, 'StateDB'),
+                        help='Keep a local database of file checksums and signatures, to avoid rereading unchanged files and fetching signatures from the server.  Use a separate file for each server and client.  Default: %(default)s')
     comgrp.add_argument('--cks-content',            dest='ckscontent', default=c.getint(t, 'ChecksumContent'), type=int, nargs='?', const=4096,
                         help='Checksum files before sending.  Is the minimum size to checksum (smaller files automaticaly sent).  Can reduce run time if lots of duplicates are expected.  Default: %(default)s')
 
+    comgrp.add_argument('--chunk-files',            dest='chunkfiles', default=c.getint(t, 'ChunkFiles'), type=int, nargs='?', const=64*1024*1024,
+                        help='Store files at least this size as content defined chunks, so data shared between files, or between versions of a file, is only sent and stored once.  Chunking is done in pure Python, at roughly 5-10MB/s, so large values are recommended.  0 to disable.  Default: %(default)s')
+    comgrp.add_argument('--chunk-avg',              dest='chunkavg', type=int, default=1024*1024,      help=_d('Average size of content defined chunks.  Default: %(default)s'))
+
     comgrp.add_argument('--clones', '-L',           dest='clones', type=int, default=100,               help=_d('Maximum number of clones per chunk.  0 to disable cloning.  Default: %(default)s'))
     comgrp.add_argument('--minclones',              dest='clonethreshold', type=int, default=64,        help=_d('Minimum number of files to do a partial clone.  If less, will send directory as normal: %(default)s'))
     comgrp.add_argument('--batchdir', '-B',         dest='batchdirs', type=int, default=16,             help=_d('Maximum size of small dirs to send.  0 to disable batching.  Default: %(default)s'))
     comgrp.add_argument('--batchsize',              dest='batchsize', type=int, default=100,            help=_d('Maximum number of small dirs to batch together.  Default: %(default)s'))
     comgrp.add_argument('--chunksize',              dest='chunksize', type=int, default=256*1024,       help=_d('Chunk size for sending data.  Default: %(default)s'))
     comgrp.add_argument('--dirslice',               dest='dirslice', type=int, default=1000,            help=_d('Maximum number of directory entries per message.  Default: %(default)s'))
+    comgrp.add_argument('--window',                 dest='window', type=int, default=c.getint(t, 'Window'),
+                        help=_d('Maximum number of directory messages outstanding to the server before waiting for responses.  0 to disable pipelining.  Default: %(default)s'))
     #comgrp.add_argument('--protocol',               dest='protocol', default="msgp", choices=['json', 'bson', 'msgp'],
     #                    help=_d('Protocol for data transfer.  Default: %(default)s'))
     comgrp.add_argument('--signature',              dest='signature', default=c.getboolean(t, 'SendSig'), action=Util.StoreBoolean,
@@ -1710,6 +2143,12 @@ def processCommandLine():
     parser.add_argument('--verbose', '-v',      dest='verbose', action='count', default=c.getint(t, 'Verbosity'),
                         help='Increase the verbosity')
     parser.add_argument('--progress',           dest='progress', action='store_true',               help='Show a one-line progress bar.')
+    parser.add_argument('--scan-threads',       dest='scanthreads', type=int, default=c.getint(t, 'ScanThreads'),
+                        help='Number of threads used to read directories ahead of the backup.  0 to read directories inline.  Default: %(default)s')
+    parser.add_argument('--streams',            dest='streams', type=int, default=c.getint(t, 'Streams'),
+                        help='Number of extra connections to send file data on, in parallel with the main connection.  Default: %(default)s')
+    parser.add_argument('--delta-threads',      dest='deltathreads', type=int, default=c.getint(t, 'DeltaThreads'),
+                        help='Number of threads used to generate deltas.  0 to generate deltas inline.  Default: %(default)s')
 
     parser.add_argument('--exclusive',          dest='exclusive', action=Util.StoreBoolean, default=True, help='Make sure the client only runs one job at a time. Default: %(default)s')
     parser.add_argument('--exceptions',         dest='exceptions', default=False, action=Util.StoreBoolean, help='Log full exception details')
@@ -1877,6 +2316,16 @@ def printReport():
     else:
         logger.log(logging.STATS, "No files backed up")
 
+    ratios = compressibility.ratios() if compressibility else None
+    if ratios:
+        fmt = '%-12s %-8s %-10s %-10s %-6s'
+        logger.log(logging.STATS, "")
+        logger.log(logging.STATS, fmt, "Type", "Files", "Size", "Comp Size", "Ratio")
+        logger.log(logging.STATS, fmt, '-' * 12, '-' * 8, '-' * 10, '-' * 10, '-' * 6)
+        for t in sorted(ratios):
+            (files, orig, comp) = ratios[t]
+            logger.log(logging.STATS, fmt, t, files, Util.fmtSize(orig), Util.fmtSize(comp), "%.2f" % (float(comp) / orig))
+
 def lockRun(server, port, client):
     lockName = 'tardis_' + str(server) + '_' + str(port) + '_' + str(client)
 
@@ -1891,7 +2340,7 @@ def lockRun(server, port, client):
     return pidfile
 
 def main():
-    global starttime, args, config, conn, verbosity, crypt, noCompTypes, srpUsr
+    global starttime, args, config, conn, verbosity, crypt, noCompTypes, srpUsr, scanPool, deltaPool, fileState, compressibility
     # Read the command line arguments.
     try:
         commandLine = ' '.join(sys.argv) + '\n'
@@ -1962,6 +2411,10 @@ def main():
             noCompTypes = set(types)
             logger.debug("Types to ignore: %s", sorted(noCompTypes))
 
+            if args.compress == 'zstd':
+                CompressedBuffer.setZstdOptions(args.zstdlevel, args.zstdthreads)
+            compressibility = Compressibility.Compressibility(Util.fullPath(args.compressstats) if args.compressstats else None)
+
             # Calculate the base directories
             directories = list(itertools.chain.from_iterable(map(glob.glob, map(Util.fullPath, args.directories))))
             if args.basepath == 'common':
@@ -2045,6 +2498,14 @@ def main():
                     sys.exit(1)
                 crypt.setKeys(f, c)
 
+        # Open the saved state of the files, if requested.
+        if args.statedb:
+            try:
+                fileState = FileState.FileState(Util.fullPath(args.statedb), "{}:{}".format(clientId, bool(args.crypt and crypt)))
+            except Exception as e:
+                logger.warning("Unable to open file state database %s: %s", args.statedb, e)
+                exceptionLogger.log(e)
+
         # Send a command line
         clHash = Util.getHash(crypt, args.crypt)
         clHash.update(commandLine)
@@ -2079,6 +2540,20 @@ def main():
             }
             batchMessage(message)
 
+        # Start the directory scanners
+        if args.scanthreads > 0:
+            scanPool = multiprocessing.pool.ThreadPool(args.scanthreads)
+        # And the delta generators.  librsync and the hashers release the GIL, so threads can run in parallel
+        if args.deltathreads > 0:
+            deltaPool = multiprocessing.pool.ThreadPool(args.deltathreads)
+
+        # Open the data streams, if the server allows them
+        if args.streams > 0:
+            if dataToken:
+                openStreams(server, port)
+            else:
+                logger.warning("Server does not support data streams.  Sending all data on the main connection")
+
         # Now, do the actual work here.
         try:
             # Now, process all the actual directories
@@ -2101,8 +2576,12 @@ def main():
             if newmeta:
                 batchMessage(makeMetaMessage())
             flushClones()
-            while flushBatchMsgs():
+            # Handling responses can generate more messages, so loop until everything is both sent and acknowledged.
+            while flushBatchMsgs() or receiveResponses():
                 pass
+            # And make sure all the data has been sent
+            if streamThreads:
+                stopStreams()
 
             # Send a purge command, if requested.
             if args.purge:
@@ -2117,6 +2596,15 @@ def main():
         except Exception as e:
             logger.error("Caught exception: %s, %s", e.__class__.__name__, e)
             exceptionLogger.log(e)
+        finally:
+            if scanPool:
+                scanPool.terminate()
+            if deltaPool:
+                deltaPool.terminate()
+            if fileState:
+                fileState.close()
+            if compressibility:
+                compressibility.close()
 
         if args.progress:
             print ' ' +  _startOfLine + _ansiClearEol + _startOfLine,
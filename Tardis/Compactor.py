@@ -0,0 +1,202 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2016, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import os.path
+import time
+import logging
+import threading
+import tempfile
+import shutil
+
+import Tardis.TardisDB as TardisDB
+import Tardis.CacheDir as CacheDir
+import Tardis.Regenerator as Regenerator
+import Tardis.CompressedBuffer as CompressedBuffer
+import Tardis.Util as Util
+
+class Compactor(threading.Thread):
+    """
+    Background job which breaks up long delta chains.  Deltas which are at least chainLength long, and were added in backup
+    sets which ended at least age seconds ago, are regenerated and stored as full files, so restoring them no longer has to
+    apply every patch in the chain.  The deltas which depend on them are left alone, as the content they apply to hasn't
+    changed, but their chain lengths are reduced to match.
+
+    Only runs while there are no sessions active, as reported by idle(), and sleeps for delay seconds between files.
+    Each file is compacted with lock held, and idle() checked again under it, so if sessions take the same lock when
+    they start, none can start while a file is being replaced.
+    Encrypted deltas can't be regenerated without the client's keys, and are skipped.
+    """
+    def __init__(self, basedir, dbdir, dbname, idle, chainLength, age=7 * 86400, delay=1.0, interval=3600, packThreshold=0, user=None, group=None, lock=None):
+        super(Compactor, self).__init__(name="Compactor")
+        self.daemon = True
+        self.logger = logging.getLogger("Compactor")
+        self.basedir = basedir
+        self.dbdir = dbdir
+        self.dbname = dbname
+        self.idle = idle
+        self.chainLength = chainLength
+        self.age = age
+        self.delay = delay
+        self.interval = interval
+        self.packThreshold = packThreshold
+        self.user = user
+        self.group = group
+        self.lock = lock if lock else threading.Lock()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        self.logger.info("Compacting delta chains of length %d and longer", self.chainLength)
+        while not self.stopped.is_set():
+            if self.idle():
+                for client in sorted(os.listdir(self.dbdir)):
+                    if self.stopped.is_set() or not self.idle():
+                        break
+                    try:
+                        self.compactClient(client)
+                    except Exception as e:
+                        self.logger.error("Unable to compact %s: %s", client, e)
+                        self.logger.exception(e)
+                self.stopped.wait(self.interval)
+            else:
+                self.stopped.wait(60)
+
+    def compactClient(self, client):
+        dbfile = os.path.join(self.dbdir, client, self.dbname.format({'client': client}))
+        basedir = os.path.join(self.basedir, client)
+        if not os.path.exists(dbfile) or not os.path.isdir(basedir):
+            return 0
+
+        db = TardisDB.TardisDB(dbfile, backup=False)
+        try:
+            if db.needsAuthentication():
+                self.logger.debug("Skipping %s.  Requires a password", client)
+                return 0
+            cache = CacheDir.CacheDir(basedir, create=False, user=self.user, group=self.group)
+            cache.usePacks(db, self.packThreshold)
+            regenerator = Regenerator.Regenerator(cache, db)
+            tempdir = os.path.join(basedir, "tmp")
+            if not os.path.isdir(tempdir):
+                os.makedirs(tempdir)
+            self.recover(db, cache, tempdir)
+
+            count = 0
+            for info in db.listLongChains(self.chainLength, time.time() - self.age):
+                with self.lock:
+                    if self.stopped.is_set() or not self.idle():
+                        break
+                    # Compacting an earlier checksum may have shortened this one's chain
+                    info = db.getChecksumInfo(info['checksum'])
+                    if info['chainlength'] < self.chainLength:
+                        continue
+                    self.compact(db, cache, regenerator, tempdir, info)
+                count += 1
+                self.stopped.wait(self.delay)
+            if count:
+                self.logger.info("Compacted %d delta chains for %s", count, client)
+            return count
+        finally:
+            db.close()
+
+    def restore(self, cache, saved, checksum):
+        """ Put back the delta saved by compact(), after the database has rolled back to describe it """
+        if saved.endswith(".old"):
+            os.rename(saved, cache.path(checksum))
+        else:
+            if os.path.lexists(cache.path(checksum)):
+                os.remove(cache.path(checksum))
+            os.remove(saved)
+
+    def recover(self, db, cache, tempdir):
+        """ Clean up after any compaction which was interrupted, putting the delta back if it wasn't committed """
+        for name in os.listdir(tempdir):
+            if not name.startswith("compact-"):
+                continue
+            saved = os.path.join(tempdir, name)
+            (checksum, ext) = os.path.splitext(name[len("compact-"):])
+            if ext in (".old", ".packed"):
+                info = db.getChecksumInfo(checksum)
+                if info and info['basis'] is not None:
+                    self.logger.warning("Restoring delta %s after an interrupted compaction", checksum)
+                    self.restore(cache, saved, checksum)
+                    continue
+            os.remove(saved)
+
+    def compact(self, db, cache, regenerator, tempdir, info):
+        """ Replace a delta with the full file it generates """
+        checksum = info['checksum']
+        compress = info['compressed'] if info['compressed'] and str(info['compressed']).lower() != 'none' else 'none'
+        if compress not in CompressedBuffer.getCompressors():
+            compress = 'none'
+        self.logger.debug("Compacting %s: chain length %d", checksum, info['chainlength'])
+
+        data = regenerator.recoverChecksum(checksum)
+        (fd, tempName) = tempfile.mkstemp(dir=tempdir, prefix="compact-")
+        try:
+            stream = CompressedBuffer.CompressedBufferedReader(data, compressor=compress, indexBlock=1024 * 1024)
+            with os.fdopen(fd, "wb") as output:
+                shutil.copyfileobj(stream, output)
+            data.close()
+            compressed = compress if stream.isCompressed() else "None"
+            disksize = os.path.getsize(tempName)
+
+            db.updateChecksumFile(checksum, False, info['size'], compressed=compressed, disksize=disksize)
+            db.setBlockIndex(checksum, stream.blockIndex())
+            db.shortenChains(checksum, info['chainlength'])
+
+            # Keep the delta until the database has been committed, so it can be put back if that fails, or by recover()
+            # if we don't get that far.
+            path = cache.path(checksum)
+            if os.path.lexists(path):
+                saved = os.path.join(tempdir, "compact-" + checksum + ".old")
+                os.link(path, saved)
+            else:
+                # Packed.  The index will roll back to point to it, but the new file would be left behind.
+                saved = os.path.join(tempdir, "compact-" + checksum + ".packed")
+                open(saved, "wb").close()
+            try:
+                cache.insert(checksum, tempName)
+                db.commit()
+            except:
+                db.rollback()
+                self.restore(cache, saved, checksum)
+                raise
+            cache.removeSuperseded()
+            os.remove(saved)
+        except:
+            if os.path.exists(tempName):
+                os.remove(tempName)
+            raise
+
+        cache.remove(checksum + ".basis")
+        Util.recordMetaData(cache, checksum, info['size'], compressed, False, disksize, logger=self.logger)
@@ -35,6 +35,18 @@ import liblzma
 
 import Tardis.librsync as librsync
 
+try:
+    import zstandard
+    _supportZstd = True
+except ImportError:
+    _supportZstd = False
+
+try:
+    import lz4.frame
+    _supportLz4 = True
+except ImportError:
+    _supportLz4 = False
+
 _defaultChunksize = 1024 * 1024
 
 # Dummy class to just pass empty data through
@@ -49,7 +61,50 @@ class _NullCompressor(object):
     def flush(self):
         return None
 
+# Compression level and number of threads for zstd.  None and 0 are the library defaults (level 3, compress in the calling thread)
+_zstdLevel = None
+_zstdThreads = 0
+
+def setZstdOptions(level=None, threads=0):
+    global _zstdLevel, _zstdThreads
+    _zstdLevel = level
+    _zstdThreads = threads
+
+def _zstdCompressor():
+    level = _zstdLevel if _zstdLevel is not None else 3
+    return zstandard.ZstdCompressor(level=level, threads=_zstdThreads).compressobj()
+
+def _zstdDecompressor():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+# The lz4 frame compressor needs to be started before the first block, and the header sent along with it.
+class _Lz4Compressor(object):
+    def __init__(self):
+        self.compressor = lz4.frame.LZ4FrameCompressor()
+        self.started = False
+
+    def _begin(self):
+        if self.started:
+            return ''
+        self.started = True
+        return self.compressor.begin()
+
+    def compress(self, data):
+        header = self._begin()
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        header = self._begin()
+        return header + self.compressor.flush()
+
+def _lz4Decompressor():
+    return lz4.frame.LZ4FrameDecompressor()
+
 _compressors = { 'zlib': (zlib.compressobj, zlib.decompressobj), 'bzip': (bz2.BZ2Compressor, bz2.BZ2Decompressor), 'lzma': (liblzma.LZMACompressor, liblzma.LZMADecompressor), 'none': (_NullCompressor, _NullCompressor) }
+if _supportZstd:
+    _compressors['zstd'] = (_zstdCompressor, _zstdDecompressor)
+if _supportLz4:
+    _compressors['lz4'] = (_Lz4Compressor, _lz4Decompressor)
 
 # Pick a selected compressor or decompressor
 def _updateAlg(alg):
@@ -77,6 +132,7 @@ class BufferedReader(object):
         self.chunksize = chunksize
         self.numbytes = 0
         self.buffer = ""
+        self.offset = 0
         self.hasher = hasher
         self.sig = librsync.SignatureJob() if signature else None
 
@@ -94,30 +150,53 @@ class BufferedReader(object):
         return buf
 
     def read(self, size=0x7fffffff):
-        #avail = 0
-        #if self.buffer:
-        #    avail = len(self.buffer)
-        #print "read called: {}  {} bytes available".format(size, avail)
-        out = ""
+        # Collect the pieces and join them once, rather than slicing the buffer down on every read
+        out = []
         left = size
-        while len(out) < size:
-            #print "read loop: so far: {}".format(len(out))
-            if (not self.buffer) or (len(self.buffer) == 0):
-                #print "Calling _get"
-                self.buffer = self._get()
-                #print "Back from _get"
+        while left > 0:
+            if self.offset >= len(self.buffer):
+                self.buffer = self._get() or ""
+                self.offset = 0
+                if not self.buffer:
+                    break
+            if self.offset == 0 and len(self.buffer) <= left:
+                # Taking the whole buffer, just hand it back without copying
+                chunk = self.buffer
+            else:
+                chunk = self.buffer[self.offset:self.offset + left]
+            out.append(chunk)
+            self.offset += len(chunk)
+            left -= len(chunk)
+
+        if len(out) == 1:
+            return out[0]
+        return "".join(out)
+
+    def readline(self):
+        out = []
+        while True:
+            if self.offset >= len(self.buffer):
+                self.buffer = self._get() or ""
+                self.offset = 0
                 if not self.buffer:
-                    #print "_get return None, leaving read: {}".format(len(out))
-                    return out
-                #print "_get returned {} bytes".format(len(self.buffer))
-            amount = min(left, len(self.buffer))
-            #print "Adding {} bytes to output".format(amount)
-            out = out + self.buffer[:amount]
-            self.buffer = self.buffer[amount:]
-            left -= amount
-
-        #print "leaving read: {}".format(len(out))
-        return out
+                    break
+            end = self.buffer.find("\n", self.offset)
+            if end == -1:
+                out.append(self.buffer[self.offset:])
+                self.offset = len(self.buffer)
+            else:
+                out.append(self.buffer[self.offset:end + 1])
+                self.offset = end + 1
+                break
+        return "".join(out)
+
+    def readlines(self):
+        return list(iter(self.readline, ""))
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
 
     def checksum(self):
         return self.hasher.hexdigest() if self.hasher else None
@@ -134,8 +213,16 @@ class BufferedReader(object):
     def isCompressed(self):
         return False
 
+    def blockIndex(self):
+        return None
+
 class CompressedBufferedReader(BufferedReader):
-    def __init__(self, stream, chunksize=_defaultChunksize, hasher=None, threshold=0.80, signature=False, compressor='zlib'):
+    """
+    Compress a stream as it's read.  If indexBlock is set, and the compressor is zlib, the compressor is fully flushed
+    after roughly every indexBlock bytes of input, and the [uncompressed, compressed] offsets recorded in blockIndex().
+    Decompression can start at any of those points, with a raw deflate decompressor, without reading what came before.
+    """
+    def __init__(self, stream, chunksize=_defaultChunksize, hasher=None, threshold=0.80, signature=False, compressor='zlib', indexBlock=0):
         super(CompressedBufferedReader, self).__init__(stream, chunksize=chunksize, hasher=hasher, signature=signature)
         self.compressor = None
         self.compressed = 0
@@ -144,11 +231,14 @@ class CompressedBufferedReader(BufferedReader):
         self.flushed = False
         self.threshold = threshold
         self.compressor = getCompressor(compressor)
+        self.indexBlock = indexBlock if _updateAlg(compressor) == 'zlib' else 0
+        self.index = []
+        self.sinceFlush = 0
 
     def _get(self):
         #print "_get called"
         ret = ''
-        uncomp = ''
+        uncomp = []
         if self.stream:
             while not ret:
                 buf = self.stream.read(self.chunksize)
@@ -158,7 +248,7 @@ class CompressedBufferedReader(BufferedReader):
                 if self.sig:
                     self.sig.step(buf)
                 if self.first and buf:
-                    uncomp = uncomp + buf
+                    uncomp.append(buf)
                 if self.compressor:
                     if not buf:
                         #print "_get: Done"
@@ -168,6 +258,12 @@ class CompressedBufferedReader(BufferedReader):
                     else:
                         #print "_get: {} bytes read".format(len(buf))
                         ret = ret + self.compressor.compress(buf)
+                        if self.indexBlock:
+                            self.sinceFlush += len(buf)
+                            if self.sinceFlush >= self.indexBlock:
+                                ret = ret + self.compressor.flush(zlib.Z_FULL_FLUSH)
+                                self.index.append([self.uncompressed, self.compressed + len(ret)])
+                                self.sinceFlush = 0
                 else:
                     ret = buf
                     break       # Make sure we don't got around the loop at the EOF
@@ -182,8 +278,9 @@ class CompressedBufferedReader(BufferedReader):
                     ratio = float(len(ret)) / float(self.uncompressed)
                     #print "Initial ratio: {} {} {}".format(ratio, len(ret), len(buf))
                     if ratio > self.threshold:
-                        ret = uncomp
+                        ret = "".join(uncomp)
                         self.compressor = None
+                        self.index = []
             self.compressed += len(ret)
             return ret
             # End if self.stream
@@ -204,6 +301,9 @@ class CompressedBufferedReader(BufferedReader):
     def isCompressed(self):
         return self.compressor != None
 
+    def blockIndex(self):
+        return self.index if (self.index and self.isCompressed()) else None
+
 class UncompressedBufferedReader(BufferedReader):
     def __init__(self, stream, chunksize=_defaultChunksize, compressor='zlib'):
         super(UncompressedBufferedReader, self).__init__(stream, chunksize=chunksize)
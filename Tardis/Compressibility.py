@@ -0,0 +1,108 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2016, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import sqlite3
+import logging
+import os.path
+
+_schema = """
+CREATE TABLE IF NOT EXISTS Compressibility (
+    Type        TEXT PRIMARY KEY,
+    Files       INTEGER NOT NULL,
+    Original    INTEGER NOT NULL,
+    Compressed  INTEGER NOT NULL
+);
+"""
+
+class Compressibility(object):
+    """
+    A table of how well each type of file, keyed by extension, has compressed.  Once enough files of a type have been
+    seen, and they don't compress to less than the threshold, compression isn't attempted on files of that type.  Every
+    probe'th file of such a type is still compressed, so the table can learn if it was wrong.
+
+    If a path is given, the table is kept in a database there, and carried from one run to the next.  Results from just
+    this run are kept separately, for reporting.
+    """
+    def __init__(self, path=None, minFiles=8, threshold=0.9, probe=64):
+        self.logger = logging.getLogger("Compressibility")
+        self.minFiles = minFiles
+        self.threshold = threshold
+        self.probe = probe
+        self.types = {}
+        self.run = {}
+        self.skipped = {}
+        self.conn = None
+
+        if path:
+            self.conn = sqlite3.connect(os.path.abspath(path))
+            self.conn.text_factory = str
+            self.conn.executescript(_schema)
+            for (t, files, orig, comp) in self.conn.execute("SELECT Type, Files, Original, Compressed FROM Compressibility"):
+                self.types[t] = [files, orig, comp]
+            self.logger.debug("Loaded compressibility of %d types from %s", len(self.types), path)
+
+    def fileType(self, pathname):
+        """ Return the type of a file, for the purposes of this table.  None if it has no extension """
+        ext = os.path.splitext(pathname)[1].lower()
+        return ext if ext else None
+
+    def shouldCompress(self, pathname):
+        """ Determine if compressing a file is worth trying, based on what's been seen of its type so far """
+        t = self.fileType(pathname)
+        if t is None or t not in self.types:
+            return True
+        (files, orig, comp) = self.types[t]
+        if files < self.minFiles or orig == 0 or float(comp) / orig < self.threshold:
+            return True
+        self.skipped[t] = self.skipped.get(t, 0) + 1
+        return (self.skipped[t] % self.probe) == 0
+
+    def record(self, pathname, original, compressed):
+        """ Record the results of compressing a file.  An incompressible file can be recorded with compressed == original """
+        t = self.fileType(pathname)
+        if t is None or original == 0:
+            return
+        for table in (self.types, self.run):
+            entry = table.setdefault(t, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += original
+            entry[2] += compressed
+
+    def ratios(self):
+        """ Return a dictionary of type -> (files, original size, compressed size) for the files seen in this run """
+        return { t: tuple(v) for (t, v) in self.run.items() }
+
+    def close(self):
+        if self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO Compressibility (Type, Files, Original, Compressed) VALUES (?, ?, ?, ?)",
+                                  [(t, v[0], v[1], v[2]) for (t, v) in self.types.items()])
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
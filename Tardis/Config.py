@@ -47,6 +47,9 @@ configDefaults = {
     'KeyFile':              None,
     'LogFiles':             None,
     'Verbosity':            str(0),
+    'RegenCache':           Defaults.getDefault('TARDIS_REGEN_CACHE'),
+    'RegenCacheSize':       Defaults.getDefault('TARDIS_REGEN_CACHE_SIZE'),
+    'RegenCacheEncrypted':  Defaults.getDefault('TARDIS_REGEN_CACHE_ENCRYPTED'),
     'Schema':				Defaults.getDefault('TARDIS_SCHEMA')
 }
 
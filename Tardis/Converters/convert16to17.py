@@ -0,0 +1,36 @@
+import sqlite3
+import sys
+import os.path
+import logging
+
+import convertutils
+
+version = 16
+
+def upgrade(conn, logger):
+    convertutils.checkVersion(conn, version, logger)
+
+    conn.execute("ALTER TABLE CheckSums ADD COLUMN Chunked INTEGER DEFAULT 0")
+    conn.execute("CREATE TABLE IF NOT EXISTS ChunkMaps ("
+                 "    ChecksumId  INTEGER NOT NULL,"
+                 "    Sequence    INTEGER NOT NULL,"
+                 "    ChunkId     INTEGER NOT NULL,"
+                 "    PRIMARY KEY(ChecksumId, Sequence),"
+                 "    FOREIGN KEY(ChecksumId) REFERENCES CheckSums(ChecksumId),"
+                 "    FOREIGN KEY(ChunkId)    REFERENCES CheckSums(ChecksumId))")
+    conn.execute("CREATE INDEX IF NOT EXISTS ChunkIndex ON ChunkMaps(ChunkId)")
+
+    convertutils.updateVersion(conn, version, logger)
+    conn.commit()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger('')
+
+    if len(sys.argv) > 1:
+        db = sys.argv[1]
+    else:
+        db = "tardis.db"
+
+    conn = sqlite3.connect(db)
+    upgrade(conn, logger)
@@ -0,0 +1,38 @@
+import sqlite3
+import sys
+import os.path
+import logging
+
+import convertutils
+
+version = 17
+
+def upgrade(conn, logger):
+    convertutils.checkVersion(conn, version, logger)
+
+    conn.execute("CREATE TABLE IF NOT EXISTS Packs ("
+                 "    PackId      INTEGER PRIMARY KEY AUTOINCREMENT,"
+                 "    Size        INTEGER DEFAULT 0,"
+                 "    Live        INTEGER DEFAULT 0)")
+    conn.execute("CREATE TABLE IF NOT EXISTS PackMembers ("
+                 "    Name        TEXT PRIMARY KEY,"
+                 "    PackId      INTEGER NOT NULL,"
+                 "    Offset      INTEGER NOT NULL,"
+                 "    Size        INTEGER NOT NULL,"
+                 "    FOREIGN KEY(PackId) REFERENCES Packs(PackId))")
+    conn.execute("CREATE INDEX IF NOT EXISTS PackMemberIndex ON PackMembers(PackId)")
+
+    convertutils.updateVersion(conn, version, logger)
+    conn.commit()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger('')
+
+    if len(sys.argv) > 1:
+        db = sys.argv[1]
+    else:
+        db = "tardis.db"
+
+    conn = sqlite3.connect(db)
+    upgrade(conn, logger)
@@ -0,0 +1,87 @@
+import sqlite3
+import sys
+import os.path
+import logging
+
+import convertutils
+
+version = 18
+
+_script = """
+CREATE INDEX IF NOT EXISTS BasisIndex ON CheckSums(Basis);
+CREATE INDEX IF NOT EXISTS FileChecksumIndex ON Files(ChecksumId);
+CREATE INDEX IF NOT EXISTS FileXattrIndex ON Files(XattrId);
+CREATE INDEX IF NOT EXISTS FileAclIndex ON Files(AclId);
+
+-- Checksums which may have lost their last reference, and so need to be checked for orphans.  Filled by the triggers
+-- below, so orphan removal only needs to look at what's changed since it last ran.
+CREATE TABLE IF NOT EXISTS OrphanCandidates (
+    ChecksumId  INTEGER PRIMARY KEY
+);
+
+CREATE TRIGGER IF NOT EXISTS CandidateNewChecksum AFTER INSERT ON CheckSums
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) VALUES (NEW.ChecksumId);
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateDeletedChecksum AFTER DELETE ON CheckSums
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT ChecksumId FROM CheckSums WHERE Checksum = OLD.Basis;
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateUpdatedChecksum AFTER UPDATE OF Basis ON CheckSums WHEN OLD.Basis IS NOT NEW.Basis
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT ChecksumId FROM CheckSums WHERE Checksum = OLD.Basis;
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateDeletedFile AFTER DELETE ON Files
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT OLD.ChecksumId WHERE OLD.ChecksumId IS NOT NULL;
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT OLD.XattrId WHERE OLD.XattrId IS NOT NULL;
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT OLD.AclId WHERE OLD.AclId IS NOT NULL;
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateUpdatedFile AFTER UPDATE OF ChecksumId, XattrId, AclId ON Files
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT OLD.ChecksumId WHERE OLD.ChecksumId IS NOT NULL AND OLD.ChecksumId IS NOT NEW.ChecksumId;
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT OLD.XattrId WHERE OLD.XattrId IS NOT NULL AND OLD.XattrId IS NOT NEW.XattrId;
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT OLD.AclId WHERE OLD.AclId IS NOT NULL AND OLD.AclId IS NOT NEW.AclId;
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateDeletedBackup AFTER DELETE ON Backups WHEN OLD.CmdLineId IS NOT NULL
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) VALUES (OLD.CmdLineId);
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateUpdatedBackup AFTER UPDATE OF CmdLineId ON Backups WHEN OLD.CmdLineId IS NOT NULL AND OLD.CmdLineId IS NOT NEW.CmdLineId
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) VALUES (OLD.CmdLineId);
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateDeletedChunk AFTER DELETE ON ChunkMaps
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) VALUES (OLD.ChunkId);
+END;
+"""
+
+def upgrade(conn, logger):
+    convertutils.checkVersion(conn, version, logger)
+
+    conn.executescript(_script)
+    # Nothing is known about the existing checksums, so check them all the first time.
+    conn.execute("INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT ChecksumId FROM CheckSums")
+
+    convertutils.updateVersion(conn, version, logger)
+    conn.commit()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger('')
+
+    if len(sys.argv) > 1:
+        db = sys.argv[1]
+    else:
+        db = "tardis.db"
+
+    conn = sqlite3.connect(db)
+    upgrade(conn, logger)
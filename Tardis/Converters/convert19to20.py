@@ -0,0 +1,28 @@
+import sqlite3
+import sys
+import os.path
+import logging
+
+import convertutils
+
+version = 19
+
+def upgrade(conn, logger):
+    convertutils.checkVersion(conn, version, logger)
+
+    conn.execute("CREATE INDEX IF NOT EXISTS FirstSetIndex ON Files(FirstSet)")
+
+    convertutils.updateVersion(conn, version, logger)
+    conn.commit()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    logger = logging.getLogger('')
+
+    if len(sys.argv) > 1:
+        db = sys.argv[1]
+    else:
+        db = "tardis.db"
+
+    conn = sqlite3.connect(db)
+    upgrade(conn, logger)
@@ -49,6 +49,9 @@ import signal
 import threading
 import json
 import base64
+import collections
+import functools
+import hmac
 from datetime import datetime
 
 # For profiling
@@ -70,6 +73,8 @@ import Tardis.Defaults as Defaults
 import Tardis.Connection as Connection
 import Tardis.CompressedBuffer as CompressedBuffer
 import Tardis.librsync as librsync
+import Tardis.Compactor as Compactor
+import Tardis.RegenCache as RegenCache
 
 DONE    = 0
 CONTENT = 1
@@ -137,10 +142,17 @@ configDefaults = {
     'SaveFull'          : str(False),
     'SkipFileName'      : skipFile,
     'DBBackups'         : '3',
+    'PackThreshold'     : '0',
+    'CompactChain'      : '0',
+    'CompactAge'        : '7',
+    'CompactDelay'      : '1.0',
+    'RegenCache'        : None,
+    'RegenCacheSize'    : '1024',
     'AutoPurge'         : str(False),
     'SaveConfig'        : str(True),
     'AllowClientOverrides'  :  str(True),
     'AllowSchemaUpgrades'   :  str(False),
+    'DBPragmas'             :  TardisDB.defaultPragmas,
 }
 
 server = None
@@ -159,6 +171,10 @@ def makeDict(row):
         return d
     return None
 
+def _similarKey(f):
+    """ Key used to match files in the bulk similar file lookups """
+    return (f['inode'], f['dev'], f['mtime'], f['size'])
+
 class InitFailedException(Exception):
     pass
 
@@ -191,6 +207,10 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
     saveFull = False
     lastCompleted = None
     maxChain = 0
+    session = None
+    dataToken = None
+    dataPending = None
+    dataClosed = False
 
     def checkMessage(self, message, expected):
         """ Check that a message is of the expected type.  Throw an exception if not """
@@ -219,12 +239,169 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
         self.logger.info("Ending session %s from %s", self.sessionid, self.address)
         self.server.rmSession(self.sessionid)
 
-    def setXattrAcl(self, inode, device, xattr, acl):
+    # Data connections.  A client can open extra connections to carry file data (CON, DEL, and SIG messages) in parallel
+    # with the main connection.  The data is received into temporary files by the data connection's handler, and the
+    # results are queued to the main connection's handler, which stores them in the database between its own messages,
+    # so only the main handler ever touches the database.
+    def queueData(self, func, tempName):
+        """ Queue func to store the data received into tempName.  If the session has already ended, just throw it away. """
+        with self.dataLock:
+            if not self.dataClosed:
+                self.dataPending.append((func, tempName))
+                return
+        self.removeDataTemp(tempName)
+
+    def removeDataTemp(self, tempName):
+        try:
+            if os.path.exists(tempName):
+                os.remove(tempName)
+        except OSError as e:
+            self.logger.warning("Unable to remove %s: %s", tempName, e)
+
+    def applyData(self):
+        """ Store the results of any data received on the data connections """
+        while True:
+            with self.dataLock:
+                if not self.dataPending:
+                    return
+                (func, tempName) = self.dataPending.popleft()
+            self.db.beginTransaction()
+            try:
+                func()
+            except Exception as e:
+                self.logger.error("Unable to store data received on data connection: %s", str(e))
+                if self.server.exceptions:
+                    self.logger.exception(e)
+                self.db.rollback()
+                self.removeDataTemp(tempName)
+                continue
+            self.db.commit()
+            self.cache.removeSuperseded()
+
+    def attachData(self, token):
+        """ Attach a data connection presenting token.  Returns False if the token is wrong, or data connections have been closed """
+        with self.dataLock:
+            if self.dataToken is None or not hmac.compare_digest(token, self.dataToken):
+                return False
+            self.dataConns += 1
+            return True
+
+    def detachData(self):
+        with self.dataLock:
+            self.dataConns -= 1
+            self.dataLock.notify_all()
+
+    def waitData(self):
+        """ Stop accepting data connections, wait for the current ones to end, and store everything they've received """
+        with self.dataLock:
+            self.dataToken = None
+            while self.dataConns:
+                self.dataLock.wait()
+        self.applyData()
+
+    def discardData(self):
+        """ Stop accepting data connections, and throw away anything received but not stored.
+            Anything the connections still running receive is thrown away as it arrives. """
+        with self.dataLock:
+            self.dataToken = None
+            self.dataClosed = True
+            pending = list(self.dataPending)
+            self.dataPending.clear()
+        for (_, tempName) in pending:
+            self.removeDataTemp(tempName)
+
+    def dataTempFile(self):
+        tempName = os.path.join(self.tempdir, self.tempPrefix + str(self._sequenceNumber))
+        self._sequenceNumber += 1
+        return (tempName, file(tempName, 'w+b'))
+
+    def receiveDataContent(self, message):
+        """ Receive a content message on a data connection """
+        (tempName, output) = self.dataTempFile()
+        info = {}
+        received = Util.receiveData(self.messenger, output, info)
+        output.close()
+        self.session.queueData(functools.partial(self.session.storeContent, message, tempName, received, info), tempName)
+
+    def receiveDataDelta(self, message):
+        """ Receive a delta message on a data connection """
+        # Always receive into a temporary file.  Whether the checksum already exists is checked when it's stored, in the
+        # main thread, as the cache may need to look in the database.
+        (tempName, output) = self.dataTempFile()
+        received = Util.receiveData(self.messenger, output)
+        self.session.queueData(functools.partial(self.session.storeDataDelta, message, tempName, output, received), tempName)
+
+    def storeDataDelta(self, message, tempName, output, received):
+        """ Record a delta received on a data connection into tempName.  Either patch it into a full file, or move it into the cache """
+        if self.cache.exists(message["checksum"]):
+            self.logger.debug("Checksum file %s already exists", message["checksum"])
+            output.close()
+            os.remove(tempName)
+            output = None
+        savefull = False
+        if output:
+            savefull = self.deltaSaveFull(message)
+            if not savefull:
+                output.close()
+                self.cache.insert(message["checksum"], tempName)
+        self.storeDelta(message, output, savefull, received)
+        if savefull:
+            os.remove(tempName)
+
+    def receiveDataSignature(self, message):
+        """ Receive a signature message on a data connection """
+        (tempName, output) = self.dataTempFile()
+        Util.receiveData(self.messenger, output)
+        output.close()
+        self.session.queueData(functools.partial(self.session.storeDataSignature, message, tempName), tempName)
+
+    def storeDataSignature(self, message, tempName):
+        """ Move a signature received on a data connection into the cache, unless it's already there """
+        sigfile = message["checksum"] + ".sig"
+        if self.cache.exists(sigfile):
+            self.logger.debug("Signature file %s already exists", sigfile)
+            os.remove(tempName)
+        else:
+            self.cache.insert(sigfile, tempName)
+
+    def handleData(self, fields):
+        """ Handle a data connection, receiving data messages until the client says BYE """
+        session = self.server.getSession(fields.get('sessionid'))
+        token = str(fields.get('token', ''))
+        if session is None or not session.attachData(token):
+            self.sendMessage({"status": "FAIL", "error": "Unknown session"})
+            raise InitFailedException("Data connection for unknown session: {}".format(fields.get('sessionid')))
+
+        self.session    = session
+        self.client     = session.client
+        self.cache      = session.cache
+        self.tempdir    = session.tempdir
+        self.logger.info("Data connection for session %s", session.sessionid)
+
+        try:
+            self.sendMessage({"status": "OK"})
+            while True:
+                message = self.recvMessage()
+                messageType = message["message"]
+                if messageType == "BYE":
+                    break
+                elif messageType == "CON":
+                    self.receiveDataContent(message)
+                elif messageType == "DEL":
+                    self.receiveDataDelta(message)
+                elif messageType == "SIG":
+                    self.receiveDataSignature(message)
+                else:
+                    raise ProtocolError("Unexpected message on data connection: {}".format(messageType))
+        finally:
+            session.detachData()
+
+    def setXattrAcl(self, inode, device, xattr, acl, updates):
         self.logger.debug("Setting Xattr and ACL info: %d %s %s", inode, xattr, acl)
         if xattr:
-            self.db.setXattrs(inode, device, xattr)
+            updates['xattr'].append((inode, device, xattr))
         if acl:
-            self.db.setAcl(inode, device, acl)
+            updates['acl'].append((inode, device, acl))
 
     def sendMessage(self, message):
         if self.printMessages:
@@ -237,9 +414,11 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
             self.logger.log(logging.TRACE, "Received:\n" + str(pp.pformat(message)).encode("utf-8"))
         return message
 
-    def checkFile(self, parent, f, dirhash):
+    def checkFile(self, parent, f, dirhash, lookups, updates):
         """
         Process an individual file.  Check to see if it's different from what's there already
+        Database lookups are taken from lookups, which were done in bulk for the whole directory, and any changes
+        are queued into updates, to be applied in bulk by applyUpdates.
         """
         xattr = None
         acl = None
@@ -255,34 +434,24 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
         #self.logger.debug("Processing Inode: %8d %d -- File: %s -- Parent: %s", inode, device, name, str(parent))
         #self.logger.debug("DirHash: %s", str(dirhash))
 
-        if name in dirhash:
-            old = dirhash[name]
-        else:
-            old = None
-        fromPartial = False
+        old = self.findOld(f, dirhash, lookups)
+        fromPartial = old['lastset'] if (old and old is lookups['partial'].get(_similarKey(f))) else False
 
         if f["dir"] == 1:
             #self.logger.debug("Is a directory: %s", name)
             if old:
                 if (old["inode"] == inode) and (old["device"] == device) and (old["mtime"] == f["mtime"]):
-                    self.db.extendFileInode(parent, (inode, device))
+                    updates['extend'].append((inode, device, False))
                 else:
-                    self.db.insertFile(f, parent)
-                    self.setXattrAcl(inode, device, xattr, acl)
+                    updates['insert'].append(f)
+                    self.setXattrAcl(inode, device, xattr, acl, updates)
             else:
-                self.db.insertFile(f, parent)
-                self.setXattrAcl(inode, device, xattr, acl)
+                updates['insert'].append(f)
+                self.setXattrAcl(inode, device, xattr, acl, updates)
             retVal = DONE
         else:       # Not a directory, it's a file
-            # Check to see if there's an updated version.
-            if not self.lastCompleted:
-                # not in this directory, but lets look further in any incomplete sets if there are any
-                #self.logger.debug("Looking up file in partial backup(s): %s (%s)", name, inode)
-                tmp = self.db.getFileFromPartialBackup(f)
-                if tmp:
-                    old = tmp
-                    fromPartial = old['lastset']
-                    self.logger.debug("Found %s in partial backup set: %d", name, old['lastset'])
+            if fromPartial:
+                self.logger.debug("Found %s in partial backup set: %d", name, fromPartial)
             if old:
                 #self.logger.debug("Comparing version:  New: %s", str(f))
                 #self.logger.debug("Comparing version:  Old: %s", str(makeDict(old)))
@@ -295,17 +464,18 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
                     #self.logger.debug("Main info matches: %s", name)
                     #if ("checksum" in old.keys()) and not (old["checksum"] is None):
                     if not old["checksum"] is None:
-                        #self.db.setChecksum(inode, device, old['checksum'])
                         if (old['mode'] == f['mode']) and (old['ctime'] == f['ctime']) and (old['xattrs'] == xattr) and (old['acl'] == acl):
                             # nothing has changed, just extend it
                             #self.logger.debug("Extending %s", name)
-                            self.db.extendFileInode(parent, (inode, device), old=fromPartial)
+                            updates['extend'].append((inode, device, fromPartial))
                         else:
                             # Some metadata has changed, so let's insert the new record, and set it's checksum
                             #self.logger.debug("Inserting new version %s", name)
-                            self.db.insertFile(f, parent)
-                            self.db.setChecksum(inode, device, old['checksum'])
-                            self.setXattrAcl(inode, device, xattr, acl)
+                            updates['insert'].append(f)
+                            updates['checksum'].append((inode, device, old['checksum']))
+                            self.setXattrAcl(inode, device, xattr, acl, updates)
+                        # Either way, this inode now has a checksum in the current set.
+                        updates['linked'][(inode, device)] = old['checksum']
                         if self.full and old['chainlength'] != 0:
                             retVal = REFRESH
                         else:
@@ -313,15 +483,15 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
                     else:
                         # Otherwise we need a whole new file
                         #self.logger.debug("No checksum: Get new file %s", name)
-                        self.db.insertFile(f, parent)
-                        self.setXattrAcl(inode, device, xattr, acl)
+                        updates['insert'].append(f)
+                        self.setXattrAcl(inode, device, xattr, acl, updates)
                         retVal = CONTENT
                 #elif (osize == fsize) and ("checksum" in old.keys()) and not (old["checksum"] is None):
                 elif (osize == fsize) and (not old["checksum"] is None):
                     #self.logger.debug("Secondary match, requesting checksum: %s", name)
                     # Size hasn't changed, but something else has.  Ask for a checksum
-                    self.db.insertFile(f, parent)
-                    self.setXattrAcl(inode, device, xattr, acl)
+                    updates['insert'].append(f)
+                    self.setXattrAcl(inode, device, xattr, acl, updates)
                     retVal = CKSUM
                 elif (f["size"] < 4096) or (old["size"] is None) or \
                      not ((old['size'] * self.deltaPercent) < f['size'] < (old['size'] * (1.0 + self.deltaPercent))) or \
@@ -332,32 +502,37 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
                     # Old file had now size
                     # File has changed size by more than a certain amount (typically 50%)
                     # Chain of delta's is too long.
-                    self.db.insertFile(f, parent)
-                    self.setXattrAcl(inode, device, xattr, acl)
+                    updates['insert'].append(f)
+                    self.setXattrAcl(inode, device, xattr, acl, updates)
                     retVal = REFRESH
                 else:
                     # Otherwise, let's just get the delta
                     #self.logger.debug("Fourth case.  Should be a delta: %s", name)
-                    self.db.insertFile(f, parent)
-                    self.setXattrAcl(inode, device, xattr, acl)
+                    updates['insert'].append(f)
+                    self.setXattrAcl(inode, device, xattr, acl, updates)
                     if self.full:
                         # Full backup, request the full version anyhow.
                         retVal = CONTENT
                     else:
                         retVal = DELTA
+                        # Tell the client what the delta will be against, in case it has the signature already.
+                        if old['checksum'] is not None:
+                            updates['basis'][(inode, device)] = old['checksum']
             else:
                 # Create a new record for this file
                 #self.logger.debug("No file found: %s", name)
-                self.db.insertFile(f, parent)
-                self.setXattrAcl(inode, device, xattr, acl)
+                updates['insert'].append(f)
+                self.setXattrAcl(inode, device, xattr, acl, updates)
                 if f["nlinks"] > 1:
                     # We're a file, and we have hard links.  Check to see if I've already been handled this inode.
                     #self.logger.debug('Looking for file with same inode %d in backupset', inode)
                     # TODO: Check that the file hasn't changed since it was last written. If file is in flux,
                     # it's a problem.
-                    checksum = self.db.getChecksumByInode(inode, device, True)
+                    # Check both what's already in the database, and anything which has been handled earlier in this directory
+                    checksum = updates['linked'].get((inode, device)) or lookups['linked'].get((inode, device))
                     if checksum:
-                        self.db.setChecksum(inode, device, checksum)
+                        updates['checksum'].append((inode, device, checksum))
+                        updates['linked'][(inode, device)] = checksum
                         retVal = DONE
                     else:
                         retVal = CONTENT
@@ -365,14 +540,15 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
                     #Check to see if it's been moved or copied
                     #self.logger.debug(u'Looking for similar file: %s (%s)', name, inode)
                     # BUG: Don't we need to extend or insert the file here?
-                    old = self.db.getFileInfoBySimilar(f)
+                    old = lookups['similar'].get(_similarKey(f))
 
                     if old:
                         if (old["name"] == f["name"]) and (old["parent"] == parent) and (old['device'] == f['parentdev']):
                             # If the name and parent ID are the same, assume it's the same
                             #if ("checksum" in old.keys()) and not (old["checksum"] is None):
                             if old["checksum"] is not None:
-                                self.db.setChecksum(inode, device, old['checksum'])
+                                updates['checksum'].append((inode, device, old['checksum']))
+                                updates['linked'][(inode, device)] = old['checksum']
                                 retVal = DONE
                             else:
                                 retVal = CONTENT
@@ -386,6 +562,46 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
 
         return retVal
 
+    def findOld(self, f, dirhash, lookups):
+        """ Find the previous version of a file, either in the previous directory, or in a partial backup set """
+        old = dirhash.get(f["name"])
+        if not f["dir"]:
+            # Check to see if there's an updated version in any incomplete sets
+            tmp = lookups['partial'].get(_similarKey(f))
+            if tmp:
+                old = tmp
+        return old
+
+    def lookupFiles(self, files, dirhash):
+        """ Do the database lookups checkFile needs for an entire directory message in a few bulk queries """
+        lookups = { 'partial': {}, 'similar': {}, 'linked': {} }
+        plain = [f for f in files if not f["dir"]]
+        if not self.lastCompleted and plain:
+            # not in this directory, but lets look further in any incomplete sets if there are any
+            lookups['partial'] = self.db.getFilesFromPartialBackup(plain)
+        unknown = [f for f in plain if not self.findOld(f, dirhash, lookups)]
+        linked  = [(f['inode'], f['dev']) for f in unknown if f['nlinks'] > 1]
+        similar = [f for f in unknown if f['nlinks'] <= 1]
+        if linked:
+            lookups['linked'] = self.db.getChecksumsByInode(linked, True)
+        if similar:
+            lookups['similar'] = self.db.getFileInfosBySimilar(similar)
+        return lookups
+
+    def applyUpdates(self, parent, updates):
+        """ Write the changes queued up by checkFile into the database """
+        if updates['extend']:
+            self.db.extendFileInodes(parent, updates['extend'])
+        if updates['insert']:
+            self.db.insertFiles(updates['insert'], parent)
+        # Must follow the inserts, as these update the inserted records
+        if updates['checksum']:
+            self.db.setChecksums(updates['checksum'])
+        if updates['xattr']:
+            self.db.setXattrsForFiles(updates['xattr'])
+        if updates['acl']:
+            self.db.setAclsForFiles(updates['acl'])
+
     lastDirNode = None
     lastDirHash = {}
 
@@ -435,10 +651,15 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
 
             self.logger.debug("Got directory: %s", str(dirhash))
 
+        # Do all the lookups for the directory up front, and collect the changes to apply afterwards
+        lookups = self.lookupFiles(files, dirhash)
+        updates = { 'extend': [], 'insert': [], 'checksum': [], 'xattr': [], 'acl': [], 'linked': {}, 'basis': {} }
+        xattrs = {}
+
         for f in files:
             fileId = (f['inode'], f['dev'])
             self.logger.debug('Processing file: %s %s', f['name'], str(fileId))
-            res = self.checkFile(parentInode, f, dirhash)
+            res = self.checkFile(parentInode, f, dirhash, lookups, updates)
             # Shortcut for this:
             #if res == 0: done.append(inode)
             #elif res == 1: content.append(inode)
@@ -448,10 +669,14 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
             if 'xattr' in f:
                 xattr = f['xattr']
                 # Check to see if we have this checksum
-                info = self.db.getChecksumInfo(xattr)
-                if (not info) or (info['size'] == -1):
+                if xattr not in xattrs:
+                    info = self.db.getChecksumInfo(xattr)
+                    xattrs[xattr] = (not info) or (info['size'] == -1)
+                if xattrs[xattr]:
                     attrs.add(xattr)
 
+        self.applyUpdates(parentInode, updates)
+
 
         response = {
             "message"   : "ACKDIR",
@@ -464,7 +689,8 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
             "content"   : list(content),
             "delta"     : list(delta),
             "refresh"   : list(refresh),
-            "xattrs"    : list(attrs)
+            "xattrs"    : list(attrs),
+            "basis"     : [[i, d, c] for ((i, d), c) in updates['basis'].iteritems() if (i, d) in delta]
         }
 
         return (response, True)
@@ -521,7 +747,7 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
                     sig = sigfile.read()       # TODO: Does this always read the entire file?
                     sigfile.close()
                 else:
-                    rpipe = self.regenerator.recoverChecksum(chksum)
+                    rpipe = self.regenerator.recoverBasis(chksum)
                     #pipe = subprocess.Popen(["rdiff", "signature"], stdin=rpipe, stdout=subprocess.PIPE)
                     #pipe = subprocess.Popen(["rdiff", "signature", self.cache.path(chksum)], stdout=subprocess.PIPE)
                     #(sig, err) = pipe.communicate()
@@ -568,34 +794,57 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
         """ Receive a delta message. """
         self.logger.debug("Processing delta message: %s", message)
         output  = None
-        temp    = None
         checksum = message["checksum"]
-        basis    = message["basis"]
         size     = message["size"]          # size of the original file, not the content
-        (inode, dev)    = message["inode"]
-
-        deltasize = message['deltasize'] if 'deltasize' in message else None
-        encrypted = message.get('encrypted', False)
 
-        savefull = self.server.savefull and not encrypted
+        tempName = None
+        savefull = False
         if self.cache.exists(checksum):
             self.logger.debug("Checksum file %s already exists", checksum)
             # Abort read
         else:
-            if not savefull:
-                chainLength = self.db.getChainLength(basis)
-                if chainLength >= self.maxChain:
-                    self.logger.debug("Chain length %d.  Converting %s (%s) to full save", chainLength, basis, inode)
-                    savefull = True
+            savefull = self.deltaSaveFull(message)
             if savefull:
                 # Save the full output, rather than just a delta.  Save the delta to a file
                 #output = tempfile.NamedTemporaryFile(dir=self.tempdir, delete=True)
                 output = tempfile.SpooledTemporaryFile(dir=self.tempdir, prefix=self.tempPrefix)
             else:
-                output = self.cache.open(checksum, "wb")
+                # Receive into a temporary file, and insert it, so small deltas can be packed
+                (tempName, output) = self.dataTempFile()
+
+        received = Util.receiveData(self.messenger, output)
+        if tempName:
+            output.close()
+            self.cache.insert(checksum, tempName)
+        self.storeDelta(message, output, savefull, received)
+
+        flush = True if size > 1000000 else False
+        return (None, flush)
 
-        (bytesReceived, status, deltaSize, deltaChecksum, compressed) = Util.receiveData(self.messenger, output)
-        self.logger.debug("Data Received: %d %s %d %s %d", bytesReceived, status, deltaSize, deltaChecksum, compressed)
+    def deltaSaveFull(self, message):
+        """ Determine if a delta should be patched into its basis, and saved as a full file """
+        savefull = self.server.savefull and not message.get('encrypted', False)
+        if not savefull:
+            basis = message["basis"]
+            chainLength = self.db.getChainLength(basis)
+            if chainLength >= self.maxChain:
+                self.logger.debug("Chain length %d.  Converting %s (%s) to full save", chainLength, basis, message["inode"])
+                savefull = True
+        return savefull
+
+    def storeDelta(self, message, output, savefull, received):
+        """ Record a delta which has been received into output.  If savefull, output contains the delta, which is patched
+            into the basis, and stored as a full file """
+        checksum = message["checksum"]
+        basis    = message["basis"]
+        size     = message["size"]          # size of the original file, not the content
+        (inode, dev)    = message["inode"]
+
+        deltasize = message['deltasize'] if 'deltasize' in message else None
+        encrypted = message.get('encrypted', False)
+
+        (bytesReceived, status, deltaSize, deltaChecksum, compressed) = received
+        self.logger.debug("Data Received: %d %s %d %s %s", bytesReceived, status, deltaSize, deltaChecksum, compressed)
         if status != 'OK':
             self.logger.warning("Received invalid status on data reception")
 
@@ -611,16 +860,14 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
             try:
                 if savefull:
                     output.seek(0)
-                    if compressed:
-                        delta = CompressedBuffer.UncompressedBufferedReader(output)
-                        # HACK: Monkeypatch the buffer reader object to have a seek function to keep librsync happy.  Never gets called
-                        delta.seek = lambda x, y: 0
+                    if compressed and str(compressed).lower() != 'none':
+                        delta = CompressedBuffer.UncompressedBufferedReader(output, compressor=compressed)
                     else:
                         delta = output
 
                     # Process the delta file into the new file.
                     #subprocess.call(["rdiff", "patch", self.cache.path(basis), output.name], stdout=self.cache.open(checksum, "wb"))
-                    basisFile = self.regenerator.recoverChecksum(basis)
+                    basisFile = self.regenerator.recoverBasis(basis)
                     # Can't use isinstance
                     if type(basisFile) != types.FileType:
                         # TODO: Is it possible to get here?  Is this just dead code?
@@ -631,7 +878,8 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
                     shutil.copyfileobj(patched, self.cache.open(checksum, "wb"))
                     self.db.insertChecksumFile(checksum, encrypted, size=size, disksize=bytesReceived)
                 else:
-                    if self.server.linkBasis:
+                    # Basis links are a file each, which is just what packing is avoiding
+                    if self.server.linkBasis and not self.cache.packThreshold:
                         self.cache.link(basis, checksum + ".basis")
                     self.db.insertChecksumFile(checksum, encrypted, size=size, deltasize=deltasize, basis=basis, compressed=compressed, disksize=bytesReceived)
 
@@ -644,9 +892,6 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
             output.close()
             # TODO: This has gotta be wrong.
 
-        flush = True if size > 1000000 else False
-        return (None, flush)
-
     def processSignature(self, message):
         """ Receive a signature message. """
         self.logger.debug("Processing signature message: %s", message)
@@ -841,36 +1086,26 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
             self.logger.debug("Sending output to temporary file %s", tempName)
             output = file(tempName, 'wb')
 
+        info = {}
+        received = Util.receiveData(self.messenger, output, info)
+        output.close()
+
+        self.storeContent(message, tempName, received, info)
+
+        #return {"message" : "OK", "inode": message["inode"]}
+        #flush = True if bytesReceived > 1000000 else False
+        return (None, False)
+
+    def storeContent(self, message, tempName, received, info=None):
+        """ Record a file's content, which has been received into tempName, or directly into the cache if tempName is None """
         encrypted = message.get('encrypted', False)
 
-        (bytesReceived, status, size, checksum, compressed) = Util.receiveData(self.messenger, output)
+        (bytesReceived, status, size, checksum, compressed) = received
         self.logger.debug("Data Received: %d %s %d %s %s", bytesReceived, status, size, checksum, compressed)
 
-        output.close()
-
         try:
-            if tempName:
-                if self.cache.exists(checksum):
-                    # Error check.  Sometimes files can get into the cachedir without being recorded.
-                    ckInfo = self.db.getChecksumInfo(checksum)
-                    if ckInfo is None:
-                        self.logger.warning("Checksum file %s exists, but no DB entry.  Reinserting", checksum)
-                        self.cache.insert(checksum, tempName)
-                        self.db.insertChecksumFile(checksum, encrypted, size, compressed=compressed, disksize=bytesReceived)
-                    else:
-                        if self.full:
-                            self.logger.debug("Replacing existing checksum file for %s", checksum)
-                            self.cache.insert(checksum, tempName)
-                            self.db.updateChecksumFile(checksum, encrypted, size, compressed=compressed, disksize=bytesReceived)
-                        else:
-                            # Check to make sure it's recorded in the DB.  If not, reinsert
-                            self.logger.debug("Checksum file %s already exists.  Deleting temporary version", checksum)
-                            os.remove(tempName)
-                else:
-                    self.cache.insert(checksum, tempName)
-                    self.db.insertChecksumFile(checksum, encrypted, size, compressed=compressed, disksize=bytesReceived)
-            else:
-                self.db.insertChecksumFile(checksum, encrypted, size, compressed=compressed, disksize=bytesReceived)
+            if self.insertContent(checksum, tempName, encrypted, size, compressed, bytesReceived) and info and info.get('index'):
+                self.db.setBlockIndex(checksum, info['index'])
 
             (inode, dev) = message['inode']
 
@@ -887,8 +1122,95 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
 
         self.statBytesReceived += bytesReceived
 
-        #return {"message" : "OK", "inode": message["inode"]}
-        #flush = True if bytesReceived > 1000000 else False
+    def insertContent(self, checksum, tempName, encrypted, size, compressed, bytesReceived):
+        """ Move content received into tempName into the cache, and record the checksum.  If tempName is None, the
+            content was received directly into the cache.  Returns False if the content was already there, and the
+            copy received has been thrown away """
+        if tempName:
+            if self.cache.exists(checksum):
+                # Error check.  Sometimes files can get into the cachedir without being recorded.
+                ckInfo = self.db.getChecksumInfo(checksum)
+                if ckInfo is None:
+                    self.logger.warning("Checksum file %s exists, but no DB entry.  Reinserting", checksum)
+                    self.cache.insert(checksum, tempName)
+                    self.db.insertChecksumFile(checksum, encrypted, size, compressed=compressed, disksize=bytesReceived)
+                else:
+                    if self.full:
+                        self.logger.debug("Replacing existing checksum file for %s", checksum)
+                        self.cache.insert(checksum, tempName)
+                        self.db.updateChecksumFile(checksum, encrypted, size, compressed=compressed, disksize=bytesReceived)
+                    else:
+                        # Check to make sure it's recorded in the DB.  If not, reinsert
+                        self.logger.debug("Checksum file %s already exists.  Deleting temporary version", checksum)
+                        os.remove(tempName)
+                        return False
+            else:
+                self.cache.insert(checksum, tempName)
+                self.db.insertChecksumFile(checksum, encrypted, size, compressed=compressed, disksize=bytesReceived)
+        else:
+            self.db.insertChecksumFile(checksum, encrypted, size, compressed=compressed, disksize=bytesReceived)
+        return True
+
+    def processChunkQuery(self, message):
+        """ Determine which chunks of a chunked file need to be sent.  If the file is already here, none are needed """
+        self.logger.debug("Processing chunk query for %s: %d chunks", message['checksum'], len(message['chunks']))
+        needed = []
+        info = self.db.getChecksumInfo(message['checksum'])
+        if not (info and info['isfile'] and info['size'] >= 0):
+            seen = set()
+            for (i, chunk) in enumerate(message['chunks']):
+                if chunk in seen:
+                    continue
+                seen.add(chunk)
+                info = self.db.getChecksumInfo(chunk)
+                if not (info and info['isfile'] and info['size'] >= 0):
+                    needed.append(i)
+        response = {
+            "message": "ACKCHUNKQ",
+            "needed" : needed
+        }
+        return (response, False)
+
+    def processChunk(self, message):
+        """ Receive one chunk of a chunked file.  It's stored like any other content, but isn't attached to a file """
+        encrypted = message.get('encrypted', False)
+        tempName = os.path.join(self.tempdir, self.tempPrefix + str(self._sequenceNumber))
+        self._sequenceNumber += 1
+
+        output = file(tempName, 'wb')
+        info = {}
+        (bytesReceived, status, size, checksum, compressed) = Util.receiveData(self.messenger, output, info)
+        output.close()
+        self.logger.debug("Chunk Received: %d %s %d %s %s", bytesReceived, status, size, checksum, compressed)
+
+        try:
+            if self.insertContent(checksum, tempName, encrypted, size, compressed, bytesReceived) and info.get('index'):
+                self.db.setBlockIndex(checksum, info['index'])
+            Util.recordMetaData(self.cache, checksum, size, compressed, encrypted, bytesReceived, logger=self.logger)
+        except Exception as e:
+            self.logger.error("Could insert chunk %s info: %s", checksum, str(e))
+            if self.server.exceptions:
+                self.logger.exception(e)
+
+        self.statBytesReceived += bytesReceived
+        return (None, False)
+
+    def processChunks(self, message):
+        """ Record a file which has been sent as a list of chunks """
+        checksum = message['checksum']
+        chunks = message['chunks']
+        (inode, dev) = message['inode']
+        self.logger.debug("Processing chunked file %s: %d chunks", checksum, len(chunks))
+
+        if self.db.getChecksumInfo(checksum) is None:
+            missing = [c for c in set(chunks) if self.db.getChecksumInfo(c) is None]
+            if missing:
+                self.logger.error("Chunked file %s is missing %d chunks.  Not recorded", checksum, len(missing))
+                return (None, False)
+            self.db.insertChunkedFile(checksum, chunks, message.get('encrypted', False), message['size'])
+
+        self.db.setChecksum(inode, dev, checksum)
+        self.statNewFiles += 1
         return (None, False)
 
     def processBatch(self, message):
@@ -972,6 +1294,12 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
             (response, flush) = self.processDelta(message)
         elif messageType == "CON":
             (response, flush) = self.processContent(message)
+        elif messageType == "CHUNKQ":
+            (response, flush) = self.processChunkQuery(message)
+        elif messageType == "CHUNK":
+            (response, flush) = self.processChunk(message)
+        elif messageType == "CHUNKS":
+            (response, flush) = self.processChunks(message)
         elif messageType == "CKS":
             (response, flush) = self.processChecksum(message)
         elif messageType == "CLN":
@@ -996,6 +1324,7 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
         if response and 'msgid' in message:
             response['respid'] = message['msgid']
         self.db.commit()
+        self.cache.removeSuperseded()
 
         return (response, flush)
 
@@ -1052,9 +1381,15 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
                                     group=self.server.group,
                                     numbackups=self.server.dbbackups,
                                     journal=journal,
-                                    allow_upgrade = self.server.allowUpgrades)
-
-        self.regenerator = Regenerator.Regenerator(self.cache, self.db)
+                                    allow_upgrade = self.server.allowUpgrades,
+                                    pragmas=self.server.dbPragmas)
+        # Only look for packed files if there can be any, as the index can only be read from this thread.
+        if self.server.packThreshold or self.db.getCurrentPack() is not None:
+            self.cache.usePacks(self.db, self.server.packThreshold)
+
+        # Clients choose their own checksums, so each gets its own part of the cache, and can't fill another's.
+        regenCache = self.server.regenCache.forClient(client) if self.server.regenCache else None
+        self.regenerator = Regenerator.Regenerator(self.cache, self.db, regenCache=regenCache)
         return ret
 
     def setConfig(self):
@@ -1099,6 +1434,7 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
                 deltaPercent    = self.db.getConfigValue('MaxChangePercent')
                 autoPurge       = self.db.getConfigValue('AutoPurge')
                 saveConfig      = self.db.getConfigValue('SaveConfig')
+                dbPragmas       = self.db.getConfigValue('DBPragmas')
 
                 if savefull is not None:
                     self.logger.debug("Overriding global save full: %s", savefull)
@@ -1115,6 +1451,9 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
                 if saveConfig is not None:
                     self.logger.debug("Overriding global saveconfig value: %s", bool(autoPurge))
                     self.saveconfig = bool(saveconfig)
+                if dbPragmas is not None:
+                    self.logger.debug("Overriding global database pragmas: %s", dbPragmas)
+                    self.db.setPragmas(dbPragmas)
             except Exception as e:
                 self.logger.error("Client %s: Unable to override global configuration: %s", self.client, str(e))
 
@@ -1276,6 +1615,9 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
             try:
                 fields = self.recvMessage()
                 messType    = fields['message']
+                if messType == 'DATA':
+                    self.handleData(fields)
+                    return
                 if not messType == 'BACKUP':
                     raise InitFailedException("Unknown message type: {}".format(messType))
 
@@ -1370,6 +1712,15 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
                 "clientid": str(self.db.clientId)
                 }
 
+            # Data connections need a thread each, so only allow them if the server is threaded
+            if isinstance(self.server, SocketServer.ThreadingMixIn):
+                self.dataLock    = threading.Condition()
+                self.dataPending = collections.deque()
+                self.dataConns   = 0
+                self.dataToken   = base64.b64encode(os.urandom(24))
+                self.server.addSession(self.sessionid, client, self)
+                response['datatoken'] = self.dataToken
+
             if authResp:
                 response.update(authResp)
                 filenameKey = self.db.getConfigValue('FilenameKey')
@@ -1393,14 +1744,18 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
             while not done:
                 flush = False
                 message = self.recvMessage()
+                if self.dataToken:
+                    self.applyData()
                 if message["message"] == "BYE":
                     done = True
                 else:
+                    # processMessage commits each message, so there's no need to commit again when flushing.
                     (response, flush) = self.processMessage(message)
                     if response:
                         self.sendMessage(response)
-                if flush:
-                    self.db.commit()
+
+            if self.dataToken:
+                self.waitData()
 
             self.db.completeBackup()
 
@@ -1421,6 +1776,9 @@ class TardisServerHandler(SocketServer.BaseRequestHandler):
                 self.logger.exception(e)
         finally:
             sock.close()
+            # Nothing more can be stored, so make sure nothing more is received, and clean up anything not stored yet.
+            if self.dataPending is not None:
+                self.discardData()
             if started:
                 self.db.setClientEndTime()
                 # Autopurge if it's set.
@@ -1486,6 +1844,7 @@ class TardisServer(object):
         self.allowOverrides = config.getboolean('Tardis', 'AllowClientOverrides')
 
         self.allowUpgrades  = config.getboolean('Tardis', 'AllowSchemaUpgrades')
+        self.dbPragmas      = config.get('Tardis', 'DBPragmas')
 
         self.formats        = map(string.strip, config.get('Tardis', 'Formats').split(','))
         self.priorities     = map(int, config.get('Tardis', 'Priorities').split(','))
@@ -1498,6 +1857,15 @@ class TardisServer(object):
                            len(self.formats), len(self.priorities), len(self.keep), len(self.forceFull))
 
         self.dbbackups      = config.getint('Tardis', 'DBBackups')
+        self.packThreshold  = config.getint('Tardis', 'PackThreshold')
+
+        self.compactChain   = config.getint('Tardis', 'CompactChain')
+        self.compactAge     = config.getfloat('Tardis', 'CompactAge') * 86400           # Convert to seconds
+        self.compactDelay   = config.getfloat('Tardis', 'CompactDelay')
+
+        self.regenCache     = None
+        if config.get('Tardis', 'RegenCache'):
+            self.regenCache = RegenCache.RegenCache(config.get('Tardis', 'RegenCache'), config.getint('Tardis', 'RegenCacheSize') * 1024 * 1024)
 
         self.exceptions     = args.exceptions
 
@@ -1512,6 +1880,9 @@ class TardisServer(object):
         self.group = None
 
         self.sessions = {}
+        self.handlers = {}
+        # Held by the compactor while it replaces each file, so sessions can't start in the middle
+        self.sessionLock = threading.Lock()
 
         # If the User or Group is set, attempt to determine the users
         # Note, these will throw exeptions if the User or Group is unknown.  Will get
@@ -1535,11 +1906,20 @@ class TardisServer(object):
         else:
             self.profiler = None
 
-    def addSession(self, sessionId, client):
-        self.sessions[sessionId] = client
+    def addSession(self, sessionId, client, handler=None):
+        with self.sessionLock:
+            self.sessions[sessionId] = client
+            if handler:
+                self.handlers[sessionId] = handler
 
     def rmSession(self, sessionId):
-        del self.sessions[sessionId]
+        # Data connections don't have sessions of their own
+        self.sessions.pop(sessionId, None)
+        self.handlers.pop(sessionId, None)
+
+    def getSession(self, sessionId):
+        """ Get the handler for a running session """
+        return self.handlers.get(sessionId)
 
     def checkSession(self, sessionId):
         return sessionId in self.sessions
@@ -1622,6 +2002,13 @@ def run_server():
 
         logger.info("Server Session: %s", server.serverSessionID)
 
+        if server.compactChain and not args.single:
+            compactor = Compactor.Compactor(server.basedir, server.dbdir, server.dbname, lambda: not server.sessions,
+                                            server.compactChain, age=server.compactAge, delay=server.compactDelay,
+                                            packThreshold=server.packThreshold, user=server.user, group=server.group,
+                                            lock=server.sessionLock)
+            compactor.start()
+
         if args.single:
             server.handle_request()
         else:
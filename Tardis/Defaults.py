@@ -59,6 +59,9 @@ _defaults = {
     'TARDIS_NOCOMPRESS'     : None,
     'TARDIS_RECENT_SET'     : 'Current',
     'TARDIS_PW_STRENGTH'    : '0.75',
+    'TARDIS_REGEN_CACHE'    : None,
+    'TARDIS_REGEN_CACHE_SIZE': '1024',
+    'TARDIS_REGEN_CACHE_ENCRYPTED': 'False',
     'TARDIS_DEFAULTS'       : '/etc/tardis/system.defaults'
 }
 
@@ -0,0 +1,136 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2016, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import sqlite3
+import logging
+import os.path
+import time
+import cStringIO
+
+_schema = """
+CREATE TABLE IF NOT EXISTS Config (
+    Key         TEXT PRIMARY KEY,
+    Value       TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS FileState (
+    Device      INTEGER NOT NULL,
+    Inode       INTEGER NOT NULL,
+    Size        INTEGER NOT NULL,
+    MTime       INTEGER NOT NULL,
+    CTime       INTEGER NOT NULL,
+    Checksum    TEXT NOT NULL,
+    Signature   BLOB,
+    PRIMARY KEY(Device, Inode)
+);
+"""
+
+class FileState(object):
+    """
+    A local record of the state of each file as of the last time it was backed up.  Maps (device, inode) to the
+    size, mtime, and ctime the file had, the checksum of its contents, and optionally the rsync signature of those
+    contents, so unchanged files don't need to be reread to be checksummed, and delta's can be generated without
+    fetching the signature from the server.
+
+    Times are only recorded to the second, so a file which is rewritten at the same size within the second it was
+    read in would look unchanged.  To avoid this, the checksums of files changed in or after the second the state
+    was opened are never reused.
+
+    Checksums are only meaningful to the server (and keys) they were generated for, so the state is tagged with an
+    identity, and discarded if the identity changes.
+    """
+    def __init__(self, path, identity, commitInterval=1000):
+        self.logger = logging.getLogger("FileState")
+        self.path = os.path.abspath(path)
+        self.commitInterval = commitInterval
+        self.pending = 0
+        # Any file changed in or after this second may change again without its times changing.
+        self.started = int(time.time())
+
+        self.conn = sqlite3.connect(self.path)
+        self.conn.text_factory = str
+        self.conn.execute("PRAGMA synchronous=normal")
+        self.conn.executescript(_schema)
+
+        row = self.conn.execute("SELECT Value FROM Config WHERE Key = 'Identity'").fetchone()
+        if row is None or row[0] != identity:
+            if row is not None:
+                self.logger.warning("File state in %s is for a different backup.  Discarding", self.path)
+            self.conn.execute("DELETE FROM FileState")
+            self.conn.execute("INSERT OR REPLACE INTO Config (Key, Value) VALUES ('Identity', :identity)", {"identity": identity})
+            self.conn.commit()
+
+    def _lookup(self, fileInfo):
+        return self.conn.execute("SELECT Size, MTime, CTime, Checksum, Signature FROM FileState WHERE Device = :dev AND Inode = :inode",
+                                 {"dev": fileInfo['dev'], "inode": fileInfo['inode']}).fetchone()
+
+    def getChecksum(self, fileInfo):
+        """ Return the checksum of a file, if the file hasn't changed since it was recorded, None otherwise """
+        row = self._lookup(fileInfo)
+        if row and (row[0], row[1], row[2]) == (fileInfo['size'], fileInfo['mtime'], fileInfo['ctime']):
+            return row[3]
+        return None
+
+    def getSignature(self, fileInfo, checksum):
+        """ Return a file object containing the signature of the last recorded contents of a file, if those contents
+            had the specified checksum, None otherwise.  The file itself may have changed since. """
+        row = self._lookup(fileInfo)
+        if row and row[3] == checksum and row[4] is not None:
+            return cStringIO.StringIO(str(row[4]))
+        return None
+
+    def setState(self, fileInfo, checksum, signature=None):
+        """ Record the current state of a file.  If no signature is given, keep the old one if the contents are unchanged """
+        if signature is None:
+            row = self._lookup(fileInfo)
+            if row and row[3] == checksum:
+                signature = row[4]
+        mtime = fileInfo['mtime']
+        if max(fileInfo['mtime'], fileInfo['ctime']) >= self.started:
+            # Changed during this run.  Keep the signature, for generating deltas, but not the checksum.
+            mtime = -1
+        self.conn.execute("INSERT OR REPLACE INTO FileState (Device, Inode, Size, MTime, CTime, Checksum, Signature) "
+                          "VALUES (:dev, :inode, :size, :mtime, :ctime, :checksum, :signature)",
+                          {"dev": fileInfo['dev'], "inode": fileInfo['inode'], "size": fileInfo['size'],
+                           "mtime": mtime, "ctime": fileInfo['ctime'], "checksum": checksum,
+                           "signature": sqlite3.Binary(signature) if signature is not None else None})
+        self.pending += 1
+        if self.pending >= self.commitInterval:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        if self.conn:
+            self.commit()
+            self.conn.close()
+            self.conn = None
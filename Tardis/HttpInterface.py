@@ -156,6 +156,7 @@ def login():
             cache   = CacheDir.CacheDir(os.path.join(args.database, host), create=False)
             upgrade = config.getboolean('Tardis', 'AllowSchemaUpgrades')
             tardis  = TardisDB.TardisDB(dbPath, allow_upgrade=upgrade)
+            cache.usePacks(tardis)
 
             #session['tardis']   = tardis
             session['host']     = host
@@ -351,6 +352,21 @@ def getChecksumInfoChain(checksum):
     db = getDB()
     return createResponse(map(makeDict, db.getChecksumInfoChain(checksum)))
 
+@app.route('/getChunks/<checksum>')
+def getChunks(checksum):
+    db = getDB()
+    return createResponse(db.getChunks(checksum))
+
+@app.route('/getChunkSizes/<checksum>')
+def getChunkSizes(checksum):
+    db = getDB()
+    return createResponse(db.getChunkSizes(checksum))
+
+@app.route('/getBlockIndex/<checksum>')
+def getBlockIndex(checksum):
+    db = getDB()
+    return createResponse(db.getBlockIndex(checksum))
+
 @app.route('/getChecksumInfoChainByPath/<int:backupset>/<path:pathname>')
 def getChecksumInfoChainByPath(pathname, backupset):
     db = getDB()
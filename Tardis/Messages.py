@@ -45,6 +45,27 @@ except:
     _supportBson = False
     pass
 
+try:
+    import zstandard
+    _supportZstd = True
+except ImportError:
+    _supportZstd = False
+
+try:
+    import lz4.frame
+    _supportLz4 = True
+except ImportError:
+    _supportLz4 = False
+
+def getCompressors():
+    """ Message compression methods available here """
+    comps = ['none', 'zlib', 'zlib-stream', 'snappy']
+    if _supportZstd:
+        comps.append('zstd')
+    if _supportLz4:
+        comps.append('lz4')
+    return comps
+
 
 class Messages(object):
     __socket = None
@@ -52,23 +73,36 @@ class Messages(object):
     def __init__(self, socket, stats=None):
         self.__socket = socket
         self.__stats = stats
+        self.__buffer = bytearray(64 * 1024)
 
-    def receiveBytes(self, n):
-        msg = ''
-        while len(msg) < n:
-            chunk = self.__socket.recv(n-len(msg))
-            if chunk == '':
+    def receiveInto(self, n):
+        """ Receive exactly n bytes into a reusable buffer, and return a read only view of them.
+            The view is only valid until the next receive. """
+        if len(self.__buffer) < n:
+            self.__buffer = bytearray(n)
+        view = memoryview(self.__buffer)
+        received = 0
+        while received < n:
+            count = self.__socket.recv_into(view[received:n], n - received)
+            if count == 0:
                 raise RuntimeError("socket connection broken")
-            msg = msg + chunk
+            received += count
         if self.__stats != None:
-            self.__stats['bytesRecvd'] += len(msg)
-        return msg
+            self.__stats['bytesRecvd'] += n
+        return buffer(self.__buffer, 0, n)
+
+    def receiveBytes(self, n):
+        return str(self.receiveInto(n))
 
     def sendBytes(self, bytes):
         if self.__stats != None:
             self.__stats['bytesSent'] += len(bytes)
         self.__socket.sendall(bytes)
 
+    def recvData(self):
+        """ Receive a raw chunk of data, and decode it.  Can return a view which is only valid until the next receive. """
+        return self.decode(self.recvMessage(raw=True))
+
 class zlibCompressor:
     def __init__(self):
         self.compressor = zlib.compressobj()
@@ -98,6 +132,12 @@ class BinMessages(Messages):
         elif compress == 'snappy':
             self.compress = snappy.compress
             self.decompress = snappy.decompress
+        elif compress == 'zstd' and _supportZstd:
+            self.compress = zstandard.ZstdCompressor().compress
+            self.decompress = zstandard.ZstdDecompressor().decompress
+        elif compress == 'lz4' and _supportLz4:
+            self.compress = lz4.frame.compress
+            self.decompress = lz4.frame.decompress
         elif compress != 'none':
             raise Exception("Unrecognized compression method: %s" % str(compress))
 
@@ -111,18 +151,30 @@ class BinMessages(Messages):
         self.sendBytes(lBytes)
         self.sendBytes(message)
 
-    def recvMessage(self):
+    def recvHeader(self):
         comp = False
         x = self.receiveBytes(4)
         n = struct.unpack("!I", x)[0]
         if (n & 0x80000000) != 0:
             n &= 0x7fffffff
             comp = True
+        return (n, comp)
+
+    def recvMessage(self):
+        (n, comp) = self.recvHeader()
         bytes = self.receiveBytes(n)
         if comp:
             bytes = self.decompress(bytes)
         return bytes
 
+    def recvData(self):
+        # Leave the data in the receive buffer, rather than copying it out.  Data isn't encoded in the binary formats.
+        (n, comp) = self.recvHeader()
+        bytes = self.receiveInto(n)
+        if comp:
+            bytes = self.decompress(bytes)
+        return bytes
+
 class TextMessages(Messages):
     def __init__(self, socket, stats=None):
         Messages.__init__(self, socket, stats)
@@ -0,0 +1,175 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2016, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import os.path
+import logging
+import tempfile
+import shutil
+import sqlite3
+import copy
+import urllib
+
+class RegenCache(object):
+    """
+    Size bounded cache of regenerated files, kept on disk and keyed by checksum.  Used by the Regenerator to hold
+    the intermediate versions it rebuilds as bases for deltas, so files which share a basis don't each have to
+    apply the whole chain again.
+
+    The index is kept in a small sqlite database in the cache directory, so the cache can be shared by any number of
+    processes and threads.  Entries are evicted greedy-dual-size style:  each entry is given a priority of the current
+    "clock" plus its cost (the seconds it took to rebuild) per byte, and the lowest priority entry is evicted first,
+    advancing the clock to its priority.  Cheap or large entries drop out first, and entries which are hit are
+    refreshed against the current clock, so entries which haven't been used in a while eventually age out.
+
+    Checksums are only unique within a client, so entries are kept separately for each client, through the cache
+    returned by forClient().  The decrypted contents of encrypted files are only cached if encrypted is set.
+    """
+    def __init__(self, path, maxSize=1024 * 1024 * 1024, encrypted=False):
+        self.logger = logging.getLogger("RegenCache")
+        self.path = os.path.abspath(path)
+        self.maxSize = maxSize
+        self.encrypted = encrypted
+        self.client = None
+        self.dbfile = os.path.join(self.path, "regencache.db")
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0700)
+
+        conn = self._connect()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS Entries (Checksum TEXT PRIMARY KEY, Size INTEGER, Cost REAL, Priority REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS PriorityIndex ON Entries(Priority)")
+            conn.execute("CREATE TABLE IF NOT EXISTS Clock (Value REAL)")
+            if conn.execute("SELECT COUNT(*) FROM Clock").fetchone()[0] == 0:
+                conn.execute("INSERT INTO Clock (Value) VALUES (0.0)")
+        conn.close()
+
+    def _connect(self):
+        # A connection per operation, so the cache can be used from any thread.
+        return sqlite3.connect(self.dbfile, timeout=60)
+
+    def forClient(self, client):
+        """ Return a view of the cache holding the entries for a client.  The size limit applies to all clients together. """
+        view = copy.copy(self)
+        view.client = urllib.quote(str(client), safe='')
+        return view
+
+    def _key(self, checksum):
+        return self.client + "/" + checksum if self.client else checksum
+
+    def _path(self, key):
+        (client, checksum) = os.path.split(key)
+        return os.path.join(self.path, client, checksum[0:2], checksum)
+
+    def _priority(self, conn, cost, size):
+        clock = conn.execute("SELECT Value FROM Clock").fetchone()[0]
+        return clock + cost / max(size, 1)
+
+    def get(self, checksum):
+        """ Return an open file containing the cached data for checksum, or None if it isn't in the cache """
+        key = self._key(checksum)
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute("SELECT Size, Cost FROM Entries WHERE Checksum = :checksum", {"checksum": key}).fetchone()
+                if row is None:
+                    return None
+                try:
+                    f = open(self._path(key), "rb")
+                except IOError:
+                    self.logger.warning("Cached file for %s missing", key)
+                    conn.execute("DELETE FROM Entries WHERE Checksum = :checksum", {"checksum": key})
+                    return None
+                (size, cost) = row
+                conn.execute("UPDATE Entries SET Priority = :priority WHERE Checksum = :checksum",
+                             {"priority": self._priority(conn, cost, size), "checksum": key})
+                return f
+        finally:
+            conn.close()
+
+    def put(self, checksum, data, cost):
+        """ Copy the contents of the file data into the cache, recording that it took cost seconds to generate """
+        data.seek(0, os.SEEK_END)
+        size = data.tell()
+        data.seek(0)
+        if size > self.maxSize:
+            return
+
+        key = self._key(checksum)
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path), 0700)
+            except OSError:
+                # Somebody else may have created it already
+                pass
+
+        # Write into a temporary, and rename, so nobody can read a partial file.
+        temp = tempfile.NamedTemporaryFile(dir=self.path, prefix=".regen-", delete=False)
+        try:
+            shutil.copyfileobj(data, temp)
+            temp.close()
+            os.rename(temp.name, path)
+        except:
+            os.unlink(temp.name)
+            raise
+        finally:
+            data.seek(0)
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO Entries (Checksum, Size, Cost, Priority) VALUES (:checksum, :size, :cost, :priority)",
+                             {"checksum": key, "size": size, "cost": cost, "priority": self._priority(conn, cost, size)})
+                self._evict(conn, key)
+        finally:
+            conn.close()
+
+    def _evict(self, conn, keep):
+        total = conn.execute("SELECT COALESCE(SUM(Size), 0) FROM Entries").fetchone()[0]
+        if total <= self.maxSize:
+            return
+        victims = conn.execute("SELECT Checksum, Size, Priority FROM Entries WHERE Checksum != :keep ORDER BY Priority ASC",
+                               {"keep": keep}).fetchall()
+        clock = None
+        for (checksum, size, priority) in victims:
+            if total <= self.maxSize:
+                break
+            self.logger.debug("Evicting %s (%d bytes)", checksum, size)
+            conn.execute("DELETE FROM Entries WHERE Checksum = :checksum", {"checksum": checksum})
+            try:
+                os.unlink(self._path(checksum))
+            except OSError:
+                pass
+            total -= size
+            clock = priority
+        if clock is not None:
+            conn.execute("UPDATE Clock SET Value = MAX(Value, :clock)", {"clock": clock})
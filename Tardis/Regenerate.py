@@ -44,6 +44,7 @@ import posix1e
 import Tardis
 import TardisDB
 import Regenerator
+import RegenCache
 import Util
 import Config
 
@@ -214,7 +215,6 @@ def recoverObject(regenerator, info, bset, outputdir, path, linkDB, name=None, a
 
                     if info['link']:
                         # read and make a link
-                        i.seek(0)
                         x = i.read(16 * 1024)
                         if outname:
                             os.symlink(x, outname)
@@ -236,6 +236,12 @@ def recoverObject(regenerator, info, bset, outputdir, path, linkDB, name=None, a
                                 if hasher:
                                     hasher.update(x)
                                 x = i.read(16 * 1024)
+                        except Regenerator.RegenerateException as e:
+                            # Encrypted files are only authenticated once they've been read to the end.  If they don't,
+                            # deal with what's been written like any other file that doesn't authenticate.
+                            if not authenticate:
+                                raise
+                            logger.error("Unable to read file: %s: %s", path, e)
                         except Exception as e:
                             logger.error("Unable to read file: {}: {}".format(i, repr(e)))
                             raise
@@ -387,6 +393,13 @@ def parseArgs():
 
     parser.add_argument('--hardlinks',  dest='hardlinks',   default=True,   action=Util.StoreBoolean,   help='Create hardlinks of multiple copies of same inode created. Default: %(default)s')
 
+    parser.add_argument('--regen-cache',        dest='regencache', default=Config.config.get(Config.job, 'RegenCache'),
+                        help='Directory in which to cache regenerated delta bases between runs.  Default: %(default)s')
+    parser.add_argument('--regen-cache-size',   dest='regencachesize', default=Config.config.getint(Config.job, 'RegenCacheSize'), type=int,
+                        help='Maximum size of the regeneration cache, in megabytes.  Default: %(default)s')
+    parser.add_argument('--regen-cache-encrypted', dest='regencacheencrypted', default=Config.config.getboolean(Config.job, 'RegenCacheEncrypted'), action=Util.StoreBoolean,
+                        help='Keep decrypted copies of encrypted files in the regeneration cache.  Default: %(default)s')
+
     parser.add_argument('--exceptions',         default=False, action=Util.StoreBoolean, dest='exceptions', help="Log full exception data");
     parser.add_argument('--verbose', '-v',      action='count', default=0, dest='verbose', help='Increase the verbosity')
     parser.add_argument('--version',            action='version', version='%(prog)s ' + Tardis.__versionstring__,    help='Show the version')
@@ -409,7 +422,10 @@ def main():
         args.password = None
         (tardis, cache, crypt) = Util.setupDataConnection(args.database, args.client, password, args.keys, args.dbname, args.dbdir)
 
-        r = Regenerator.Regenerator(cache, tardis, crypt=crypt)
+        regenCache = None
+        if args.regencache:
+            regenCache = RegenCache.RegenCache(args.regencache, args.regencachesize * 1024 * 1024, encrypted=args.regencacheencrypted).forClient(args.client)
+        r = Regenerator.Regenerator(cache, tardis, crypt=crypt, regenCache=regenCache)
     except TardisDB.AuthenticationException as e:
         logger.error("Authentication failed.  Bad password")
         exceptionLogger.log(e)
@@ -498,6 +514,10 @@ def main():
                                 if hasher:
                                     hasher.update(x)
                                 x = f.read(64 * 1024)
+                        except Regenerator.RegenerateException as e:
+                            if not args.auth:
+                                raise
+                            logger.error("Unable to read file: %s: %s", i, e)
                         except Exception as e:
                             logger.error("Unable to read file: {}: {}".format(i, repr(e)))
                             raise
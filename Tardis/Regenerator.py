@@ -34,6 +34,9 @@ import logging
 import tempfile
 import shutil
 import hashlib
+import time
+import zlib
+import bisect
 
 import Tardis.CompressedBuffer as CompressedBuffer
 
@@ -43,64 +46,323 @@ import Tardis.librsync as librsync
 class RegenerateException(Exception):
     pass
 
+class DecryptingReader(CompressedBuffer.BufferedReader):
+    """
+    Decrypt an encrypted file as it's read.  If authenticate is set, the HMAC at the end of the file is checked
+    when the last block is read, and a RegenerateException raised if it doesn't match, so consumers only find out
+    the data was bad once they've read all of it.
+    """
+    def __init__(self, stream, crypt, size, authenticate=True, chunksize=64 * 1024):
+        super(DecryptingReader, self).__init__(stream, chunksize=chunksize)
+        self.logger = logging.getLogger("Regenerator")
+        self.crypt = crypt
+        self.authenticate = authenticate
+        self.hmac = crypt.getHash(func=hashlib.sha512)
+
+        # Get the IV, and create the cypher
+        stream.seek(0, os.SEEK_SET)
+        iv = stream.read(crypt.ivLength)
+        self.logger.debug("Got IV: %d %s", len(iv), binascii.hexlify(iv))
+        if authenticate:
+            self.hmac.update(iv)
+        self.cipher = crypt.getContentCipher(iv)
+
+        self.remaining = size - crypt.ivLength - self.hmac.digest_size
+
+    def _get(self):
+        if self.remaining <= 0:
+            return ""
+        readsize = min(self.chunksize, self.remaining)
+        ct = self.stream.read(readsize)
+        if self.authenticate:
+            self.hmac.update(ct)
+        pt = self.cipher.decrypt(ct)
+        if self.remaining <= self.chunksize:
+            # ie, we're the last block
+            digest = self.stream.read(self.hmac.digest_size)
+            self.logger.debug("Got HMAC Digest: %d %s", len(digest), binascii.hexlify(digest))
+            if self.authenticate and digest != self.hmac.digest():
+                self.logger.debug("HMAC's:  File: %-128s Computed: %-128s", binascii.hexlify(digest), self.hmac.hexdigest())
+                raise RegenerateException("HMAC did not authenticate.")
+            pt = self.crypt.unpad(pt)
+        self.remaining -= readsize
+        self.numbytes += len(pt)
+        return pt
+
+class PatchingReader(CompressedBuffer.BufferedReader):
+    """
+    Apply a delta to a basis as it's read, so the patched file never has to be written out.  The basis must be
+    seekable, the delta can be any stream.
+    """
+    def __init__(self, basis, delta):
+        super(PatchingReader, self).__init__(delta, chunksize=librsync.RS_JOB_BLOCKSIZE)
+        self.basis = basis
+        self.job = librsync.PatchJob(basis)
+        self.pending = ""
+        self.eof = False
+        self.done = False
+
+    def _get(self):
+        try:
+            while not self.done:
+                if not self.eof and len(self.pending) < self.chunksize:
+                    data = self.stream.read(self.chunksize)
+                    self.eof = not data
+                    self.pending += data
+                (output, self.pending, self.done) = self.job.step(self.pending, self.eof)
+                if output:
+                    self.numbytes += len(output)
+                    return output
+        except librsync.LibrsyncError as e:
+            raise RegenerateException("Error applying delta: {}".format(e))
+        return ""
+
+    def close(self):
+        self.job.close()
+        if self.basis:
+            self.basis.close()
+            self.basis = None
+        super(PatchingReader, self).close()
+
+class ChunkedReader(CompressedBuffer.BufferedReader):
+    """
+    Read a chunked file, recovering each chunk only when the previous one has been read.
+    """
+    def __init__(self, regenerator, chunks, authenticate=True):
+        super(ChunkedReader, self).__init__(None)
+        self.regenerator = regenerator
+        self.chunks = iter(chunks)
+        self.authenticate = authenticate
+
+    def _get(self):
+        while True:
+            if self.stream:
+                buf = self.stream.read(self.chunksize)
+                if buf:
+                    self.numbytes += len(buf)
+                    return buf
+                self.stream.close()
+                self.stream = None
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                return ""
+            self.stream = self.regenerator.recoverChecksum(chunk, self.authenticate)
+            if self.stream is None:
+                raise RegenerateException("Unable to recover chunk {}".format(chunk))
+
+class SeekableReader(object):
+    """
+    Random access to a file which is stored whole, rather than as a delta, reading only what's asked for.  Encrypted
+    data can be decrypted from any AES block, as CBC only needs the block before as the IV.  Compressed data can only
+    be entered at the points in its block index, so the block around the read is decompressed, and kept for the next
+    read.  If authenticate is set, the HMAC is checked over the ciphertext when the file is opened.
+    """
+    def __init__(self, stream, size, crypt=None, disksize=None, index=None, authenticate=True):
+        self.logger = logging.getLogger("Regenerator")
+        self.stream = stream
+        self.size = size
+        self.crypt = crypt
+        self.pos = 0
+        self.block = None
+        self.blockStart = None
+
+        if index:
+            if index[0][0] != 0:
+                index = [[0, 0]] + index
+            self.index = index
+            self.starts = [u for (u, _) in index]
+        else:
+            self.index = None
+
+        if crypt:
+            hmac = crypt.getHash(func=hashlib.sha512)
+            stream.seek(0, os.SEEK_SET)
+            self.iv = stream.read(crypt.ivLength)
+            self.ctSize = disksize - crypt.ivLength - hmac.digest_size
+            if authenticate:
+                self._authenticate(hmac)
+
+    def _authenticate(self, hmac):
+        hmac.update(self.iv)
+        rem = self.ctSize
+        while rem > 0:
+            ct = self.stream.read(min(rem, 1024 * 1024))
+            if not ct:
+                break
+            hmac.update(ct)
+            rem -= len(ct)
+        if self.stream.read(hmac.digest_size) != hmac.digest():
+            raise RegenerateException("HMAC did not authenticate.")
+
+    def _readStored(self, offset, length=None):
+        """ Read length bytes, or everything, from offset in the data as it was before it was encrypted """
+        if not self.crypt:
+            self.stream.seek(offset)
+            return self.stream.read() if length is None else self.stream.read(length)
+
+        blocksize = self.crypt.ivLength
+        start = offset - (offset % blocksize)
+        if length is None:
+            end = self.ctSize
+        else:
+            end = min(self.ctSize, offset + length + (-(offset + length) % blocksize))
+        if start >= end:
+            return ""
+
+        if start == 0:
+            iv = self.iv
+            self.stream.seek(self.crypt.ivLength)
+        else:
+            self.stream.seek(self.crypt.ivLength + start - blocksize)
+            iv = self.stream.read(blocksize)
+        pt = self.crypt.getContentCipher(iv).decrypt(self.stream.read(end - start))
+        if end == self.ctSize:
+            pt = self.crypt.unpad(pt)
+        pt = pt[offset - start:]
+        return pt if length is None else pt[:length]
+
+    def _getBlock(self, i):
+        if self.blockStart != self.index[i][0]:
+            (start, compStart) = self.index[i]
+            compLength = (self.index[i + 1][1] - compStart) if i + 1 < len(self.index) else None
+            # Only the first block has the zlib header.  The rest follow full flushes, and are raw deflate data.
+            decompressor = zlib.decompressobj() if compStart == 0 else zlib.decompressobj(-zlib.MAX_WBITS)
+            self.block = decompressor.decompress(self._readStored(compStart, compLength)) + decompressor.flush()
+            self.blockStart = start
+        return self.block
+
+    def read(self, size=-1):
+        if size is None or size < 0 or self.pos + size > self.size:
+            size = max(self.size - self.pos, 0)
+        if size == 0:
+            return ""
+
+        if self.index is None:
+            data = self._readStored(self.pos, size)
+            self.pos += len(data)
+            return data
+
+        out = []
+        while size > 0:
+            i = bisect.bisect_right(self.starts, self.pos) - 1
+            block = self._getBlock(i)
+            data = block[self.pos - self.blockStart:self.pos - self.blockStart + size]
+            if not data:
+                break
+            out.append(data)
+            self.pos += len(data)
+            size -= len(data)
+        return "".join(out)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = max(offset, 0)
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+class SeekableChunkedReader(object):
+    """
+    Random access to a chunked file.  Only the chunk around the read is recovered, and kept open for the next read.
+    """
+    def __init__(self, regenerator, chunks, authenticate=True):
+        self.regenerator = regenerator
+        self.authenticate = authenticate
+        self.chunks = []
+        self.starts = []
+        self.size = 0
+        for (chunk, size) in chunks:
+            self.chunks.append(chunk)
+            self.starts.append(self.size)
+            self.size += size
+        self.pos = 0
+        self.current = None
+        self.stream = None
+
+    def read(self, size=-1):
+        if size is None or size < 0 or self.pos + size > self.size:
+            size = max(self.size - self.pos, 0)
+        out = []
+        while size > 0:
+            i = bisect.bisect_right(self.starts, self.pos) - 1
+            if i != self.current:
+                if self.stream:
+                    self.stream.close()
+                self.stream = self.regenerator.makeSeekable(self.regenerator.recoverChecksum(self.chunks[i], self.authenticate, lazy=True))
+                if self.stream is None:
+                    raise RegenerateException("Unable to recover chunk {}".format(self.chunks[i]))
+                self.current = i
+            self.stream.seek(self.pos - self.starts[i])
+            data = self.stream.read(size)
+            if not data:
+                break
+            out.append(data)
+            self.pos += len(data)
+            size -= len(data)
+        return "".join(out)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = max(offset, 0)
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
 class Regenerator(object):
     errors = 0
 
-    def __init__(self, cache, db, crypt=None, tempdir="/tmp"):
+    def __init__(self, cache, db, crypt=None, tempdir="/tmp", regenCache=None):
         self.logger = logging.getLogger("Regenerator")
         self.cacheDir = cache
         self.db = db
         self.tempdir = tempdir
         self.crypt = crypt
+        self.regenCache = regenCache
 
     def decryptFile(self, filename, size, authenticate=True):
         self.logger.debug("Decrypting %s", filename)
         if self.crypt is None:
             raise Exception("Encrypted file.  No password specified")
         infile = self.cacheDir.open(filename, 'rb')
-        hmac = self.crypt.getHash(func=hashlib.sha512)
-
-        # Get the IV, if it's not specified.
-        infile.seek(0, os.SEEK_SET)
-        iv = infile.read(self.crypt.ivLength)
-
-        self.logger.debug("Got IV: %d %s", len(iv), binascii.hexlify(iv))
-
-        if authenticate:
-            hmac.update(iv)
-
-        # Create the cypher
-        cipher = self.crypt.getContentCipher(iv)
-
-        outfile = tempfile.TemporaryFile()
+        return DecryptingReader(infile, self.crypt, size, authenticate)
 
-        contentSize = size - self.crypt.ivLength - hmac.digest_size
-        #self.logger.info("Computed Size: %d.  Specified size: %d.  Diff: %d", ctSize, size, (ctSize - size))
+    def openLazy(self, cksum, cksInfo, authenticate=True):
+        """ Open a checksum stored as a whole file for random access.  Returns None if it can't be read that way. """
+        compressed = cksInfo['compressed'] is not None and str(cksInfo['compressed']).lower() != 'none'
+        index = None
+        if compressed:
+            if str(cksInfo['compressed']) != 'zlib':
+                return None
+            index = self.db.getBlockIndex(cksum)
+            if not index:
+                return None
+        if cksInfo['encrypted'] and self.crypt is None:
+            return None
+        crypt = self.crypt if cksInfo['encrypted'] else None
+        return SeekableReader(self.cacheDir.open(cksum, 'rb'), cksInfo['size'], crypt, cksInfo['disksize'], index, authenticate)
 
-        rem = contentSize
-        blocksize = 64 * 1024
-        while rem > 0:
-            readsize = blocksize if rem > blocksize else rem
-            ct = infile.read(readsize)
-            if authenticate:
-                hmac.update(ct)
-            pt = cipher.decrypt(ct)
-            if rem <= blocksize:
-                # ie, we're the last block
-                digest = infile.read(hmac.digest_size)
-                self.logger.debug("Got HMAC Digest: %d %s", len(digest), binascii.hexlify(digest))
-                readsize += len(digest)
-                if digest != hmac.digest():
-                    self.logger.debug("HMAC's:  File: %-128s Computed: %-128s", binascii.hexlify(digest), hmac.hexdigest())
-                    raise RegenerateException("HMAC did not authenticate.")
-                pt = self.crypt.unpad(pt)
-            outfile.write(pt)
-            rem -= readsize
-
-        outfile.seek(0)
-        return outfile
-
-    def recoverChecksum(self, cksum, authenticate=True, chain=None, basisFile=None):
+    def recoverChecksum(self, cksum, authenticate=True, chain=None, basisFile=None, lazy=False):
+        """
+        Recover the data for a checksum.  Mostly returns a stream.  If lazy is set, files stored whole, and chunked
+        files, are returned as readers which can seek, and only decrypt and decompress what's read.
+        """
         self.logger.debug("Recovering checksum: %s", cksum)
         cksInfo = None
         if not chain:
@@ -121,12 +383,17 @@ class Regenerator(object):
         #self.logger.debug(" %s: %s", cksum, str(cksInfo))
 
         try:
-            if cksInfo['basis']:
+            if cksInfo['chunked']:
+                # Stored as a list of chunks, each a checksum of its own.  Read them one after another.
+                if lazy:
+                    return SeekableChunkedReader(self, self.db.getChunkSizes(cksum), authenticate)
+                return ChunkedReader(self, self.db.getChunks(cksum), authenticate)
+            elif cksInfo['basis']:
                 if basisFile:
                     basis = basisFile
                     basis.seek(0)
                 else:
-                    basis = self.recoverChecksum(cksInfo['basis'], authenticate, chain)
+                    basis = self.recoverBasis(cksInfo['basis'], authenticate, chain)
 
                 if cksInfo['encrypted']:
                     patchfile = self.decryptFile(cksum, cksInfo['disksize'], authenticate)
@@ -135,19 +402,14 @@ class Regenerator(object):
 
                 if cksInfo['compressed']:
                     self.logger.debug("Uncompressing %s", cksum)
-                    temp = tempfile.TemporaryFile()
-                    buf = CompressedBuffer.UncompressedBufferedReader(patchfile, compressor=cksInfo['compressed'])
-                    shutil.copyfileobj(buf, temp)
-                    temp.seek(0)
-                    patchfile = temp
-                try:
-                    output = librsync.patch(basis, patchfile)
-                    #output.seek(0)
-                    return output
-                except librsync.LibrsyncError as e:
-                    self.logger.error("Recovering checksum: %s : %s", cksum, e)
-                    raise RegenerateException("Checksum: {}: Error: {}".format(cksum, e))
+                    patchfile = CompressedBuffer.UncompressedBufferedReader(patchfile, compressor=cksInfo['compressed'])
+                return PatchingReader(basis, patchfile)
             else:
+                if lazy:
+                    output = self.openLazy(cksum, cksInfo, authenticate)
+                    if output:
+                        return output
+
                 if cksInfo['encrypted']:
                     output =  self.decryptFile(cksum, cksInfo['disksize'])
                 else:
@@ -155,11 +417,7 @@ class Regenerator(object):
 
                 if cksInfo['compressed'] is not None and cksInfo['compressed'].lower() != 'none':
                     self.logger.debug("Uncompressing %s", cksum)
-                    temp = tempfile.TemporaryFile()
-                    buf = CompressedBuffer.UncompressedBufferedReader(output, compressor=cksInfo['compressed'])
-                    shutil.copyfileobj(buf, temp)
-                    temp.seek(0)
-                    output = temp
+                    output = CompressedBuffer.UncompressedBufferedReader(output, compressor=cksInfo['compressed'])
 
                 return output
 
@@ -168,7 +426,49 @@ class Regenerator(object):
             #self.logger.exception(e)
             raise RegenerateException("Checksum: {}: Error: {}".format(cksum, e))
 
-    def recoverFile(self, filename, bset=False, nameEncrypted=False, permchecker=None, authenticate=True):
+    def makeSeekable(self, output):
+        """ Return output, written out to a temporary file if it's a stream which can't seek.  librsync needs to seek in a basis. """
+        if output is None or callable(getattr(output, 'seek', None)):
+            return output
+        temp = tempfile.TemporaryFile(dir=self.tempdir)
+        shutil.copyfileobj(output, temp)
+        output.close()
+        temp.seek(0)
+        return temp
+
+    def recoverBasis(self, cksum, authenticate=True, chain=None):
+        """
+        Recover a file which is to be used as the basis for a delta.  This is the only file which needs to be seekable,
+        and so the only one which is ever written out to a temporary file.  If there's a regeneration cache, check it
+        first, and put deltas and chunked files into it after they've been rebuilt, along with how long that took.
+        """
+        if self.regenCache is None:
+            return self.makeSeekable(self.recoverChecksum(cksum, authenticate, chain))
+
+        output = self.regenCache.get(cksum)
+        if output:
+            self.logger.debug("Basis %s found in regeneration cache", cksum)
+            return output
+
+        if chain and chain[0]['checksum'] == cksum:
+            cksInfo = chain[0]
+        else:
+            cksInfo = self.db.getChecksumInfo(cksum)
+
+        start = time.time()
+        output = self.makeSeekable(self.recoverChecksum(cksum, authenticate, chain))
+
+        # Full files are no cheaper to get from the cache than from the backup, and files which weren't authenticated
+        # shouldn't be handed out to anybody who wants them authenticated.  Decrypted files are only kept if asked for.
+        if output and cksInfo and (cksInfo['basis'] or cksInfo['chunked']) and \
+           (not cksInfo['encrypted'] or (authenticate and self.regenCache.encrypted)):
+            try:
+                self.regenCache.put(cksum, output, time.time() - start)
+            except Exception as e:
+                self.logger.warning("Unable to cache basis %s: %s", cksum, e)
+        return output
+
+    def recoverFile(self, filename, bset=False, nameEncrypted=False, permchecker=None, authenticate=True, lazy=False):
         self.logger.info("Recovering file: %s", filename)
         name = filename
         if self.crypt and not nameEncrypted:
@@ -177,7 +477,7 @@ class Regenerator(object):
             chain = self.db.getChecksumInfoChainByPath(name, bset, permchecker=permchecker)
             if chain:
                 cksum = chain[0]['checksum']
-                return self.recoverChecksum(cksum, authenticate, chain)
+                return self.recoverChecksum(cksum, authenticate, chain, lazy=lazy)
             else:
                 self.logger.error("Could not locate file: %s ", name)
                 return None
@@ -337,6 +337,24 @@ class RemoteDB(object):
         r.raise_for_status()
         return r.json()
 
+    @reconnect
+    def getChunks(self, checksum):
+        r = self.session.get(self.baseURL + "getChunks/" + checksum, headers=self.headers)
+        r.raise_for_status()
+        return r.json()
+
+    @reconnect
+    def getChunkSizes(self, checksum):
+        r = self.session.get(self.baseURL + "getChunkSizes/" + checksum, headers=self.headers)
+        r.raise_for_status()
+        return r.json()
+
+    @reconnect
+    def getBlockIndex(self, checksum):
+        r = self.session.get(self.baseURL + "getBlockIndex/" + checksum, headers=self.headers)
+        r.raise_for_status()
+        return r.json()
+
     @reconnect
     def getChecksumInfoChainByPath(self, name, bset, permchecker=None):
         if not name.startswith('/'):
@@ -90,6 +90,7 @@ def getDB(crypt, password, new=False, allowRemote=True, allowUpgrade=False):
         cache = CacheDir.CacheDir(basedir, 2, 2, create=new)
         schema = args.schema if new else None
         tardisdb = TardisDB.TardisDB(dbfile, backup=False, initialize=schema, allow_upgrade=allowUpgrade)
+        cache.usePacks(tardisdb)
 
     if tardisdb.needsAuthentication():
         if password is None:
@@ -38,12 +38,18 @@ import uuid
 import srp
 import functools
 import importlib
+import re
+import bisect
+import json
+import threading
+import weakref
 
 from binascii import hexlify, unhexlify
 
 import Tardis
 import Tardis.ConnIdLogAdapter as ConnIdLogAdapter
 import Tardis.Rotator as Rotator
+import Tardis.Cache as Cache
 
 # Exception classes
 class AuthenticationException(Exception):
@@ -85,9 +91,48 @@ _backupSetInfoFields = "BackupSet AS backupset, StartTime AS starttime, EndTime
 _backupSetInfoJoin = "FROM Backups LEFT OUTER JOIN Checksums ON Checksums.ChecksumID = Backups.CmdLineId "
 
 _checksumInfoFields = "Checksum AS checksum, ChecksumID AS checksumid, Basis AS basis, Encrypted AS encrypted, " \
-                      "Size AS size, DeltaSize AS deltasize, DiskSize AS disksize, IsFile AS isfile, Compressed AS compressed, ChainLength AS chainlength "
-
-_schemaVersion = 16
+                      "Size AS size, DeltaSize AS deltasize, DiskSize AS disksize, IsFile AS isfile, Compressed AS compressed, ChainLength AS chainlength, Chunked AS chunked "
+
+# Orphans are only looked for among the candidates, checksums which have been added, or have lost a reference, since
+# orphans were last removed.  The candidates are recorded by triggers in the schema.
+_orphanCandidates = "FROM OrphanCandidates JOIN CheckSums AS C ON C.ChecksumId = OrphanCandidates.ChecksumId " \
+                    "WHERE NOT EXISTS (SELECT 1 FROM Files WHERE Files.ChecksumId = C.ChecksumId) " \
+                    "AND   NOT EXISTS (SELECT 1 FROM Files WHERE Files.XattrId = C.ChecksumId) " \
+                    "AND   NOT EXISTS (SELECT 1 FROM Files WHERE Files.AclId = C.ChecksumId) " \
+                    "AND   NOT EXISTS (SELECT 1 FROM Backups WHERE Backups.CmdLineId = C.ChecksumId) " \
+                    "AND   NOT EXISTS (SELECT 1 FROM CheckSums AS B WHERE B.Basis = C.Checksum) " \
+                    "AND   NOT EXISTS (SELECT 1 FROM ChunkMaps WHERE ChunkMaps.ChunkId = C.ChecksumId) " \
+                    "AND   C.IsFile = :isfile "
+
+_schemaVersion = 21
+
+# Default SQLite settings.  WAL allows readers (tardisfs, lstardis, etc) to access the database while a backup is
+# running, and makes commits cheap.  Can be changed with the DBPragmas configuration value.
+defaultPragmas = "journal_mode=wal, synchronous=normal, cache_size=-65536, temp_store=memory, mmap_size=268435456"
+
+# Pragmas which can be set via the configuration, and which only a writer should change.
+_allowedPragmas = ['journal_mode', 'synchronous', 'cache_size', 'temp_store', 'mmap_size', 'wal_autocheckpoint', 'busy_timeout']
+_writerPragmas  = ['journal_mode', 'wal_autocheckpoint']
+
+def parsePragmas(pragmas):
+    """ Parse a string of the form "name=value, name=value" into a list of (name, value) tuples """
+    ret = []
+    if not pragmas:
+        return ret
+    for item in pragmas.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        (name, _, value) = item.partition('=')
+        name = name.strip().lower()
+        value = value.strip()
+        if name not in _allowedPragmas or not re.match(r'^-?\w+$', value):
+            raise ValueError("Invalid database pragma: {}".format(item))
+        ret.append((name, value))
+    return ret
+
+# Recursive common table expressions showed up in SQLite 3.8.3.  Older versions have to walk things by hand.
+_haveRecursive = sqlite3.sqlite_version_info >= (3, 8, 3)
 
 def _addFields(x, y):
     """ Add fields to the end of a dict """
@@ -98,6 +143,11 @@ def _splitpath(path):
     (head, tail) = os.path.split(path)
     return _splitpath(head) + [ tail ] if head and head != path else [ head or tail ]
 
+def _chunks(items, size=500):
+    """ Split a list into pieces small enough to be passed as parameters to a single query """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 def _fetchEm(cursor):
     while True:
         batch = cursor.fetchmany(10000)
@@ -126,12 +176,16 @@ class TardisDB(object):
     srpSrv          = None
     authenticated   = False
 
-    def __init__(self, dbname, backup=False, prevSet=None, initialize=None, connid=None, user=-1, group=-1, chunksize=1000, numbackups=2, journal=None, allow_upgrade=False):
+    def __init__(self, dbname, backup=False, prevSet=None, initialize=None, connid=None, user=-1, group=-1, chunksize=1000, numbackups=2, journal=None, allow_upgrade=False, namecache=10000, pathcache=10000, pragmas=defaultPragmas, readonly=False, checkThread=True):
         """ Initialize the connection to a per-machine Tardis Database"""
         self.logger  = logging.getLogger("DB")
         self.logger.debug("Initializing connection to %s", dbname)
         self.dbName = dbname
         self.chunksize = chunksize
+        # Cache of Name -> NameId.  The same names show up over and over again.
+        self.nameCache = Cache.Cache(namecache, 0, 'NameCache')
+        # Cache of (BackupSet, Path) -> FileInfo for directories, to shortcut path lookups.
+        self.pathCache = Cache.Cache(pathcache, 0, 'PathCache')
         self.prevSet = prevSet
         self.journalName = journal
         self.allow_upgrade = allow_upgrade
@@ -148,13 +202,17 @@ class TardisDB(object):
         self.backup = backup
         self.numbackups = numbackups
 
-        conn = sqlite3.connect(self.dbName)
+        conn = sqlite3.connect(self.dbName, check_same_thread=checkThread)
         conn.text_factory = str
         conn.row_factory= sqlite3.Row
 
         self.conn = conn
         self.cursor = self.conn.cursor()
 
+        self.setPragmas(pragmas)
+        if readonly:
+            self.conn.execute("PRAGMA query_only=1")
+
         if initialize:
             self.logger.info("Creating database from schema: %s", initialize)
             try:
@@ -185,6 +243,14 @@ class TardisDB(object):
             self.authenticated = False
             
     
+    def setPragmas(self, pragmas):
+        """ Apply a set of pragmas, as parsed by parsePragmas, to the connection.  Only a backup connection will change the journaling """
+        for (name, value) in parsePragmas(pragmas):
+            if name in _writerPragmas and not self.backup:
+                continue
+            self.logger.debug("Setting pragma %s = %s", name, value)
+            self.conn.execute("PRAGMA {}={}".format(name, value))
+
     def needsAuthentication(self):
         """ Return true if a database needs to be authenticated """
         salt, vkey = self.getSrpValues()
@@ -251,7 +317,6 @@ class TardisDB(object):
 
         self.conn.commit()
 
-        self.conn.execute("PRAGMA synchronous=false")
         self.conn.execute("PRAGMA foreignkeys=true")
 
         if self.journalName:
@@ -395,29 +460,79 @@ class TardisDB(object):
                   {"name": name, "parent": inode, "parentDev": device, "backup": backupset})
         return c.fetchone()
 
+    def _resolvePath(self, names, parent, backupset):
+        """ Resolve a list of path components, starting in the parent directory.
+            Returns a list of the FileInfo's for each component found, stopping at the first one which isn't. """
+        if not names:
+            return []
+        if not _haveRecursive:
+            infos = []
+            for name in names:
+                info = self.getFileInfoByName(name, parent, backupset)
+                if not info:
+                    break
+                infos.append(info)
+                parent = (info["inode"], info["device"])
+            return infos
+
+        (inode, device) = parent
+        # Start with SELECT, not WITH, or sqlite3 commits the current transaction first.
+        c = self._execute("SELECT " + _fileInfoFields + _fileInfoJoin +
+                          "JOIN ("
+                          "    WITH RECURSIVE "
+                          "    Components(Position, Component) AS (VALUES " + ",".join(["(?, ?)"] * len(names)) + "), "
+                          "    Path(PathDepth, PathRowId, PathInode, PathDevice) AS ("
+                          "        SELECT 0, NULL, ?, ? "
+                          "        UNION ALL "
+                          "        SELECT PathDepth + 1, Files.rowid, Files.Inode, Files.Device "
+                          "        FROM Path "
+                          "        JOIN Components ON Components.Position = PathDepth + 1 "
+                          "        JOIN Files ON Files.Parent = PathInode AND Files.ParentDev = PathDevice "
+                          "        JOIN Names ON Files.NameId = Names.NameId AND Names.Name = Components.Component "
+                          "        WHERE ? BETWEEN Files.FirstSet AND Files.LastSet) "
+                          "    SELECT PathDepth, PathRowId FROM Path) AS Path ON Files.rowid = Path.PathRowId "
+                          "ORDER BY PathDepth ASC",
+                          [x for pair in enumerate(names, 1) for x in pair] + [inode, device, backupset])
+        return c.fetchall()
+
+    def _getPathInfos(self, names, backupset):
+        """ Get the FileInfo's along a path, using cached directories where possible """
+        # The current set is changing underneath us, so don't cache it.
+        cacheable = (backupset != self.currBackupSet)
+        infos = []
+        if cacheable:
+            for i in range(len(names)):
+                info = self.pathCache.retrieve((backupset, tuple(names[:i + 1])))
+                if info is None:
+                    break
+                infos.append(info)
+
+        if len(infos) < len(names):
+            parent = (infos[-1]["inode"], infos[-1]["device"]) if infos else (0, 0)
+            found = self._resolvePath(names[len(infos):], parent, backupset)
+            if cacheable:
+                for (i, info) in enumerate(found, len(infos)):
+                    if info["dir"]:
+                        self.pathCache.insert((backupset, tuple(names[:i + 1])), info)
+            infos.extend(found)
+        return infos
+
     @authenticate
     def getFileInfoByPath(self, path, current=False, permchecker=None):
         """ Lookup a file by a full path. """
-        ### TODO: Could be a LOT faster without the repeated calls to getFileInfoByName
         backupset = self._bset(current)
         self.logger.debug("Looking up file by path {} {}".format(path, backupset))
-        parent = (0, 0)         # Root directory value
-        info = None
-
-        #(dirname, name) = os.path.split(path)
-        # Walk the path
-        for name in _splitpath(path):
-            if name == '/':
-                continue
-            info = self.getFileInfoByName(name, parent, backupset)
-            if info:
-                parent = (info["inode"], info["device"])
-                if permchecker:
-                    if not permchecker(info['uid'], info['gid'], info['mode']):
-                        raise Exception("File permission denied: " + name)
-            else:
-                break
-        return info
+        names = [name for name in _splitpath(path) if name != '/']
+
+        infos = self._getPathInfos(names, backupset)
+        if permchecker:
+            for info in infos:
+                if not permchecker(info['uid'], info['gid'], info['mode']):
+                    raise Exception("File permission denied: " + info['name'])
+        # Only return something if the whole path was found
+        if infos and len(infos) == len(names):
+            return infos[-1]
+        return None
 
     @authenticate
     def getFileInfoByPathForRange(self, path, first, last, permchecker=None):
@@ -430,17 +545,9 @@ class TardisDB(object):
         """ Return the FileInfo structures for each file along a path """
         backupset = self._bset(current)
         #self.logger.debug("Looking up file by path {} {}".format(path, backupset))
-        parent = (0, 0)         # Root directory value
-        info = None
-        for name in _splitpath(path):
-            if name == '/':
-                continue
-            info = self.getFileInfoByName(name, parent, backupset)
-            if info:
-                yield info
-                parent = (info["inode"], info["device"])
-            else:
-                break
+        names = [name for name in _splitpath(path) if name != '/']
+        for info in self._getPathInfos(names, backupset):
+            yield info
 
     @authenticate
     def getFileInfoByInode(self, info, current=False):
@@ -484,6 +591,37 @@ class TardisDB(object):
                                 temp)
         return c.fetchone()
 
+    @authenticate
+    def getFileInfosBySimilar(self, fileInfos, current=False):
+        """ Bulk version of getFileInfoBySimilar.  Returns a dictionary keyed by (inode, device, mtime, size) """
+        backupset = self._bset(current)
+        results = {}
+        for chunk in _chunks(list(set([f['inode'] for f in fileInfos]))):
+            c = self._execute("SELECT " +
+                              _fileInfoFields + _fileInfoJoin +
+                              "WHERE Inode IN (" + ",".join("?" * len(chunk)) + ") AND "
+                              "? BETWEEN Files.FirstSet AND Files.LastSet",
+                              chunk + [backupset])
+            for row in _fetchEm(c):
+                results.setdefault((row['inode'], row['device'], row['mtime'], row['size']), row)
+        return results
+
+    @authenticate
+    def getFilesFromPartialBackup(self, fileInfos):
+        """ Bulk version of getFileFromPartialBackup.  Returns a dictionary keyed by (inode, device, mtime, size) """
+        results = {}
+        for chunk in _chunks(list(set([f['inode'] for f in fileInfos]))):
+            c = self._execute("SELECT " +
+                              _fileInfoFields + _fileInfoJoin +
+                              "WHERE Inode IN (" + ",".join("?" * len(chunk)) + ") AND "
+                              "Files.LastSet >= ? "
+                              "ORDER BY Files.LastSet ASC",
+                              chunk + [self.prevBackupSet])
+            # Ordered, so the latest version of each file wins
+            for row in _fetchEm(c):
+                results[(row['inode'], row['device'], row['mtime'], row['size'])] = row
+        return results
+
     @authenticate
     def getFileInfoByInodeFromPartial(self, inode):
         (ino, dev) = inode
@@ -504,6 +642,14 @@ class TardisDB(object):
                             {"inode": inode, "device": device, "checksum": checksum, "backup": self.currBackupSet})
         return self.cursor.rowcount
 
+    @authenticate
+    def setChecksums(self, checksums):
+        """ Set the checksums for a list of (inode, device, checksum) tuples """
+        self.conn.executemany("UPDATE Files SET ChecksumId = (SELECT ChecksumId FROM CheckSums WHERE CheckSum = :checksum) "
+                              "WHERE Inode = :inode AND Device = :device AND "
+                              ":backup BETWEEN FirstSet AND LastSet",
+                              [{"inode": i, "device": d, "checksum": c, "backup": self.currBackupSet} for (i, d, c) in checksums])
+
     @authenticate
     def setXattrs(self, inode, device, checksum):
         self.cursor.execute("UPDATE Files SET XattrId = (SELECT ChecksumId FROM CheckSums WHERE CheckSum = :checksum) "
@@ -522,6 +668,22 @@ class TardisDB(object):
         #self.logger.info("Setting ACL ID for %d to %s, %d rows changed", inode, checksum, self.cursor.rowcount)
         return self.cursor.rowcount
 
+    @authenticate
+    def setXattrsForFiles(self, xattrs):
+        """ Set the extended attributes for a list of (inode, device, checksum) tuples """
+        self.conn.executemany("UPDATE Files SET XattrId = (SELECT ChecksumId FROM CheckSums WHERE CheckSum = :checksum) "
+                              "WHERE Inode = :inode AND Device = :device AND "
+                              ":backup BETWEEN FirstSet AND LastSet",
+                              [{"inode": i, "device": d, "checksum": c, "backup": self.currBackupSet} for (i, d, c) in xattrs])
+
+    @authenticate
+    def setAclsForFiles(self, acls):
+        """ Set the ACL's for a list of (inode, device, checksum) tuples """
+        self.conn.executemany("UPDATE Files SET AclId = (SELECT ChecksumId FROM CheckSums WHERE CheckSum = :checksum) "
+                              "WHERE Inode = :inode AND Device = :device AND "
+                              ":backup BETWEEN FirstSet AND LastSet",
+                              [{"inode": i, "device": d, "checksum": c, "backup": self.currBackupSet} for (i, d, c) in acls])
+
 
     @authenticate
     def getChecksumByInode(self, inode, device, current=True):
@@ -536,6 +698,24 @@ class TardisDB(object):
         return row[0] if row else None
         #if row: return row[0] else: return None
 
+    @authenticate
+    def getChecksumsByInode(self, inodes, current=True):
+        """ Bulk version of getChecksumByInode.  Returns a dictionary of (inode, device) -> checksum """
+        backupset = self._bset(current)
+        wanted = set(inodes)
+        results = {}
+        for chunk in _chunks(list(set([i for (i, _) in wanted]))):
+            c = self._execute("SELECT Files.Inode, Files.Device, CheckSums.Checksum "
+                              "FROM Files JOIN CheckSums ON Files.ChecksumId = Checksums.ChecksumId "
+                              "WHERE Files.Inode IN (" + ",".join("?" * len(chunk)) + ") AND "
+                              "? BETWEEN Files.FirstSet AND Files.LastSet",
+                              chunk + [backupset])
+            for row in _fetchEm(c):
+                key = (row[0], row[1])
+                if key in wanted:
+                    results.setdefault(key, row[2])
+        return results
+
     @authenticate
     def getChecksumByName(self, name, parent, current=False):
         backupset = self._bset(current)
@@ -609,6 +789,19 @@ class TardisDB(object):
                       "(:nameid, :backup, :backup, :inode, :dev, :parent, :parentDev, :dir, :link, :mtime, :ctime, :atime, :mode, :uid, :gid, :nlinks)",
                       temp)
 
+    @authenticate
+    def insertFiles(self, files, parent):
+        """ Insert a list of files, all in the same parent directory """
+        (parIno, parDev) = parent
+        fields = {"backup": self.currBackupSet, "parent": parIno, "parentDev": parDev}.items()
+        temps = [_addFields(fields, f) for f in files]
+        self.setNameID(temps)
+        self.conn.executemany("INSERT INTO Files "
+                              "(NameId, FirstSet, LastSet, Inode, Device, Parent, ParentDev, Dir, Link, MTime, CTime, ATime,  Mode, UID, GID, NLinks) "
+                              "VALUES  "
+                              "(:nameid, :backup, :backup, :inode, :dev, :parent, :parentDev, :dir, :link, :mtime, :ctime, :atime, :mode, :uid, :gid, :nlinks)",
+                              temps)
+
     @authenticate
     def updateDirChecksum(self, directory, cksid, current=True):
         bset = self._bset(current)
@@ -644,6 +837,18 @@ class TardisDB(object):
                                { "parent": parIno, "parentDev": parDev , "inode": ino, "device": dev, "old": old, "new": current })
         return cursor.rowcount
 
+    @authenticate
+    def extendFileInodes(self, parent, inodes, current=True):
+        """ Extend a list of files in a directory into the current set.  inodes is a list of (inode, device, old) tuples """
+        current = self._bset(current)
+        (parIno, parDev) = parent
+        self.conn.executemany("UPDATE FILES "
+                              "SET LastSet = :new "
+                              "WHERE Parent = :parent AND ParentDev = :parentDev AND Inode = :inode AND Device = :device AND "
+                              ":old BETWEEN FirstSet AND LastSet",
+                              [{ "parent": parIno, "parentDev": parDev , "inode": ino, "device": dev, "old": self._bset(old), "new": current }
+                               for (ino, dev, old) in inodes])
+
     @authenticate
     def cloneDir(self, parent, new=True, old=False):
         newBSet = self._bset(new)
@@ -659,14 +864,26 @@ class TardisDB(object):
 
     @authenticate
     def setNameID(self, files):
+        """ Set the nameid field of each file, adding any names which aren't in the Names table yet """
+        names = set([f["name"] for f in files])
+        ids = {}
+        for name in names:
+            nameid = self.nameCache.retrieve(name)
+            if nameid is not None:
+                ids[name] = nameid
+        # Fetch everything that's not in the cache in bulk
+        missing = [n for n in names if n not in ids]
+        for chunk in _chunks(missing):
+            c = self._execute("SELECT Name, NameId FROM Names WHERE Name IN (" + ",".join("?" * len(chunk)) + ")", chunk)
+            for row in c.fetchall():
+                ids[row[0]] = row[1]
+        for name in missing:
+            if name not in ids:
+                self.cursor.execute("INSERT INTO Names (Name) VALUES (:name)", {"name": name})
+                ids[name] = self.cursor.lastrowid
+            self.nameCache.insert(name, ids[name])
         for f in files:
-            c = self.cursor.execute("SELECT NameId FROM Names WHERE Name = :name", f)
-            row = c.fetchone()
-            if row:
-                f["nameid"] = row[0]
-            else:
-                self.cursor.execute("INSERT INTO Names (Name) VALUES (:name)", f)
-                f["nameid"] = self.cursor.lastrowid
+            f["nameid"] = ids[f["name"]]
 
     @authenticate
     def insertChecksumFile(self, checksum, encrypted=False, size=0, basis=None, deltasize=None, compressed='None', disksize=None, current=True, isFile=True):
@@ -689,17 +906,104 @@ class TardisDB(object):
                              "compressed": str(compressed), "disksize": disksize, "chainlength": chainlength, "added": added, "isfile": int(isFile)})
         return self.cursor.lastrowid
 
+    @authenticate
+    def insertChunkedFile(self, checksum, chunks, encrypted=False, size=0, current=True):
+        """ Record a file whose content is stored as a list of chunks.  Each chunk must already be stored as a checksum. """
+        self.logger.debug("Inserting chunked file: %s -- %d bytes, %d chunks", checksum, size, len(chunks))
+        added = self._bset(current)
+
+        self.cursor.execute("INSERT INTO CheckSums (CheckSum,  Size,  Encrypted,  DiskSize,  ChainLength,  Added,  IsFile,  Chunked) "
+                            "VALUES                (:checksum, :size, :encrypted, 0,         0,            :added, 1,       1)",
+                            {"checksum": checksum, "size": size, "encrypted": encrypted, "added": added})
+        cksid = self.cursor.lastrowid
+        self.cursor.executemany("INSERT INTO ChunkMaps (ChecksumId, Sequence, ChunkId) "
+                                "SELECT ?, ?, ChecksumId FROM CheckSums WHERE Checksum = ?",
+                                ((cksid, seq, chunk) for (seq, chunk) in enumerate(chunks)))
+        return cksid
+
+    @authenticate
+    def getChunks(self, checksum):
+        """ Return the checksums of the chunks which make up a chunked file, in order """
+        c = self._execute("SELECT C2.Checksum FROM CheckSums AS C1 "
+                          "JOIN ChunkMaps ON ChunkMaps.ChecksumId = C1.ChecksumId "
+                          "JOIN CheckSums AS C2 ON C2.ChecksumId = ChunkMaps.ChunkId "
+                          "WHERE C1.Checksum = :checksum "
+                          "ORDER BY ChunkMaps.Sequence ASC",
+                          {"checksum": checksum})
+        return [row[0] for row in c.fetchall()]
+
+    @authenticate
+    def getChunkSizes(self, checksum):
+        """ Return the checksums and sizes of the chunks which make up a chunked file, in order """
+        c = self._execute("SELECT C2.Checksum, C2.Size FROM CheckSums AS C1 "
+                          "JOIN ChunkMaps ON ChunkMaps.ChecksumId = C1.ChecksumId "
+                          "JOIN CheckSums AS C2 ON C2.ChecksumId = ChunkMaps.ChunkId "
+                          "WHERE C1.Checksum = :checksum "
+                          "ORDER BY ChunkMaps.Sequence ASC",
+                          {"checksum": checksum})
+        return [(row[0], row[1]) for row in c.fetchall()]
+
+    @authenticate
+    def setBlockIndex(self, checksum, index):
+        """ Record the points at which the compressed data for a checksum can be entered, as [uncompressed, compressed] offsets """
+        self._execute("UPDATE CheckSums SET BlockIndex = :index WHERE Checksum = :checksum",
+                      {"checksum": checksum, "index": json.dumps(index) if index else None})
+
+    @authenticate
+    def getBlockIndex(self, checksum):
+        c = self._execute("SELECT BlockIndex FROM CheckSums WHERE Checksum = :checksum", {"checksum": checksum})
+        row = c.fetchone()
+        if row and row[0]:
+            return json.loads(row[0])
+        return None
+
     @authenticate
     def updateChecksumFile(self, checksum, encrypted=False, size=0, basis=None, deltasize=None, compressed=False, disksize=None, chainlength=0):
         self.logger.debug("Updating checksum file: %s -- %d bytes, Compressed %s", checksum, size, str(compressed))
 
         self.cursor.execute("UPDATE CheckSums SET "
                             "Size = :size, Encrypted = :encrypted, Basis = :basis, DeltaSize = :deltasize, ChainLength = :chainlength, "
-                            "Compressed = :compressed, DiskSize = :disksize "
+                            "Compressed = :compressed, DiskSize = :disksize, BlockIndex = NULL "
                             "WHERE Checksum = :checksum",
                             {"checksum": checksum, "size": size, "basis": basis, "encrypted": encrypted, "deltasize": deltasize,
                              "compressed": str(compressed), "chainlength": chainlength, "disksize": disksize})
 
+    @authenticate
+    def listLongChains(self, chainLength, timestamp, limit=100):
+        """ List unencrypted deltas at least chainLength long, added in backup sets which ended before timestamp, shortest first """
+        c = self._execute("SELECT " + _checksumInfoFields + "FROM CheckSums "
+                          "WHERE ChainLength >= :chainlength AND Basis IS NOT NULL AND Encrypted = 0 "
+                          "AND Added <= (SELECT MAX(BackupSet) FROM Backups WHERE EndTime <= :timestamp) "
+                          "ORDER BY ChainLength ASC LIMIT :limit",
+                          {"chainlength": chainLength, "timestamp": str(timestamp), "limit": limit})
+        return c.fetchall()
+
+    @authenticate
+    def shortenChains(self, checksum, amount):
+        """ Reduce the chain length of every delta which depends on checksum, directly or indirectly, by amount """
+        if _haveRecursive:
+            # Start with UPDATE, not WITH, or sqlite3 commits the current transaction first, and doesn't set the rowcount.
+            self.cursor.execute("UPDATE CheckSums SET ChainLength = ChainLength - :amount WHERE Checksum IN ("
+                                "    WITH RECURSIVE Descendants(Checksum) AS ("
+                                "        SELECT Checksum FROM CheckSums WHERE Basis = :checksum "
+                                "        UNION ALL "
+                                "        SELECT CheckSums.Checksum FROM CheckSums JOIN Descendants ON CheckSums.Basis = Descendants.Checksum) "
+                                "    SELECT Checksum FROM Descendants)",
+                                {"checksum": checksum, "amount": amount})
+            return self.cursor.rowcount
+        count = 0
+        bases = [checksum]
+        while bases:
+            basis = bases.pop()
+            c = self._execute("SELECT Checksum FROM CheckSums WHERE Basis = :basis", {"basis": basis})
+            children = [row[0] for row in c.fetchall()]
+            for child in children:
+                self.cursor.execute("UPDATE CheckSums SET ChainLength = ChainLength - :amount WHERE Checksum = :checksum",
+                                    {"checksum": child, "amount": amount})
+                count += 1
+            bases.extend(children)
+        return count
+
     @authenticate
     def getChecksumInfo(self, checksum):
         self.logger.debug("Getting checksum info on: %s", checksum)
@@ -718,16 +1022,61 @@ class TardisDB(object):
     def getChecksumInfoChain(self, checksum):
         """ Recover a list of all the checksums which need to be used to generate a file """
         self.logger.debug("Getting checksum info chain on: %s", checksum)
-        chain = []
-        while checksum:
-            row = self.getChecksumInfo(checksum)
-            if row:
-                chain.append(row)
-            else:
-                return chain
-            checksum = row['basis']
-
-        return chain
+        if not _haveRecursive:
+            chain = []
+            while checksum:
+                row = self.getChecksumInfo(checksum)
+                if row:
+                    chain.append(row)
+                else:
+                    return chain
+                checksum = row['basis']
+
+            return chain
+
+        # Start with SELECT, not WITH, or sqlite3 commits the current transaction first.
+        c = self._execute("SELECT " + _checksumInfoFields +
+                          "FROM ("
+                          "    WITH RECURSIVE Chain(Depth, ChainChecksum) AS ("
+                          "        VALUES (0, :checksum) "
+                          "        UNION ALL "
+                          "        SELECT Depth + 1, Basis FROM Chain JOIN CheckSums ON CheckSums.Checksum = ChainChecksum "
+                          "        WHERE Basis IS NOT NULL) "
+                          "    SELECT Depth, ChainChecksum FROM Chain) "
+                          "JOIN CheckSums ON CheckSums.Checksum = ChainChecksum "
+                          "ORDER BY Depth ASC",
+                          {"checksum": checksum})
+        return c.fetchall()
+
+    @authenticate
+    def getChecksumInfoChains(self, checksums):
+        """ Recover the chains for many checksums at once.  Returns a dictionary of checksum -> chain, as returned by
+            getChecksumInfoChain.  Checksums which aren't found are left out. """
+        if not _haveRecursive:
+            chains = {}
+            for checksum in checksums:
+                chain = self.getChecksumInfoChain(checksum)
+                if chain:
+                    chains[checksum] = chain
+            return chains
+
+        chains = {}
+        for chunk in _chunks(list(set(checksums))):
+            # Start with SELECT, not WITH, or sqlite3 commits the current transaction first.
+            c = self._execute("SELECT Root AS root, " + _checksumInfoFields +
+                              "FROM ("
+                              "    WITH RECURSIVE Chain(Root, Depth, ChainChecksum) AS ("
+                              "        SELECT Checksum, 0, Checksum FROM CheckSums WHERE Checksum IN (" + ",".join("?" * len(chunk)) + ") "
+                              "        UNION ALL "
+                              "        SELECT Root, Depth + 1, Basis FROM Chain JOIN CheckSums ON CheckSums.Checksum = ChainChecksum "
+                              "        WHERE Basis IS NOT NULL) "
+                              "    SELECT Root, Depth, ChainChecksum FROM Chain) "
+                              "JOIN CheckSums ON CheckSums.Checksum = ChainChecksum "
+                              "ORDER BY Root, Depth ASC",
+                              chunk)
+            for row in _fetchEm(c):
+                chains.setdefault(row['root'], []).append(row)
+        return chains
 
     @authenticate
     def getNamesForChecksum(self, checksum):
@@ -1017,10 +1366,36 @@ class TardisDB(object):
         self._execute("UPDATE Backups SET Completed = 1 WHERE BackupSet = :backup", { "backup": self.currBackupSet })
         self.commit()
 
-    def _purgeFiles(self):
-        self.cursor.execute("DELETE FROM Files WHERE "
-                            "0 = (SELECT COUNT(*) FROM Backups WHERE Backups.BackupSet BETWEEN Files.FirstSet AND Files.LastSet)")
-        filesDeleted = self.cursor.rowcount
+    def _deleteSets(self, where, params):
+        """ Delete the backup sets matching the where clause.  Returns a list of the sets deleted """
+        c = self.cursor.execute("SELECT BackupSet FROM Backups " + where, params)
+        deleted = [row[0] for row in c.fetchall()]
+        self.cursor.execute("DELETE FROM Backups " + where, params)
+        return deleted
+
+    def _purgeFiles(self, deleted):
+        """
+        Delete the files which were only in the deleted backup sets.  A file is gone if its FirstSet to LastSet range falls
+        entirely between two of the remaining sets, so only the gaps the deleted sets leave need to be looked at, and
+        they can be found through the FirstSet index.  Files which start in a gap, but continue into a remaining set,
+        are trimmed to start at that set.
+        """
+        remaining = [row[0] for row in self.cursor.execute("SELECT BackupSet FROM Backups ORDER BY BackupSet ASC")]
+        gaps = set()
+        for bset in deleted:
+            i = bisect.bisect_left(remaining, bset)
+            gaps.add((remaining[i - 1] if i > 0 else -1, remaining[i] if i < len(remaining) else None))
+
+        filesDeleted = 0
+        for (lo, hi) in gaps:
+            self.logger.debug("Purging files between sets %d and %s", lo, hi)
+            if hi is None:
+                self.cursor.execute("DELETE FROM Files WHERE FirstSet > :lo", {"lo": lo})
+                filesDeleted += self.cursor.rowcount
+            else:
+                self.cursor.execute("DELETE FROM Files WHERE FirstSet > :lo AND FirstSet < :hi AND LastSet < :hi", {"lo": lo, "hi": hi})
+                filesDeleted += self.cursor.rowcount
+                self.cursor.execute("UPDATE Files SET FirstSet = :hi WHERE FirstSet > :lo AND FirstSet < :hi", {"lo": lo, "hi": hi})
         return filesDeleted
 
     @authenticate
@@ -1055,11 +1430,12 @@ class TardisDB(object):
         backupset = self._bset(current)
         self.logger.debug("Purging backupsets below priority %d, before %s, and backupset: %d", priority, timestamp, backupset)
         # First, purge out the backupsets that don't match
-        self.cursor.execute("DELETE FROM Backups WHERE Priority <= :priority AND EndTime <= :timestamp AND BackupSet < :backupset",
-                            {"priority": priority, "timestamp": str(timestamp), "backupset": backupset})
-        setsDeleted = self.cursor.rowcount
+        self.pathCache.purge()
+        deleted = self._deleteSets("WHERE Priority <= :priority AND EndTime <= :timestamp AND BackupSet < :backupset",
+                                   {"priority": priority, "timestamp": str(timestamp), "backupset": backupset})
+        setsDeleted = len(deleted)
         # Then delete the files which are no longer referenced
-        filesDeleted = self._purgeFiles()
+        filesDeleted = self._purgeFiles(deleted)
 
         return (filesDeleted, setsDeleted)
 
@@ -1069,35 +1445,30 @@ class TardisDB(object):
         backupset = self._bset(current)
         self.logger.debug("Purging incomplete backupsets below priority %d, before %s, and backupset: %d", priority, timestamp, backupset)
         # First, purge out the backupsets that don't match
-        self.cursor.execute("DELETE FROM Backups WHERE Priority <= :priority AND COALESCE(EndTime, StartTime) <= :timestamp AND BackupSet < :backupset AND Completed = 0",
-                            {"priority": priority, "timestamp": str(timestamp), "backupset": backupset})
-        setsDeleted = self.cursor.rowcount
+        self.pathCache.purge()
+        deleted = self._deleteSets("WHERE Priority <= :priority AND COALESCE(EndTime, StartTime) <= :timestamp AND BackupSet < :backupset AND Completed = 0",
+                                   {"priority": priority, "timestamp": str(timestamp), "backupset": backupset})
+        setsDeleted = len(deleted)
 
         # Then delete the files which are no longer referenced
-        filesDeleted = self._purgeFiles()
+        filesDeleted = self._purgeFiles(deleted)
 
         return (filesDeleted, setsDeleted)
 
     @authenticate
     def deleteBackupSet(self, current=False):
         bset = self._bset(current)
-        self.cursor.execute("DELETE FROM Backups WHERE BackupSet = :backupset", {"backupset": bset})
+        self.pathCache.purge()
+        deleted = self._deleteSets("WHERE BackupSet = :backupset", {"backupset": bset})
         # TODO: Move this to the removeOrphans phase
         # Then delete the files which are no longer referenced
-        filesDeleted = self._purgeFiles()
+        filesDeleted = self._purgeFiles(deleted)
 
         return filesDeleted
 
     @authenticate
     def listOrphanChecksums(self, isFile):
-        c = self.conn.execute("SELECT Checksum FROM Checksums "
-                              "WHERE ChecksumID NOT IN (SELECT DISTINCT(ChecksumID) FROM Files WHERE ChecksumID IS NOT NULL) "
-                              "AND   ChecksumID NOT IN (SELECT DISTINCT(XattrId) FROM Files WHERE XattrID IS NOT NULL) "
-                              "AND   ChecksumID NOT IN (SELECT DISTINCT(AclId) FROM Files WHERE AclId IS NOT NULL) "
-                              "AND   ChecksumID NOT IN (SELECT DISTINCT(CmdLineID) FROM Backups WHERE CmdLineID IS NOT NULL) "
-                              "AND   Checksum   NOT IN (SELECT DISTINCT(Basis) FROM Checksums WHERE Basis IS NOT NULL) "
-                              "AND IsFile = :isfile",
-                              { 'isfile': int(isFile)} )
+        c = self.conn.execute("SELECT C.Checksum " + _orphanCandidates, { 'isfile': int(isFile)} )
         while True:
             batch = c.fetchmany(self.chunksize)
             if not batch:
@@ -1107,21 +1478,23 @@ class TardisDB(object):
 
     @authenticate
     def deleteOrphanChecksums(self, isFile):
-        self.cursor.execute("DELETE FROM Checksums "
-                            "WHERE ChecksumID NOT IN (SELECT DISTINCT(ChecksumID) FROM Files WHERE ChecksumID IS NOT NULL) "
-                            "AND   ChecksumID NOT IN (SELECT DISTINCT(XattrId) FROM Files WHERE XattrID IS NOT NULL) "
-                            "AND   ChecksumID NOT IN (SELECT DISTINCT(AclId) FROM Files WHERE AclId IS NOT NULL) "
-                            "AND   ChecksumID NOT IN (SELECT DISTINCT(CmdLineID) FROM Backups WHERE CmdLineID IS NOT NULL) "
-                            "AND   Checksum   NOT IN (SELECT DISTINCT(Basis) FROM Checksums WHERE Basis IS NOT NULL) "
-                            "AND IsFile = :isfile",
+        self.cursor.execute("DELETE FROM CheckSums WHERE ChecksumId IN (SELECT C.ChecksumId " + _orphanCandidates + ")",
                             { 'isfile': int(isFile)} )
         return self.cursor.rowcount
 
+    @authenticate
+    def clearOrphanCandidates(self):
+        """ Forget the orphan candidates.  Call once all the orphans among them have been removed """
+        self.cursor.execute("DELETE FROM OrphanCandidates")
+        return self.cursor.rowcount
+
     @authenticate
     def compact(self):
         self.logger.debug("Removing unused names")
         # Purge out any unused names
         self.conn.execute("DELETE FROM Names WHERE NameID NOT IN (SELECT NameID FROM Files)")
+        # Removed names may be reused with different ID's, so forget what we know.
+        self.nameCache.purge()
         vacuumed = False
 
         # Check if we've hit an interval where we want to do a vacuum
@@ -1134,9 +1507,66 @@ class TardisDB(object):
             vacuumed = True
         self.conn.execute("UPDATE Backups SET Vacuumed = :vacuumed WHERE BackupSet = :backup", {"backup": self.currBackupSet, "vacuumed": vacuumed})
 
+    @authenticate
+    def getPackMember(self, name):
+        """ Find where a file packed into a pack file is.  Returns (packid, offset, size), or None if it isn't packed """
+        c = self._execute("SELECT PackId, Offset, Size FROM PackMembers WHERE Name = :name", {"name": name})
+        row = c.fetchone()
+        return tuple(row) if row else None
+
+    @authenticate
+    def getCurrentPack(self):
+        """ Return the ID of the most recent pack file, or None if there aren't any """
+        c = self._execute("SELECT MAX(PackId) FROM Packs", {})
+        row = c.fetchone()
+        return row[0] if row else None
+
+    @authenticate
+    def newPack(self):
+        self.cursor.execute("INSERT INTO Packs (Size, Live) VALUES (0, 0)")
+        return self.cursor.lastrowid
+
+    @authenticate
+    def insertPackMember(self, name, packid, offset, size):
+        """ Record a file packed into a pack file.  Replaces any earlier version of the file """
+        self.deletePackMember(name)
+        self.cursor.execute("INSERT INTO PackMembers (Name, PackId, Offset, Size) VALUES (:name, :packid, :offset, :size)",
+                            {"name": name, "packid": packid, "offset": offset, "size": size})
+        self.cursor.execute("UPDATE Packs SET Size = MAX(Size, :end), Live = Live + :size WHERE PackId = :packid",
+                            {"packid": packid, "end": offset + size, "size": size})
+
+    @authenticate
+    def deletePackMember(self, name):
+        """ Forget a packed file.  Its space in the pack file is left dead until the pack is repacked """
+        member = self.getPackMember(name)
+        if member is None:
+            return False
+        (packid, _, size) = member
+        self.cursor.execute("DELETE FROM PackMembers WHERE Name = :name", {"name": name})
+        self.cursor.execute("UPDATE Packs SET Live = Live - :size WHERE PackId = :packid", {"packid": packid, "size": size})
+        return True
+
+    @authenticate
+    def listSparsePacks(self, ratio, exclude=None):
+        """ List the packs whose live data is less than ratio of their size """
+        c = self._execute("SELECT PackId FROM Packs WHERE Live < Size * :ratio AND PackId IS NOT :exclude",
+                          {"ratio": ratio, "exclude": exclude})
+        return [row[0] for row in c.fetchall()]
+
+    @authenticate
+    def listPackMembers(self, packid):
+        c = self._execute("SELECT Name, Offset, Size FROM PackMembers WHERE PackId = :packid ORDER BY Offset ASC", {"packid": packid})
+        return [tuple(row) for row in c.fetchall()]
+
+    @authenticate
+    def deletePack(self, packid):
+        self.cursor.execute("DELETE FROM PackMembers WHERE PackId = :packid", {"packid": packid})
+        self.cursor.execute("DELETE FROM Packs WHERE PackId = :packid", {"packid": packid})
+
     @authenticate
     def deleteChecksum(self, checksum):
         self.logger.debug("Deleting checksum: %s", checksum)
+        self.cursor.execute("DELETE FROM ChunkMaps WHERE ChecksumId IN (SELECT ChecksumId FROM Checksums WHERE Checksum = :checksum)", {"checksum": checksum})
         self.cursor.execute("DELETE FROM Checksums WHERE Checksum = :checksum", {"checksum": checksum})
         return self.cursor.rowcount
 
@@ -1144,15 +1574,23 @@ class TardisDB(object):
     def commit(self):
         self.conn.commit()
 
+    @authenticate
+    def rollback(self):
+        self.conn.rollback()
+
     @authenticate
     def setClientEndTime(self):
         if self.currBackupSet:
             self.conn.execute("UPDATE Backups SET ClientEndTime = :now WHERE BackupSet = :backup",
                               { "now": time.time(), "backup": self.currBackupSet })
 
-    def close(self, completeBackup=False):
+    def close(self, completeBackup=False, logStats=True):
         #self.logger.debug("Closing DB: %s", self.dbName)
         # Apparently logger will get shut down if we're executing in __del__, so leave the debugging message out
+        # Not called from __del__, for the same reason.
+        if logStats:
+            self.nameCache.logStats()
+            self.pathCache.logStats()
         if self.currBackupSet:
             self.conn.execute("UPDATE Backups SET EndTime = :now WHERE BackupSet = :backup",
                               { "now": time.time(), "backup": self.currBackupSet })
@@ -1170,7 +1608,7 @@ class TardisDB(object):
 
     def __del__(self):
         if self.conn:
-            self.close()
+            self.close(logStats=False)
 
     def _isAuthenticated(self):
         if self.authenticated:
@@ -1180,6 +1618,54 @@ class TardisDB(object):
         else:
             return False
 
+    def clone(self, readonly=False):
+        """
+        Open another connection to the same database, for use in another thread.  It's authenticated if this one is.
+        The connection can be closed from any thread, so it can be cleaned up after the thread using it exits.
+        """
+        db = TardisDB(self.dbName, prevSet=self.prevSet, allow_upgrade=False, readonly=readonly, checkThread=False)
+        if self._isAuthenticated() and not db.authenticated:
+            db.authenticated = True
+            db._completeInit()
+        return db
+
+class ConnectionPool(object):
+    """
+    Stands in for a TardisDB, but gives each thread its own connection, cloned from db, so the database can be read from
+    several threads at once.  Connections are opened the first time a thread uses the pool, and closed when the thread
+    exits, or by close().  The thread which created the pool uses db itself.
+    """
+    def __init__(self, db, readonly=True):
+        self.db = db
+        self.readonly = readonly
+        self.local = threading.local()
+        self.local.db = db
+        self.lock = threading.Lock()
+        # Only the thread's local storage holds on to its connection
+        self.connections = weakref.WeakSet()
+
+    def _get(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.db.clone(readonly=self.readonly)
+            self.local.db = db
+            with self.lock:
+                self.connections.add(db)
+        return db
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def close(self):
+        with self.lock:
+            connections = list(self.connections)
+            self.connections.clear()
+        for db in connections:
+            if db.conn:
+                db.close()
+        if self.db.conn:
+            self.db.close()
+
 if __name__ == "__main__":
     db = TardisDB(sys.argv[1])
     db.newBackupSet(sys.argv[2], str(uuid.uuid1()))
@@ -37,17 +37,18 @@ import errno   # for error number codes (ENOENT, etc)
 import sys
 import logging
 import logging.handlers
-import tempfile
 import json
 import base64
 import time
 import stat    # for file properties
+import threading
 
 import fuse
 
 import Tardis
 import Tardis.CacheDir as CacheDir
 import Tardis.Regenerator as Regenerator
+import Tardis.RegenCache as RegenCache
 import Tardis.Util as Util
 import Tardis.Cache as Cache
 import Tardis.Defaults as Defaults
@@ -61,6 +62,10 @@ _DirInfo       = 2
 _DirContents   = 3
 _FileDetails   = 4
 _LinkContents  = 5
+_DirNames      = 6
+
+# Cached in place of the info for files which don't exist, so they aren't looked up again.
+_NotFound      = object()
 
 _infoEnabled    = True
 
@@ -134,11 +139,16 @@ class TardisFS(fuse.Fuse):
             self.dbdir          = dbdir
             self.logfile        = None
             self.cachetime      = 60
+            self.cachesize      = 64
             self.nocrypt        = False
             self.noauth         = False
+            self.nothreads      = False
             self.current        = current
             self.authenticate   = True
             self.verbose        = 0
+            self.regencache     = Defaults.getDefault('TARDIS_REGEN_CACHE')
+            self.regencachesize = Defaults.getDefault('TARDIS_REGEN_CACHE_SIZE')
+            self.regencacheencrypted = Defaults.getDefault('TARDIS_REGEN_CACHE_ENCRYPTED')
 
             self.crypt          = None
 
@@ -160,11 +170,16 @@ class TardisFS(fuse.Fuse):
             self.parser.add_option(mountopt="dbname",       help="Database Name")
             self.parser.add_option(mountopt="dbdir",        help="Database Directory (if different from data directory")
             self.parser.add_option(mountopt="cachetime",    help="Lifetime of cached elements in seconds")
+            self.parser.add_option(mountopt="cachesize",    help="Maximum size of each of the attribute and directory caches, in megabytes")
             self.parser.add_option(mountopt="logfile",      help="Log to file")
             self.parser.add_option(mountopt="verbose",      help="Logging level")
             self.parser.add_option(mountopt='nocrypt',      help="Disable encryption")
             self.parser.add_option(mountopt='noauth',       help="Disable authentication")
+            self.parser.add_option(mountopt='nothreads',    help="Handle one request at a time")
             self.parser.add_option(mountopt='current',      help="Name to use for most recent complete backup")
+            self.parser.add_option(mountopt='regencache',   help="Directory in which to cache regenerated delta bases")
+            self.parser.add_option(mountopt='regencachesize', help="Maximum size of the regeneration cache, in megabytes")
+            self.parser.add_option(mountopt='regencacheencrypted', help="Keep decrypted copies of encrypted files in the regeneration cache")
 
             res = self.parse(values=self, errex=1)
 
@@ -189,8 +204,8 @@ class TardisFS(fuse.Fuse):
             password = Util.getPassword(self.password, self.pwfile, self.pwprog, prompt="Password for %s: " % (self.client))
             self.password = None
 
-            self.cache      = Cache.Cache(0, float(self.cachetime))
-            self.fileCache  = Cache.Cache(0, float(self.cachetime), 'FileCache')
+            self.cache      = Cache.Cache(0, float(self.cachetime), maxBytes=int(self.cachesize) * 1024 * 1024)
+            self.fileCache  = Cache.Cache(0, float(self.cachetime), 'FileCache', maxBytes=int(self.cachesize) * 1024 * 1024)
 
             #if password:
             #    self.crypt = TardisCrypto.TardisCrypto(password, self.client)
@@ -204,16 +219,29 @@ class TardisFS(fuse.Fuse):
             if self.noauth or self.noauth is None:
                 self.authenticate = False
 
+            # Give each thread handling requests its own connection to the database, so one slow request, such as
+            # regenerating a long delta chain, doesn't hold up everything else.  Remote databases share one session
+            # for all requests, so they're only used from one thread.
+            threaded = not (self.nothreads or self.nothreads is None) and isinstance(self.tardis, TardisDB.TardisDB)
+            if threaded:
+                self.tardis = TardisDB.ConnectionPool(self.tardis)
+                self.cacheDir.usePacks(self.tardis)
+
             # Create a regenerator.
-            self.regenerator = Regenerator.Regenerator(self.cacheDir, self.tardis, crypt=self.crypt)
+            regenCache = None
+            if self.regencache:
+                encrypted = self.regencacheencrypted is None or str(self.regencacheencrypted).lower() in ('true', 'yes', '1')
+                regenCache = RegenCache.RegenCache(Util.fullPath(self.regencache), int(self.regencachesize) * 1024 * 1024, encrypted=encrypted).forClient(self.client)
+            self.regenerator = Regenerator.Regenerator(self.cacheDir, self.tardis, crypt=self.crypt, regenCache=regenCache)
             self.files = {}
+            self.filesLock = threading.Lock()
 
             # Make sure we can get something
             self.tardis.lastBackupSet()
 
             # Fuse variables
             self.flags = 0
-            self.multithreaded = 0
+            self.multithreaded = 1 if threaded else 0
 
         except TardisDB.AuthenticationException as e:
             self.log.critical("Authentication failed.  Bad Password")
@@ -287,18 +315,37 @@ class TardisFS(fuse.Fuse):
         f = self.fileCache.retrieve(path)
         if f:
             #self.log.debug("getFileInfoByPath: %s found in cache", path)
-            return f
+            return f if f is not _NotFound else None
+
+        (head, tail) = os.path.split(path)
+
+        # If the directory has been read, everything in it is in the cache, and anything else isn't there.
+        # If it hasn't, but the directory has been looked up before, read it all now.  Whatever's asked for next is
+        # most likely in the same directory.
+        names = self.cache.retrieve((_DirNames, head))
+        if names is None and getDepth(head) >= 1 and self.cache.retrieve((_DirInfo, head)):
+            self.prefetchDirectory(head)
+            names = self.cache.retrieve((_DirNames, head))
+        if names is not None:
+            f = self.fileCache.retrieve(path)
+            if f:
+                return f if f is not _NotFound else None
+            if tail not in names:
+                self.fileCache.insert(path, _NotFound)
+                return None
 
         # Not in the cache, look things up
         #self.log.debug("File info for %s not in cache", path)
-        (head, tail) = os.path.split(path)
         data = self.getDirInfo(head)
         if data:
             bsInfo, dInfo = data
         else:
             return None
 
-        if bsInfo:
+        if bsInfo and dInfo is None:
+            # Directory doesn't exist, so neither does anything in it.
+            f = None
+        elif bsInfo:
             if self.crypt:
                 tail = self.crypt.encryptPath(tail)
             #self.log.debug(str(dInfo))
@@ -311,8 +358,8 @@ class TardisFS(fuse.Fuse):
                 subpath = self.crypt.encryptPath(subpath)
             #self.log.debug("getFileInfoByPath: %s=>%s", parts[1], subpath)
             f = self.tardis.getFileInfoByPath(subpath, b['backupset'])
-        # Cache it.
-        self.fileCache.insert(path, f)
+        # Cache it, even if it isn't there.
+        self.fileCache.insert(path, f if f else _NotFound)
         # Return it
         return f
 
@@ -424,11 +471,40 @@ class TardisFS(fuse.Fuse):
         #self.log.info('CALL getdir {}'.format(path))
         return -errno.ENOSYS
 
+    def prefetchDirectory(self, path):
+        """
+        Read the contents of a directory (below the backup set level) in one pass, and put the info for each entry
+        in the file cache, so getattr() can find it there.  Returns the entries, as (name, mode) pairs.
+        """
+        parts = getParts(path)
+        if getDepth(path) == 1:
+            b = self.getBackupSetInfo(parts[0])
+            if not b:
+                return None
+            entries = self.tardis.readDirectory((0, 0), b['backupset'])
+        else:
+            (b, parent) = self.getDirInfo(path)
+            if not (b and parent):
+                return None
+            entries = self.tardis.readDirectory((parent["inode"], parent["device"]), b['backupset'])
+
+        now = time.time()
+        dirents = []
+        names = set()
+        for e in entries:
+            name  = e['name']
+            if self.crypt:
+                name = self.crypt.decryptFilename(name)
+            name = self.fsEncodeName(name)
+            self.fileCache.insert(os.path.join(path, name), e, now=now)
+            dirents.append((name, e['mode']))
+            names.add(name)
+        self.cache.insert((_DirNames, path), names, now=now)
+        return dirents
+
     @tracer
     def readdir(self, path, offset):
         #self.log.info("CALL readdir %s Offset: %d", path, offset)
-        parent = None
-
         path = self.fsEncodeName(path)
 
         key = (_DirContents, path)
@@ -441,27 +517,7 @@ class TardisFS(fuse.Fuse):
                 entries = self.tardis.listBackupSets()
                 dirents.extend([(y['name'], stat.S_IFDIR) for y in entries])
             else:
-                parts = getParts(path)
-                if depth == 1:
-                    b = self.getBackupSetInfo(parts[0])
-                    entries = self.tardis.readDirectory((0, 0), b['backupset'])
-                else:
-                    (b, parent) = self.getDirInfo(path)
-                    entries = self.tardis.readDirectory((parent["inode"], parent["device"]), b['backupset'])
-                #if self.crypt:
-                    #entries = self.decryptNames(entries)
-
-                # For each entry, cache it, so a later getattr() call can use it.
-                # Get attr will typically be called promptly after a call to
-                now = time.time()
-                for e in entries:
-                    name  = e['name']
-                    if self.crypt:
-                        name = self.crypt.decryptFilename(name)
-                    name = self.fsEncodeName(name)
-                    p = os.path.join(path, name)
-                    self.fileCache.insert(p, e, now=now)
-                    dirents.append((name, e['mode']))
+                dirents.extend(self.prefetchDirectory(path) or [])
             self.cache.insert(key, dirents)
 
         #self.log.debug("Direntries: %s", str(dirents))
@@ -517,10 +573,10 @@ class TardisFS(fuse.Fuse):
         if depth < 2:
             return -errno.ENOENT
 
-        # TODO: Lock this
-        if path in self.files:
-            self.files[path]["opens"] += 1
-            return 0
+        with self.filesLock:
+            if path in self.files:
+                self.files[path]["opens"] += 1
+                return 0
 
         parts = getParts(path)
         b = self.getBackupSetInfo(parts[0])
@@ -528,27 +584,22 @@ class TardisFS(fuse.Fuse):
             subpath = parts[1]
             if self.crypt:
                 subpath = self.crypt.encryptPath(subpath)
-            f = self.regenerator.recoverFile(subpath, b['backupset'], nameEncrypted=True, authenticate=self.authenticate)
+            # Files stored whole, or in chunks, can be read in place.  Deltas have to be regenerated into a temporary file.
+            f = self.regenerator.recoverFile(subpath, b['backupset'], nameEncrypted=True, authenticate=self.authenticate, lazy=True)
             if f:
                 try:
-                    f.flush()
-                    f.seek(0)
-                except (AttributeError, IOError):
-                    bytesCopied = 0
-                    self.log.debug("Copying file to tempfile")
-                    temp = tempfile.TemporaryFile()
-                    chunk = f.read(65536)
-                    while chunk:
-                        bytesCopied = bytesCopied + len(chunk)
-                        temp.write(chunk)
-                        chunk = f.read(65536)
-                    f.close()
-                    self.log.debug("Copied %d bytes to tempfile", bytesCopied)
-                    temp.flush()
-                    temp.seek(0)
-                    f = temp
-
-                self.files[path] = {"file": f, "opens": 1}
+                    f = self.regenerator.makeSeekable(f)
+                except Exception as e:
+                    self.log.error("Unable to read %s: %s", path, e)
+                    return -errno.EIO
+
+                with self.filesLock:
+                    if path in self.files:
+                        # Opened by another thread while this one was regenerating it.  Use theirs.
+                        self.files[path]["opens"] += 1
+                        f.close()
+                    else:
+                        self.files[path] = {"file": f, "opens": 1, "lock": threading.Lock()}
                 return 0
         # Otherwise.....
         return -errno.ENOENT
@@ -557,10 +608,14 @@ class TardisFS(fuse.Fuse):
     @tracer
     def read ( self, path, length, offset ):
         #self.log.info('CALL read {} {} {}'.format(path, length, offset))
-        f = self.files[path]["file"]
-        if f:
-            f.seek(offset)
-            return f.read(length)
+        with self.filesLock:
+            entry = self.files.get(path)
+        if entry:
+            # Seek and read have to go together
+            with entry["lock"]:
+                f = entry["file"]
+                f.seek(offset)
+                return f.read(length)
         return -errno.EINVAL
 
     @tracer
@@ -586,7 +641,6 @@ class TardisFS(fuse.Fuse):
                 if self.crypt:
                     subpath = self.crypt.encryptPath(subpath)
                 f = self.regenerator.recoverFile(subpath, b['backupset'], nameEncrypted=True, authenticate=self.authenticate)
-                f.flush()
                 link = f.readline()
                 f.close()
                 if self.repoint:
@@ -600,13 +654,18 @@ class TardisFS(fuse.Fuse):
     def release ( self, path, flags ):
         path = self.fsEncodeName(path)
 
-        if self.files[path]:
-            self.files[path]["opens"] -= 1
-            if self.files[path]["opens"] == 0:
-                self.files[path]["file"].close()
-                del self.files[path]
-            return 0
-        return -errno.EINVAL
+        with self.filesLock:
+            entry = self.files.get(path)
+            if not entry:
+                return -errno.EINVAL
+            entry["opens"] -= 1
+            if entry["opens"] > 0:
+                return 0
+            del self.files[path]
+        # Let any read in progress finish first
+        with entry["lock"]:
+            entry["file"].close()
+        return 0
 
     @tracer
     def rename ( self, oldPath, newPath ):
@@ -771,7 +830,6 @@ def main():
         sys.exit(1)
 
     fs.flags = 0
-    fs.multithreaded = 0
 
     try:
         logger.debug("TardsFS Version: %s", Tardis.__versionstring__)
@@ -781,6 +839,8 @@ def main():
         logger.debug("DBName: %s", fs.dbname)
         logger.debug("Repoint Links: %s", fs.repoint)
         fs.main()
+        fs.cache.logStats()
+        fs.fileCache.logStats()
     except Exception as e:
         logger.exception(e)
 
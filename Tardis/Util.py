@@ -411,6 +411,7 @@ def setupDataConnection(dataLoc, client, password, keyFile, dbName, dbLoc=None,
             dbDir = os.path.join(dbLoc, client)
         dbPath = os.path.join(dbDir, dbName)
         tardis = TardisDB.TardisDB(dbPath, allow_upgrade=allow_upgrade)
+        cache.usePacks(tardis)
 
     needsAuth = tardis.needsAuthentication()
     if needsAuth and password is None:
@@ -459,8 +460,9 @@ def _removeOrphans(db, cache):
 
     size = 0
     count = 0
-    # Get a list of orphan'd files
-    orphans = db.listOrphanChecksums(isFile=True)
+    deleted = 0
+    # Get a list of orphan'd files.  Read them all first, as deleting them adds more candidates to the list being read.
+    orphans = list(db.listOrphanChecksums(isFile=True))
     for cksum in orphans:
         logger.debug("Removing %s", cksum)
         # And remove them each....
@@ -475,10 +477,11 @@ def _removeOrphans(db, cache):
 
             cache.removeSuffixes(cksum, _suffixes)
 
-            db.deleteChecksum(cksum)
+            # Chunked files have no file of their own, but deleting them can orphan their chunks
+            deleted += db.deleteChecksum(cksum)
         except OSError:
             logger.warning("No checksum file for checksum %s", cksum)
-    return count, size
+    return count, size, deleted
 
 def removeOrphans(db, cache):
     count = 0
@@ -488,15 +491,21 @@ def removeOrphans(db, cache):
     # we have to do this, as there can be multiple levels of basis files, each dependant on the one above (below?)
     # Theoretically we should be able to do this is one go, but SQLite's implementation of recursive queries doesn't
     # seem to work quite right.
+    # Only checksums which are candidates (new, or which have lost a reference) are checked, so each round only costs
+    # in proportion to what's changed.  Deleting a checksum makes its basis, and its chunks, candidates for the next round.
     while True:
-        (lCount, lSize) = _removeOrphans(db, cache)
-        if lCount == 0:
+        (lCount, lSize, lDeleted) = _removeOrphans(db, cache)
+        if lDeleted == 0:
             break
         rounds += 1
         count  += lCount
         size   += lSize
 
     db.deleteOrphanChecksums(False)
+    # Everything left among the candidates is still in use
+    db.clearOrphanCandidates()
+    # Compact any pack files which the removed checksums have left mostly empty
+    cache.repack()
     return count, size, rounds
 
 # Data transmission functions
@@ -511,10 +520,12 @@ def _chunks(stream, chunksize):
 
 _transmissionTime = 0
 
-def sendData(sender, data, encrypt=lambda x:x, pad=lambda x:x, chunksize=(16 * 1024), hasher=None, compress=None, stats=None, signature=False, hmac=None, iv=None, progress=None, progressPeriod=8*1024*1024):
+def sendData(sender, data, encrypt=lambda x:x, pad=lambda x:x, chunksize=(16 * 1024), hasher=None, compress=None, stats=None, signature=False, hmac=None, iv=None, progress=None, progressPeriod=8*1024*1024, info=None, indexBlock=1024*1024):
     """
     Send a block of data, optionally encrypt and/or compress it before sending
-    Compress should be either None, for no compression, or one of the known compression types (zlib, bzip, lzma)
+    Compress should be either None, for no compression, or one of the known compression types (zlib, bzip, lzma, zstd, lz4)
+    If info is a dictionary, the compressed size, and whether the data was actually compressed, are returned in it
+    zlib compressed data is indexed every indexBlock bytes, so it can be read from the middle.  The index is sent with the data.
     """
     #logger = logging.getLogger('Data')
     if isinstance(sender, Connection.Connection):
@@ -531,7 +542,7 @@ def sendData(sender, data, encrypt=lambda x:x, pad=lambda x:x, chunksize=(16 * 1
             progressPeriod -= progressPeriod % chunksize
 
     if compress:
-        stream = CompressedBuffer.CompressedBufferedReader(data, hasher=hasher, signature=signature, compressor=compress)
+        stream = CompressedBuffer.CompressedBufferedReader(data, hasher=hasher, signature=signature, compressor=compress, indexBlock=indexBlock)
     else:
         stream = CompressedBuffer.BufferedReader(data, hasher=hasher, signature=signature)
 
@@ -571,10 +582,17 @@ def sendData(sender, data, encrypt=lambda x:x, pad=lambda x:x, chunksize=(16 * 1
         sender.sendMessage('', raw=True)
         compressed = compress if stream.isCompressed() else "None"
         size = stream.size()
+        index = stream.blockIndex()
+        if info is not None:
+            info['compsize'] = stream.compsize()
+            info['compressed'] = stream.isCompressed()
+            info['index'] = index
 
         accumulateStat(stats, 'dataBacked', size)
 
         message = { "chunk": "done", "size": size, "status": status, "compressed": compressed }
+        if index:
+            message["index"] = index
         if hasher:
             ck = stream.checksum()
             message["checksum"] = ck
@@ -588,9 +606,9 @@ def sendData(sender, data, encrypt=lambda x:x, pad=lambda x:x, chunksize=(16 * 1
         _transmissionTime += end - start
     return size, ck, sig
 
-def receiveData(receiver, output):
+def receiveData(receiver, output, info=None):
     """ Receive a block of data from the sender, and store it in the specified file.
-    Collect some info sent, and return it.
+    Collect some info sent, and return it.  If info is a dictionary, the block index of the data, if any, is returned in it.
     """
     # logger = logging.getLogger('Data')
     if isinstance(receiver, Connection.Connection):
@@ -599,16 +617,15 @@ def receiveData(receiver, output):
     checksum = None
     compressed = False
     while True:
-        chunk = receiver.recvMessage(raw=True)
-        #print chunk
-        # logger.debug("Chunk: %s", str(chunk))
-        if len(chunk) == 0:
+        # bytes may be a view into the receive buffer, so write it out before the next receive
+        bytes = receiver.recvData()
+        if len(bytes) == 0:
             break
-        bytes = receiver.decode(chunk)
         if output:
             output.write(bytes)
-            output.flush()
         bytesReceived += len(bytes)
+    if output:
+        output.flush()
 
     chunk = receiver.recvMessage()
     status = chunk['status']
@@ -617,6 +634,8 @@ def receiveData(receiver, output):
         checksum = chunk['checksum']
     if 'compressed' in chunk:
         compressed = chunk['compressed']
+    if info is not None:
+        info['index'] = chunk.get('index')
     return (bytesReceived, status, size, checksum, compressed)
 
 
@@ -716,10 +735,7 @@ def recordMetaData(cache, checksum, size, compressed, encrypted, disksize, basis
     logger.debug("Storing metadata for %s: %s", checksum, metaStr)
 
     try:
-        f = cache.open(metaName, 'wb')
-        f.write(metaStr)
-        f.write('\n')
-        f.close()
+        cache.store(metaName, metaStr + '\n')
     except Exception as e:
         logger.warning("Could not write metadata file for %s: %s: %s", checksum, metaName, str(e))
 
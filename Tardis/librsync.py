@@ -151,13 +151,23 @@ def _execute(job, f, o=None):
     # Re-use the same buffer for output, we will read from it after each
     # iteration.
     out = ctypes.create_string_buffer(RS_JOB_BLOCKSIZE)
+    # Input librsync didn't consume last time around.  Kept here and handed
+    # back on the next iteration, rather than seeking back in `f`, so `f` can
+    # be a stream (such as a decrypting or decompressing reader).
+    pending = ""
+    eof = False
     while True:
-        block = f.read(RS_JOB_BLOCKSIZE)
+        if not eof and len(pending) < RS_JOB_BLOCKSIZE:
+            data = f.read(RS_JOB_BLOCKSIZE)
+            eof = not data
+            block = pending + data if pending else data
+        else:
+            block = pending
         buff = Buffer()
         # provide the data block via input buffer.
         buff.next_in = ctypes.c_char_p(block)
         buff.avail_in = ctypes.c_size_t(len(block))
-        buff.eof_in = ctypes.c_int(not block)
+        buff.eof_in = ctypes.c_int(eof)
         # Set up our buffer for output.
         buff.next_out = ctypes.cast(out, ctypes.c_char_p)
         buff.avail_out = ctypes.c_size_t(RS_JOB_BLOCKSIZE)
@@ -168,12 +178,7 @@ def _execute(job, f, o=None):
             break
         elif r != RS_BLOCKED:
             raise LibrsyncError(r)
-        if buff.avail_in > 0:
-            # There is data left in the input buffer, librsync did not consume
-            # all of it. Rewind the file a bit so we include that data in our
-            # next read. It would be better to simply tack data to the end of
-            # this buffer, but that is very difficult in Python.
-            f.seek(f.tell() - buff.avail_in)
+        pending = block[len(block) - buff.avail_in:] if buff.avail_in > 0 else ""
     if o and callable(getattr(o, 'seek', None)):
         # As a matter of convenience, rewind the output file.
         o.seek(0)
@@ -311,3 +316,48 @@ class SignatureJob(object):
             # As a matter of convenience, rewind the output file.
             self.output.seek(0)
         return self.output
+
+class PatchJob(object):
+    """
+    Patch the seekable file `f` a block of the delta at a time, so the patched
+    output can be consumed as it's generated, rather than written to a file.
+    """
+    def __init__(self, f):
+        @patch_callback
+        def read_cb(opaque, pos, length, buff):
+            f.seek(pos)
+            size_p = ctypes.cast(length, ctypes.POINTER(ctypes.c_size_t)).contents
+            size = size_p.value
+            block = f.read(size)
+            size_p.value = len(block)
+            buff_p = ctypes.cast(buff, ctypes.POINTER(ctypes.c_char_p)).contents
+            buff_p.value = block
+            return RS_DONE
+
+        # Keep a reference to the callback, so it isn't freed while the job can still call it.
+        self.read_cb = read_cb
+        self.job = _librsync.rs_patch_begin(read_cb, None)
+        self.out = ctypes.create_string_buffer(RS_JOB_BLOCKSIZE)
+
+    def step(self, data, eof):
+        """
+        Feed a block of the delta to the job.  Returns the output generated, the
+        part of the block the job didn't consume, and whether the patch is done.
+        """
+        buff = Buffer()
+        buff.next_in = ctypes.c_char_p(data)
+        buff.avail_in = ctypes.c_size_t(len(data))
+        buff.eof_in = ctypes.c_int(eof)
+        buff.next_out = ctypes.cast(self.out, ctypes.c_char_p)
+        buff.avail_out = ctypes.c_size_t(RS_JOB_BLOCKSIZE)
+        r = _librsync.rs_job_iter(self.job, ctypes.byref(buff))
+        if r != RS_DONE and r != RS_BLOCKED:
+            raise LibrsyncError(r)
+        output = self.out.raw[:RS_JOB_BLOCKSIZE - buff.avail_out]
+        remaining = data[len(data) - buff.avail_in:] if buff.avail_in > 0 else ""
+        return (output, remaining, r == RS_DONE)
+
+    def close(self):
+        if self.job:
+            _librsync.rs_job_free(self.job)
+            self.job = None
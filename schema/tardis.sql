@@ -1,5 +1,3 @@
-PRAGMA journal_mode=truncate;
-
 CREATE TABLE IF NOT EXISTS Config (
     Key             TEXT PRIMARY KEY,
     Value           TEXT NOT NULL,
@@ -52,9 +50,34 @@ CREATE TABLE IF NOT EXISTS CheckSums (
     ChainLength INTEGER,
     Added       INTEGER,            -- References BackupSet, but not foreign key, as sets can be deleted.
     IsFile      INTEGER,            -- Boolean, is there a file backing this checksum
+    Chunked     INTEGER DEFAULT 0,  -- Boolean, is the content stored as a list of chunks in ChunkMaps
+    BlockIndex  TEXT,               -- JSON list of [uncompressed, compressed] offsets where the compressed data can be entered
     FOREIGN KEY(Basis) REFERENCES CheckSums(Checksum)
 );
 
+CREATE TABLE IF NOT EXISTS ChunkMaps (
+    ChecksumId  INTEGER NOT NULL,   -- The chunked file
+    Sequence    INTEGER NOT NULL,
+    ChunkId     INTEGER NOT NULL,   -- A chunk of the file, stored as a regular checksum
+    PRIMARY KEY(ChecksumId, Sequence),
+    FOREIGN KEY(ChecksumId) REFERENCES CheckSums(ChecksumId),
+    FOREIGN KEY(ChunkId)    REFERENCES CheckSums(ChecksumId)
+);
+
+CREATE TABLE IF NOT EXISTS Packs (
+    PackId      INTEGER PRIMARY KEY AUTOINCREMENT,
+    Size        INTEGER DEFAULT 0,  -- Bytes written to the pack file
+    Live        INTEGER DEFAULT 0   -- Bytes still referenced by members
+);
+
+CREATE TABLE IF NOT EXISTS PackMembers (
+    Name        TEXT PRIMARY KEY,   -- Name in the CacheDir
+    PackId      INTEGER NOT NULL,
+    Offset      INTEGER NOT NULL,
+    Size        INTEGER NOT NULL,
+    FOREIGN KEY(PackId) REFERENCES Packs(PackId)
+);
+
 CREATE TABLE IF NOT EXISTS Names (
     Name        TEXT UNIQUE NOT NULL,
     NameId      INTEGER PRIMARY KEY AUTOINCREMENT
@@ -90,6 +113,13 @@ CREATE TABLE IF NOT EXISTS Files (
 );
 
 CREATE INDEX IF NOT EXISTS CheckSumIndex ON CheckSums(Checksum);
+CREATE INDEX IF NOT EXISTS ChunkIndex ON ChunkMaps(ChunkId);
+CREATE INDEX IF NOT EXISTS PackMemberIndex ON PackMembers(PackId);
+CREATE INDEX IF NOT EXISTS BasisIndex ON CheckSums(Basis);
+CREATE INDEX IF NOT EXISTS FileChecksumIndex ON Files(ChecksumId);
+CREATE INDEX IF NOT EXISTS FileXattrIndex ON Files(XattrId);
+CREATE INDEX IF NOT EXISTS FileAclIndex ON Files(AclId);
+CREATE INDEX IF NOT EXISTS FirstSetIndex ON Files(FirstSet);
 
 CREATE INDEX IF NOT EXISTS InodeFirstIndex ON Files(Inode ASC, Device ASC, FirstSet ASC);
 CREATE INDEX IF NOT EXISTS ParentFirstIndex ON Files(Parent ASC, ParentDev ASC, FirstSet ASC);
@@ -98,6 +128,56 @@ CREATE INDEX IF NOT EXISTS ParentLastndex ON Files(Parent ASC, ParentDev ASC, La
 CREATE INDEX IF NOT EXISTS NameIndex ON Names(Name ASC);
 CREATE INDEX IF NOT EXISTS InodeIndex ON Files(Inode ASC, Device ASC, Parent ASC, ParentDev ASC, FirstSet ASC, LastSet ASC);
 
+-- Checksums which may have lost their last reference, and so need to be checked for orphans.  Filled by the triggers
+-- below, so orphan removal only needs to look at what's changed since it last ran.
+CREATE TABLE IF NOT EXISTS OrphanCandidates (
+    ChecksumId  INTEGER PRIMARY KEY
+);
+
+CREATE TRIGGER IF NOT EXISTS CandidateNewChecksum AFTER INSERT ON CheckSums
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) VALUES (NEW.ChecksumId);
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateDeletedChecksum AFTER DELETE ON CheckSums
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT ChecksumId FROM CheckSums WHERE Checksum = OLD.Basis;
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateUpdatedChecksum AFTER UPDATE OF Basis ON CheckSums WHEN OLD.Basis IS NOT NEW.Basis
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT ChecksumId FROM CheckSums WHERE Checksum = OLD.Basis;
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateDeletedFile AFTER DELETE ON Files
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT OLD.ChecksumId WHERE OLD.ChecksumId IS NOT NULL;
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT OLD.XattrId WHERE OLD.XattrId IS NOT NULL;
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT OLD.AclId WHERE OLD.AclId IS NOT NULL;
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateUpdatedFile AFTER UPDATE OF ChecksumId, XattrId, AclId ON Files
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT OLD.ChecksumId WHERE OLD.ChecksumId IS NOT NULL AND OLD.ChecksumId IS NOT NEW.ChecksumId;
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT OLD.XattrId WHERE OLD.XattrId IS NOT NULL AND OLD.XattrId IS NOT NEW.XattrId;
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) SELECT OLD.AclId WHERE OLD.AclId IS NOT NULL AND OLD.AclId IS NOT NEW.AclId;
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateDeletedBackup AFTER DELETE ON Backups WHEN OLD.CmdLineId IS NOT NULL
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) VALUES (OLD.CmdLineId);
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateUpdatedBackup AFTER UPDATE OF CmdLineId ON Backups WHEN OLD.CmdLineId IS NOT NULL AND OLD.CmdLineId IS NOT NEW.CmdLineId
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) VALUES (OLD.CmdLineId);
+END;
+
+CREATE TRIGGER IF NOT EXISTS CandidateDeletedChunk AFTER DELETE ON ChunkMaps
+BEGIN
+    INSERT OR IGNORE INTO OrphanCandidates (ChecksumId) VALUES (OLD.ChunkId);
+END;
+
 INSERT OR IGNORE INTO Backups (Name, StartTime, EndTime, ClientTime, Completed, Priority, FilesFull, FilesDelta, BytesReceived) VALUES (".Initial", 0, 0, 0, 1, 0, 0, 0, 0);
     
 CREATE VIEW IF NOT EXISTS VFiles AS
@@ -107,5 +187,5 @@ CREATE VIEW IF NOT EXISTS VFiles AS
     JOIN Backups ON Backups.BackupSet BETWEEN Files.FirstSet AND Files.LastSet
     LEFT OUTER JOIN CheckSums ON Files.ChecksumId = CheckSums.ChecksumId;
 
-INSERT OR REPLACE INTO Config (Key, Value) VALUES ("SchemaVersion", "16");
+INSERT OR REPLACE INTO Config (Key, Value) VALUES ("SchemaVersion", "21");
 INSERT OR REPLACE INTO Config (Key, Value) VALUES ("VacuumInterval", "5");
@@ -40,6 +40,7 @@ setup(  name                    = 'Tardis-Backup',
                             'requests',       'flask',     'tornado',       'termcolor',     'passwordmeter',   'pid',
                             'python-magic',   'urllib3',   'binaryornot',   'pyliblzma',     'python-snappy',   'srp',
                             'colorlog',       'progressbar2',   'reportlab', 'qrcode'         ] + add_pkgs,
+        extras_require = { 'zstd': ['zstandard'], 'lz4': ['lz4'] },
         data_files = [( root + '/etc/tardis',                     [ 'tardisd.cfg-template', 'types.ignore', 'tardisremote.cfg-template' ]),
                       ( 'schema',                                 [ 'schema/tardis.sql' ] + convert_scripts),
                       ( 'info',                                   [ 'tardisversion' ]),
@@ -0,0 +1,116 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2016, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import time
+import unittest
+
+from Tardis import Cache
+
+class CacheTest(unittest.TestCase):
+    def testLRU(self):
+        c = Cache.Cache(3, 0)
+        for i in range(3):
+            c.insert(i, i * 100)
+        # Using 0 makes 1 the least recently used
+        self.assertEqual(c.retrieve(0), 0)
+        c.insert(3, 300)
+        self.assertEqual(len(c), 3)
+        self.assertIsNone(c.retrieve(1))
+        self.assertEqual([c.retrieve(i) for i in (0, 2, 3)], [0, 200, 300])
+        # Replacing an entry doesn't evict anything
+        c.insert(0, 1000)
+        self.assertEqual([c.retrieve(i) for i in (0, 2, 3)], [1000, 200, 300])
+        self.assertEqual(c.stats()['evictions'], 1)
+
+    def testTimeout(self):
+        c = Cache.Cache(0, 10)
+        now = time.time()
+        c.insert('old', 1, now=now - 20)
+        c.insert('new', 2, now=now)
+        c.insert('forever', 3, now=now - 20, timeout=0)
+        self.assertIsNone(c.retrieve('old'))
+        self.assertEqual(c.retrieve('new'), 2)
+        self.assertEqual(c.retrieve('forever'), 3)
+        self.assertEqual(c.stats()['expirations'], 1)
+
+    def testFlush(self):
+        c = Cache.Cache(0, 10)
+        now = time.time()
+        for i in range(5):
+            c.insert(i, i, now=now - 20)
+        self.assertEqual(len(c), 5)
+        c.flush()
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.stats()['expirations'], 5)
+
+    def testSweep(self):
+        # Expired entries are swept up by an insert, once per timeout period
+        c = Cache.Cache(0, 10)
+        now = time.time()
+        for i in range(5):
+            c.insert(i, i, now=now - 20)
+        c.insert(5, 5, now=now - 15)
+        self.assertEqual(len(c), 6)
+        c.insert(6, 6, now=now)
+        self.assertEqual(len(c), 1)
+
+    def testMaxBytes(self):
+        c = Cache.Cache(0, 0, maxBytes=100, sizeOf=len)
+        c.insert('a', 'x' * 40)
+        c.insert('b', 'x' * 40)
+        self.assertEqual(c.stats()['bytes'], 80)
+        c.insert('c', 'x' * 40)
+        self.assertIsNone(c.retrieve('a'))
+        self.assertEqual(c.stats()['bytes'], 80)
+        c.insert('b', 'x' * 10)
+        self.assertEqual(c.stats()['bytes'], 50)
+        c.delete('c')
+        self.assertEqual(c.stats()['bytes'], 10)
+        # Too large to keep at all
+        c.insert('d', 'x' * 200)
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.stats()['bytes'], 0)
+
+    def testSizeOf(self):
+        self.assertGreater(Cache.sizeOf(['x' * 1000]), Cache.sizeOf(['x']) + 900)
+        self.assertGreater(Cache.sizeOf({'a': 'x' * 1000}), 1000)
+
+    def testStats(self):
+        c = Cache.Cache(1, 0)
+        c.insert(1, 1)
+        c.retrieve(1)
+        c.retrieve(2)
+        c.insert(2, 2)
+        self.assertEqual(c.stats(), {'entries': 1, 'bytes': 0, 'hits': 1, 'misses': 1, 'evictions': 1, 'expirations': 0})
+        c.purge()
+        self.assertEqual(len(c), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2016, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import StringIO
+import unittest
+
+from Tardis import Chunker
+
+class ChunkerTest(unittest.TestCase):
+    # Chunk boundaries are part of the on-disk format:  chunks already stored are only reused if the same content is
+    # cut at the same places.  If these fail, the gear table or the cut point selection has changed.
+    boundaries = [5044, 4369, 4116, 3239, 2188, 5418, 4916, 5041, 3075, 4821, 7766, 4231, 8389, 3939, 6091, 4159,
+                  4511, 5046, 3884, 8225, 1288, 4225, 5656, 4524, 2779, 1599, 4344, 4743, 1650, 1101, 695]
+
+    def setUp(self):
+        self.data = ''.join(hashlib.md5(str(i)).digest() for i in range(8192))
+
+    def chunk(self, data, **kwargs):
+        return list(Chunker.chunks(StringIO.StringIO(data), **kwargs))
+
+    def testGearTable(self):
+        self.assertEqual(len(Chunker._gear), 256)
+        self.assertEqual(Chunker._gear[:4], [2911221907, 138454357, 1485596830, 896034438])
+        self.assertEqual(hashlib.md5(''.join('%08x' % g for g in Chunker._gear)).hexdigest(), '1e44e239a1f97b4798e0922378a085d6')
+
+    def testBoundaries(self):
+        chunks = self.chunk(self.data, minSize=1024, avgSize=4096, maxSize=16384)
+        self.assertEqual(map(len, chunks), self.boundaries)
+        self.assertEqual(''.join(chunks), self.data)
+
+    def testMaxSize(self):
+        chunks = self.chunk('\0' * 100000, minSize=1024, avgSize=4096, maxSize=16384)
+        self.assertEqual(''.join(chunks), '\0' * 100000)
+        self.assertTrue(all(len(c) <= 16384 for c in chunks))
+        self.assertTrue(all(len(c) == 16384 for c in chunks[:-1]))
+
+    def testShift(self):
+        # Inserting data near the start should only change the chunks around it.
+        before = self.chunk(self.data, minSize=1024, avgSize=4096, maxSize=16384)
+        after = self.chunk(self.data[:100] + 'inserted' + self.data[100:], minSize=1024, avgSize=4096, maxSize=16384)
+        self.assertEqual(before[2:], after[2:])
+
+    def testEmpty(self):
+        self.assertEqual(self.chunk(''), [])
+
+if __name__ == '__main__':
+    unittest.main()
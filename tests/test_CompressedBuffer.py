@@ -0,0 +1,80 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2016, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import zlib
+import StringIO
+import unittest
+
+from Tardis import CompressedBuffer
+
+def makeData(lines=5000):
+    return "".join("Line %d of some fairly compressible data\n" % i for i in range(lines))
+
+class CompressedBufferTest(unittest.TestCase):
+    def compress(self, data, **kwargs):
+        reader = CompressedBuffer.CompressedBufferedReader(StringIO.StringIO(data), **kwargs)
+        out = reader.read()
+        return (reader, out)
+
+    def testRoundTrip(self):
+        data = makeData()
+        (reader, out) = self.compress(data)
+        self.assertTrue(reader.isCompressed())
+        self.assertEqual(reader.origsize(), len(data))
+        self.assertEqual(reader.compsize(), len(out))
+        self.assertEqual(zlib.decompress(out), data)
+        self.assertIsNone(reader.blockIndex())
+
+    def testIncompressible(self):
+        data = "".join(hashlib.md5(str(i)).digest() for i in range(8192))
+        (reader, out) = self.compress(data)
+        self.assertFalse(reader.isCompressed())
+        self.assertEqual(out, data)
+        self.assertIsNone(reader.blockIndex())
+
+    def testBlockIndex(self):
+        data = makeData()
+        (reader, out) = self.compress(data, chunksize=1000, indexBlock=4000)
+        index = reader.blockIndex()
+        self.assertTrue(index)
+        self.assertEqual(zlib.decompress(out), data)
+        self.assertEqual(index, sorted(index))
+        for (uncomp, comp) in index:
+            # Each entry is a point after a full flush, where a raw deflate decompressor can start
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            self.assertEqual(decompressor.decompress(out[comp:]), data[uncomp:])
+
+    def testBlockIndexOtherCompressor(self):
+        (reader, _) = self.compress(makeData(), chunksize=1000, indexBlock=4000, compressor='bzip')
+        self.assertIsNone(reader.blockIndex())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2016, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from Tardis import FileState
+
+class FileStateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "state.db")
+        self.state = FileState.FileState(self.path, "identity")
+        # Old enough to have been changed before the state was opened
+        self.old = self.state.started - 100
+        self.info = {'dev': 1, 'inode': 2, 'size': 100, 'mtime': self.old, 'ctime': self.old}
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.dir)
+
+    def testChecksum(self):
+        self.assertIsNone(self.state.getChecksum(self.info))
+        self.state.setState(self.info, "abcd")
+        self.assertEqual(self.state.getChecksum(self.info), "abcd")
+        for field in ('size', 'mtime', 'ctime'):
+            changed = dict(self.info)
+            changed[field] += 1
+            self.assertIsNone(self.state.getChecksum(changed))
+        self.assertIsNone(self.state.getChecksum(dict(self.info, inode=3)))
+
+    def testRecentlyChanged(self):
+        # Changed in the second the state was opened, so the checksum can't be trusted, but the signature can be used
+        info = dict(self.info, mtime=self.state.started)
+        self.state.setState(info, "abcd", "signature")
+        self.assertIsNone(self.state.getChecksum(info))
+        self.assertEqual(self.state.getSignature(info, "abcd").read(), "signature")
+        info = dict(self.info, ctime=self.state.started + 10)
+        self.state.setState(info, "abcd")
+        self.assertIsNone(self.state.getChecksum(info))
+
+    def testSignature(self):
+        self.state.setState(self.info, "abcd", "signature")
+        self.assertEqual(self.state.getSignature(self.info, "abcd").read(), "signature")
+        self.assertIsNone(self.state.getSignature(self.info, "efgh"))
+        # Kept if the contents don't change, and dropped if they do
+        self.state.setState(dict(self.info, ctime=self.old + 1), "abcd")
+        self.assertEqual(self.state.getSignature(self.info, "abcd").read(), "signature")
+        self.state.setState(self.info, "efgh")
+        self.assertIsNone(self.state.getSignature(self.info, "efgh"))
+
+    def testReopen(self):
+        self.state.setState(self.info, "abcd")
+        self.state.close()
+        self.state = FileState.FileState(self.path, "identity")
+        self.assertEqual(self.state.getChecksum(self.info), "abcd")
+
+    def testIdentity(self):
+        self.state.setState(self.info, "abcd")
+        self.state.close()
+        self.state = FileState.FileState(self.path, "other")
+        self.assertIsNone(self.state.getChecksum(self.info))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2016, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+from Tardis import RegenCache
+
+class RegenCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = RegenCache.RegenCache(os.path.join(self.dir, "regen"), maxSize=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def get(self, cache, checksum):
+        f = cache.get(checksum)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def testPutGet(self):
+        self.assertIsNone(self.cache.get("abcd"))
+        data = StringIO.StringIO("contents")
+        self.cache.put("abcd", data, 1.0)
+        self.assertEqual(data.tell(), 0)
+        self.assertEqual(self.get(self.cache, "abcd"), "contents")
+
+    def testClients(self):
+        one = self.cache.forClient("one")
+        two = self.cache.forClient("two/..")
+        one.put("abcd", StringIO.StringIO("one"), 1.0)
+        two.put("abcd", StringIO.StringIO("two"), 1.0)
+        self.assertEqual(self.get(one, "abcd"), "one")
+        self.assertEqual(self.get(two, "abcd"), "two")
+        self.assertIsNone(self.cache.get("abcd"))
+        self.assertIsNone(self.cache.forClient("three").get("abcd"))
+
+    def testTooLarge(self):
+        self.cache.put("abcd", StringIO.StringIO("x" * 1001), 1.0)
+        self.assertIsNone(self.cache.get("abcd"))
+
+    def testEviction(self):
+        # The cheapest entry, for its size, goes first
+        self.cache.put("aaaa", StringIO.StringIO("a" * 400), 10.0)
+        self.cache.put("bbbb", StringIO.StringIO("b" * 400), 1.0)
+        self.cache.put("cccc", StringIO.StringIO("c" * 400), 5.0)
+        self.assertIsNone(self.cache.get("bbbb"))
+        self.assertEqual(self.get(self.cache, "aaaa"), "a" * 400)
+        self.assertEqual(self.get(self.cache, "cccc"), "c" * 400)
+        # The newest entry is never the one evicted, even if it's the cheapest
+        self.cache.put("dddd", StringIO.StringIO("d" * 400), 0.0)
+        self.assertEqual(self.get(self.cache, "dddd"), "d" * 400)
+        self.assertIsNone(self.cache.get("cccc"))
+
+    def testAging(self):
+        self.cache.put("aaaa", StringIO.StringIO("a" * 400), 4.0)
+        self.cache.put("bbbb", StringIO.StringIO("b" * 400), 1.0)
+        self.cache.put("cccc", StringIO.StringIO("c" * 400), 3.6)
+        # Evicting bbbb advanced the clock, so using cccc again puts it above aaaa
+        self.assertIsNone(self.cache.get("bbbb"))
+        self.assertEqual(self.get(self.cache, "cccc"), "c" * 400)
+        self.cache.put("dddd", StringIO.StringIO("d" * 400), 100.0)
+        self.assertIsNone(self.cache.get("aaaa"))
+        self.assertEqual(self.get(self.cache, "cccc"), "c" * 400)
+
+    def testMissingFile(self):
+        self.cache.put("abcd", StringIO.StringIO("contents"), 1.0)
+        os.remove(self.cache._path("abcd"))
+        self.assertIsNone(self.cache.get("abcd"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2016, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import zlib
+import StringIO
+import unittest
+
+from Tardis import CompressedBuffer, Regenerator
+
+def makeData(lines=5000):
+    return "".join("Line %d of some fairly compressible data\n" % i for i in range(lines))
+
+class SeekableReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.data = makeData()
+        reader = CompressedBuffer.CompressedBufferedReader(StringIO.StringIO(self.data), chunksize=1000, indexBlock=4000)
+        self.compressed = reader.read()
+        self.index = reader.blockIndex()
+
+    def check(self, reader):
+        self.assertEqual(reader.read(), self.data)
+        self.assertEqual(reader.read(10), "")
+        # Within a block, across blocks, and off the end
+        for (offset, length) in [(0, 10), (5, 100), (3990, 20), (3000, 20000), (len(self.data) - 5, 10), (len(self.data) + 10, 5)]:
+            reader.seek(offset)
+            self.assertEqual(reader.read(length), self.data[offset:offset + length])
+            self.assertEqual(reader.tell(), min(offset + length, max(offset, len(self.data))))
+        reader.seek(-10, os.SEEK_END)
+        self.assertEqual(reader.read(), self.data[-10:])
+        reader.seek(100)
+        reader.seek(50, os.SEEK_CUR)
+        self.assertEqual(reader.read(5), self.data[150:155])
+
+    def testUncompressed(self):
+        self.check(Regenerator.SeekableReader(StringIO.StringIO(self.data), len(self.data)))
+
+    def testIndexed(self):
+        self.check(Regenerator.SeekableReader(StringIO.StringIO(self.compressed), len(self.data), index=self.index))
+
+if __name__ == '__main__':
+    unittest.main()
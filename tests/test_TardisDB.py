@@ -0,0 +1,89 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2016, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from Tardis import TardisDB
+
+schemaFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "schema", "tardis.sql")
+
+class PurgeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = TardisDB.TardisDB(os.path.join(self.dir, "tardis.db"), initialize=schemaFile, backup=False)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def addSets(self, count):
+        # Replace the set a new database starts with
+        self.db.conn.execute("DELETE FROM Backups")
+        for i in range(1, count + 1):
+            self.db.conn.execute("INSERT INTO Backups (Name, BackupSet) VALUES (:name, :bset)", {"name": "Set%d" % i, "bset": i})
+
+    def addFiles(self, files):
+        for (nameid, (first, last)) in files.items():
+            self.db.conn.execute("INSERT INTO Files (NameId, FirstSet, LastSet, Inode, Device, Parent, ParentDev) "
+                                 "VALUES (:nameid, :first, :last, :nameid, 0, 0, 0)",
+                                 {"nameid": nameid, "first": first, "last": last})
+
+    def purge(self, sets):
+        deleted = self.db._deleteSets("WHERE BackupSet IN (%s)" % ", ".join(map(str, sets)), {})
+        self.assertEqual(sorted(deleted), sorted(sets))
+        return self.db._purgeFiles(deleted)
+
+    def files(self):
+        return dict((row[0], (row[1], row[2])) for row in self.db.conn.execute("SELECT NameId, FirstSet, LastSet FROM Files"))
+
+    def testGaps(self):
+        self.addSets(7)
+        self.addFiles({1: (1, 7), 2: (2, 3), 3: (2, 4), 4: (3, 6), 5: (5, 5), 6: (5, 6), 7: (7, 7), 8: (6, 7), 9: (1, 2)})
+        # Leaves sets 1, 4, and 6, with gaps between 1 and 4, 4 and 6, and after 6
+        self.assertEqual(self.purge([2, 3, 5, 7]), 3)
+        self.assertEqual(self.files(), {1: (1, 7), 3: (4, 4), 4: (4, 6), 6: (6, 6), 8: (6, 7), 9: (1, 2)})
+
+    def testFirstSet(self):
+        self.addSets(3)
+        self.addFiles({1: (1, 1), 2: (1, 2), 3: (2, 3)})
+        self.assertEqual(self.purge([1]), 1)
+        self.assertEqual(self.files(), {2: (2, 2), 3: (2, 3)})
+
+    def testAllSets(self):
+        self.addSets(2)
+        self.addFiles({1: (1, 1), 2: (1, 2)})
+        self.assertEqual(self.purge([1, 2]), 2)
+        self.assertEqual(self.files(), {})
+
+if __name__ == '__main__':
+    unittest.main()
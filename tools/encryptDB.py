@@ -63,7 +63,8 @@ def encryptFile(checksum, cacheDir, cipher, iv, pad, hmac, nameHmac, output = No
     return nb
 
 def generateFullFileInfo(checksum, regenerator, cacheDir, nameMac, signature=True, basis=None):
-    i = regenerator.recoverChecksum(checksum, basisFile=basis)
+    # Handed back to be used as the basis for the next file, so it has to be seekable.
+    i = regenerator.makeSeekable(regenerator.recoverChecksum(checksum, basisFile=basis))
     sig = None
     logger.debug("    Generating HMAC for %s.  Generating signature: %s", checksum, str(signature))
     if signature:
@@ -215,7 +216,7 @@ def generateDirHashes(db, crypto, cacheDir):
     logger.info("Hashed %d directories (%d unique)", hashes, unique)
 
 def makeSig(checksum, regenerator, cacheDir):
-    data = regenerator.recoverChecksum(checksum)
+    data = regenerator.recoverBasis(checksum)
     fname = checksum + ".sig"
     output = cacheDir.open(fname, "wb")
     librsync.signature(data, output)
@@ -310,6 +311,7 @@ def main():
     crypto.setKeys(f, c)
 
     cacheDir = CacheDir.CacheDir(os.path.join(args.database, args.client))
+    cacheDir.usePacks(db)
 
     if args.names or args.all:
         encryptFilenames(db, crypto)
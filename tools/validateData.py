@@ -36,6 +36,7 @@ def validate(root, client, dbname, password):
         crypto = TardisCrypto.TardisCrypto(password, client)
         token = crypto.encryptFilename(client)
     db = TardisDB.TardisDB(os.path.join(base, dbname), token=token, backup=False)
+    cache.usePacks(db)
     regen = Regenerate.Regenerator(cache, db, crypto)
 
     conn = db.conn